@@ -0,0 +1,99 @@
+from collections import deque
+from starlette.responses import JSONResponse
+import asyncio
+import math
+import time
+
+"""Contains admission control with bounded concurrency pools per traffic class"""
+
+
+class AdmissionPool:
+    """Runs at most concurrency requests at a time, queueing up to max_queued more for at most max_wait seconds each"""
+
+    def __init__(self, concurrency, max_queued, max_wait):
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.shed = 0
+        # Moving average of seconds requests hold their slot
+        self.service_time = 0.0
+
+    async def acquire(self):
+        """Take a slot, waiting for one if all are taken, returning False if the queue is full or none frees up in time"""
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+            self.admitted += 1
+            return True
+        if len(self.waiters) >= self.max_queued:
+            self.shed += 1
+            return False
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait({waiter}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            # Pass on a slot handed over just as the request was cancelled
+            if waiter.done():
+                self.release(0)
+            else:
+                self.waiters.remove(waiter)
+            raise
+        if not waiter.done():
+            self.waiters.remove(waiter)
+            self.shed += 1
+            return False
+        self.admitted += 1
+        return True
+
+    def release(self, held_seconds):
+        """Hand slot held for held_seconds to the longest waiting request, or free it if none is waiting"""
+        self.service_time += (held_seconds - self.service_time) / 10
+        if self.waiters:
+            self.waiters.popleft().set_result(None)
+        else:
+            self.active -= 1
+
+    def retry_after(self):
+        """Estimate whole seconds until a new request would get a slot, from the queue length and average time slots are held"""
+        return max(1, math.ceil((len(self.waiters) + 1) * self.service_time / max(self.concurrency, 1)))
+
+    def stats(self):
+        """Get limits, active and queued requests and admitted and shed request counts"""
+        return {
+            'concurrency': self.concurrency,
+            'max_queued': self.max_queued,
+            'max_wait': self.max_wait,
+            'active': self.active,
+            'queued': len(self.waiters),
+            'admitted': self.admitted,
+            'shed': self.shed,
+            'service_time': round(self.service_time, 3)
+        }
+
+
+class AdmissionMiddleware:
+    """ASGI middleware holding a slot of the pool of each request's traffic class until its response is sent, shedding it with 503 if none is free in time"""
+
+    def __init__(self, app, pools, classify):
+        self.app = app
+        self.pools = pools
+        # Function getting traffic class of a request scope, None for requests not admission controlled
+        self.classify = classify
+
+    async def __call__(self, scope, receive, send):
+        pool = self.pools.get(self.classify(scope)) if scope['type'] == 'http' else None
+        if pool is None:
+            await self.app(scope, receive, send)
+            return
+        if not await pool.acquire():
+            response = JSONResponse({'detail': 'Server overloaded'}, status_code=503, headers={'Retry-After': str(pool.retry_after())})
+            await response(scope, receive, send)
+            return
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            pool.release(time.monotonic() - started)
@@ -1,17 +1,45 @@
 from databases import Database
+from databases.core import Transaction
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from urllib.parse import quote
+from sqlalchemy.dialects.sqlite import pysqlite
 import sqlalchemy
+import sqlite3
+import asyncio
 import os
+import time
+import datetime
+import functools
 import hashlib
+import operator
 import uuid
+import metrics
+import tracing
+from slow_query_log import SlowQueryLog
 
 # Contains functions for interacting with SQLite database
 
-# Set database URL to production or test database according to environment variable
+# Set database to production, test or in-memory database according to environment variable
 db_name = os.getenv('DB_NAME', 'production')
 if db_name == 'test':
-    DATABASE_URL = 'sqlite:///test_database.db'
+    SQLITE_DATABASE = 'test_database.db'
+elif db_name == 'memory':
+    # Named shared-cache in-memory database so that every connection sees the same data
+    SQLITE_DATABASE = 'file:facility_memory?mode=memory&cache=shared'
 else:
-    DATABASE_URL = 'sqlite:///database.db'
+    SQLITE_DATABASE = 'database.db'
+# Quote database name so the URI query survives URL parsing
+DATABASE_URL = 'sqlite:///' + quote(SQLITE_DATABASE)
+
+
+def sqlite_connect():
+    """Open a plain sqlite3 connection to the current database"""
+    return sqlite3.connect(SQLITE_DATABASE, uri=True, check_same_thread=False)
+
+
+# An in-memory database only lives as long as a connection to it is open, kept from create_schema on
+memory_keeper = None
 
 # Databases to hold reservations and transactions
 # https://fastapi.tiangolo.com/advanced/async-sql-databases/
@@ -24,7 +52,9 @@ reservations = sqlalchemy.Table(
     sqlalchemy.Column('resource', sqlalchemy.String(length=50)),
     sqlalchemy.Column('customer', sqlalchemy.String(length=50)),
     sqlalchemy.Column('reserver', sqlalchemy.String(length=50)),
-    sqlalchemy.Column('cost', sqlalchemy.Float)
+    sqlalchemy.Column('cost', sqlalchemy.Float),
+    # Covers date-range usage reports grouped by resource or customer
+    sqlalchemy.Index('ix_reservations_report', 'date_time', 'resource', 'customer', 'cost')
 )
 transactions = sqlalchemy.Table(
     'transactions',
@@ -32,7 +62,14 @@ transactions = sqlalchemy.Table(
     sqlalchemy.Column('id', sqlalchemy.String(length=36), primary_key=True),
     sqlalchemy.Column('date_time', sqlalchemy.DateTime),
     sqlalchemy.Column('customer', sqlalchemy.String(length=50)),
-    sqlalchemy.Column('amount', sqlalchemy.Float)
+    sqlalchemy.Column('amount', sqlalchemy.Float),
+    # Reservation (and its resource) the transaction pays for or refunds, None for other transactions
+    sqlalchemy.Column('reservation_serial_num', sqlalchemy.String(length=36)),
+    sqlalchemy.Column('resource', sqlalchemy.String(length=50)),
+    # Covers date-range revenue reports grouped by resource or customer
+    sqlalchemy.Index('ix_transactions_report', 'date_time', 'resource', 'customer', 'amount'),
+    # Covers balance sums of customer statements
+    sqlalchemy.Index('ix_transactions_customer', 'customer', 'date_time', 'amount')
 )
 users = sqlalchemy.Table(
     'users',
@@ -51,23 +88,555 @@ settings = sqlalchemy.Table(
     sqlalchemy.Column('setting', sqlalchemy.String(length=50), primary_key=True),
     sqlalchemy.Column('value', sqlalchemy.Boolean)
 )
-database = Database(DATABASE_URL)
-engine = sqlalchemy.create_engine(
-    DATABASE_URL, connect_args={'check_same_thread': False}
+# Append-only log of every insert, update and delete, in the order they were committed
+changes = sqlalchemy.Table(
+    'changes',
+    metadata,
+    # Never reused, so IDs serve as cursors for reading the log from where a reader left off
+    sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('date_time', sqlalchemy.DateTime),
+    sqlalchemy.Column('table_name', sqlalchemy.String(length=50)),
+    sqlalchemy.Column('operation', sqlalchemy.String(length=6)),
+    sqlalchemy.Column('row_key', sqlalchemy.String(length=50)),
+    # JSON object of the row's values after an insert or update, None for a delete
+    sqlalchemy.Column('data', sqlalchemy.Text),
+    # Finds later changes to the same row when compacting
+    sqlalchemy.Index('ix_changes_row', 'table_name', 'row_key', 'id'),
+    sqlite_autoincrement=True
+)
+# Responses of writes sent with an Idempotency-Key header, replayed when the same key is sent again
+idempotency_keys = sqlalchemy.Table(
+    'idempotency_keys',
+    metadata,
+    sqlalchemy.Column('key', sqlalchemy.String(length=255), primary_key=True),
+    # Hash of the method, path, query and body of the request the key was first used for
+    sqlalchemy.Column('fingerprint', sqlalchemy.String(length=64)),
+    sqlalchemy.Column('status_code', sqlalchemy.Integer),
+    sqlalchemy.Column('media_type', sqlalchemy.String(length=100)),
+    sqlalchemy.Column('body', sqlalchemy.LargeBinary),
+    sqlalchemy.Column('created', sqlalchemy.DateTime),
+    # Finds expired keys
+    sqlalchemy.Index('ix_idempotency_keys_created', 'created')
+)
+
+
+def rollup_table(name, key_column):
+    """Define table of daily booking, charge and refund counts and amounts per value of key column"""
+    return sqlalchemy.Table(
+        name,
+        metadata,
+        sqlalchemy.Column('date', sqlalchemy.Date, primary_key=True),
+        sqlalchemy.Column(key_column, sqlalchemy.String(length=50), primary_key=True),
+        sqlalchemy.Column('bookings', sqlalchemy.Integer, nullable=False, server_default='0'),
+        sqlalchemy.Column('booking_amount', sqlalchemy.Float, nullable=False, server_default='0'),
+        sqlalchemy.Column('charges', sqlalchemy.Integer, nullable=False, server_default='0'),
+        sqlalchemy.Column('charge_amount', sqlalchemy.Float, nullable=False, server_default='0'),
+        sqlalchemy.Column('refunds', sqlalchemy.Integer, nullable=False, server_default='0'),
+        sqlalchemy.Column('refund_amount', sqlalchemy.Float, nullable=False, server_default='0')
+    )
+
+
+# Daily rollups of reservations (by reservation date) and transactions (by transaction date), kept up to date by every write
+resource_daily = rollup_table('resource_daily', 'resource')
+customer_daily = rollup_table('customer_daily', 'customer')
+
+
+class QueryStats:
+    """Counts of database work done while query tracking is active"""
+
+    def __init__(self):
+        self.connects = 0
+        self.queries = 0
+        self.writes = 0
+        self.commits = 0
+        self.statements = []
+
+
+database_calls = metrics.Counter('database_calls_total', 'Calls of database functions by function name', ('function',))
+database_statements = metrics.Counter('database_statements_total', 'Database connects, queries, writes and commits', ('kind',))
+password_hash_seconds = metrics.Histogram('password_hash_seconds', 'Time spent hashing passwords', ('operation',))
+# Statements taking at least SLOW_QUERY_SECONDS are logged, the SLOW_QUERY_LOG_SIZE slowest kept for GET /admin/slow_queries
+slow_query_log = SlowQueryLog(float(os.getenv('SLOW_QUERY_SECONDS', '0.1')), int(os.getenv('SLOW_QUERY_LOG_SIZE', '20')))
+# Endpoint the current request is for, noted with slow queries (None outside requests)
+_endpoint = ContextVar('endpoint', default=None)
+# Query stats for the current request (None when tracking is not active)
+_query_stats = ContextVar('query_stats', default=None)
+
+
+@contextmanager
+def track_queries():
+    """Count connects, queries, writes and commits made inside the with block"""
+    stats = QueryStats()
+    token = _query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _query_stats.reset(token)
+
+
+@contextmanager
+def query_endpoint(endpoint):
+    """Note endpoint that statements inside the with block are run for"""
+    token = _endpoint.set(endpoint)
+    try:
+        yield
+    finally:
+        _endpoint.reset(token)
+
+
+# Dialect the databases package compiles statements with
+DIALECT = pysqlite.dialect(paramstyle='qmark')
+
+
+def statement_sql(query, values):
+    """Get SQL text and parameters of a statement given as SQLAlchemy expression or text with named values"""
+    if isinstance(query, str):
+        return query, dict(values or {})
+    # Values are bound the same way the databases package binds them
+    if values:
+        query = query.values(**values)
+    compiled = query.compile(dialect=DIALECT)
+    return str(compiled), [compiled.params[name] for name in compiled.positiontup]
+
+
+def query_plan(sql, params):
+    """Get SQLite's EXPLAIN QUERY PLAN for statement, read on a separate blocking connection"""
+    conn = sqlite_connect()
+    try:
+        return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+    except sqlite3.Error as error:
+        return ['EXPLAIN QUERY PLAN failed: ' + str(error)]
+    finally:
+        conn.close()
+
+
+def loggable(value):
+    """Get parameter value that can be shown in the slow query log, without binary values such as password hashes"""
+    if isinstance(value, bytes):
+        return '<' + str(len(value)) + ' bytes>'
+    if isinstance(value, (str, int, float, type(None))):
+        return value
+    return str(value)
+
+
+async def _check_slow(seconds, query, values):
+    """Log statement with its parameters, endpoint and query plan if it took at least the slow query threshold"""
+    if not slow_query_log.is_slow(seconds):
+        return
+    sql, params = statement_sql(query, values)
+    if isinstance(params, dict):
+        logged_params = {name: loggable(value) for name, value in params.items()}
+    else:
+        logged_params = [loggable(value) for value in params]
+    # The plan is read in a worker thread so the event loop is not blocked by the separate connection
+    plan = await asyncio.get_event_loop().run_in_executor(None, query_plan, sql, params)
+    slow_query_log.record(seconds, sql, logged_params, _endpoint.get(), plan)
+
+
+@asynccontextmanager
+async def _timed_statement(query, values):
+    """Time statement run in the with block, logging it if it is slow"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        await _check_slow(time.perf_counter() - started, query, values)
+
+
+def _statement_span(kind):
+    """Trace statement as a span, a child of the span of the database function running it"""
+    return tracing.span('database.' + kind)
+
+
+def _record(counter, query=None):
+    """Increment counter of the active query stats and remember the statement"""
+    database_statements.inc(counter)
+    stats = _query_stats.get()
+    if stats is None:
+        return
+    setattr(stats, counter, getattr(stats, counter) + 1)
+    if query is not None:
+        stats.statements.append(str(query))
+
+
+class CountedTransaction(Transaction):
+    """Transaction that records a commit when the outermost transaction commits"""
+
+    async def commit(self):
+        is_root = len(self._connection._transaction_stack) == 1
+        await super().commit()
+        if is_root:
+            _record('commits')
+
+
+class InstrumentedDatabase(Database):
+    """Database that records its connects, queries, writes and commits in the active query stats"""
+
+    def __init__(self, url, **options):
+        super().__init__(url, **options)
+        # Number of callers currently between connect and disconnect
+        self._users = 0
+
+    async def connect(self, function=None):
+        # Concurrent requests share the connection pool, which closes when the last one disconnects
+        _record('connects')
+        # Every database function connects first, passing its name, so this counts calls per function
+        if function is not None:
+            database_calls.inc(function)
+        self._users += 1
+        if not self.is_connected:
+            await super().connect()
+
+    async def disconnect(self):
+        self._users -= 1
+        if self._users == 0 and self.is_connected:
+            await super().disconnect()
+
+    async def fetch_all(self, query, values=None):
+        _record('queries', query)
+        with _statement_span('query'):
+            async with _timed_statement(query, values):
+                return await super().fetch_all(query, values)
+
+    async def fetch_one(self, query, values=None):
+        _record('queries', query)
+        with _statement_span('query'):
+            async with _timed_statement(query, values):
+                return await super().fetch_one(query, values)
+
+    async def fetch_val(self, query, values=None, column=0):
+        _record('queries', query)
+        with _statement_span('query'):
+            async with _timed_statement(query, values):
+                return await super().fetch_val(query, values, column)
+
+    async def iterate(self, query, values=None):
+        _record('queries', query)
+        # Only time spent fetching counts towards the slow query threshold, not time the caller spends between rows
+        seconds = 0
+        started = time.perf_counter()
+        try:
+            # Traced as one span from the first fetch to the last, including time between rows
+            with _statement_span('iterate'):
+                async for record in super().iterate(query, values):
+                    seconds += time.perf_counter() - started
+                    yield record
+                    started = time.perf_counter()
+            seconds += time.perf_counter() - started
+        finally:
+            await _check_slow(seconds, query, values)
+
+    async def execute(self, query, values=None):
+        _record('writes', query)
+        # Statements outside of a transaction are committed immediately
+        if not self.connection()._transaction_stack:
+            _record('commits')
+        with _statement_span('write'):
+            async with _timed_statement(query, values):
+                return await super().execute(query, values)
+
+    async def execute_many(self, query, values):
+        for _ in values:
+            _record('writes', query)
+            if not self.connection()._transaction_stack:
+                _record('commits')
+        with _statement_span('write'):
+            async with _timed_statement(query, values[0] if values else None):
+                return await super().execute_many(query, values)
+
+    def transaction(self, *, force_rollback=False, **kwargs):
+        return CountedTransaction(self.connection, force_rollback, **kwargs)
+
+
+database = InstrumentedDatabase(DATABASE_URL, uri=True)
+
+
+def create_schema():
+    """Create missing tables in the current database, first opening the connection keeping an in-memory database alive"""
+    global memory_keeper
+    if db_name == 'memory' and memory_keeper is None:
+        memory_keeper = sqlite_connect()
+    metadata.create_all(sqlalchemy.create_engine('sqlite://', creator=sqlite_connect))
+
+
+# Columns added to tables after they were first created, with their SQLite types
+ADDED_COLUMNS = {
+    'transactions': (('reservation_serial_num', 'VARCHAR(36)'), ('resource', 'VARCHAR(50)'))
+}
+
+
+def migrate(conn):
+    """Add columns and indexes missing from databases created before they were introduced"""
+    for table_name, columns in ADDED_COLUMNS.items():
+        existing_columns = [row[1] for row in conn.execute('PRAGMA table_info(' + table_name + ')')]
+        for column_name, column_type in columns:
+            if column_name not in existing_columns:
+                conn.execute('ALTER TABLE ' + table_name + ' ADD COLUMN ' + column_name + ' ' + column_type)
+    for table in metadata.tables.values():
+        for index in table.indexes:
+            conn.execute('CREATE INDEX IF NOT EXISTS ' + index.name + ' ON ' + table.name + ' (' + ', '.join([column.name for column in index.columns]) + ')')
+    conn.commit()
+    # Backfill rollup tables created in a database that already has data
+    if not conn.execute('SELECT 1 FROM customer_daily LIMIT 1').fetchone():
+        rebuild_rollups(conn)
+
+
+ROLLUP_REBUILD_QUERIES = (
+    'INSERT INTO {rollup} (date, {key}, bookings, booking_amount) '
+    'SELECT date(date_time), {key}, count(*), sum(cost) FROM reservations GROUP BY 1, 2',
+    # Transactions from before they were linked to a resource are only in the customer rollup
+    'INSERT INTO {rollup} (date, {key}, charges, charge_amount, refunds, refund_amount) '
+    'SELECT date(date_time), {key}, sum(amount >= 0), sum(max(amount, 0)), sum(amount < 0), sum(min(amount, 0)) '
+    'FROM transactions WHERE {key} IS NOT NULL GROUP BY 1, 2 '
+    'ON CONFLICT (date, {key}) DO UPDATE SET charges = excluded.charges, charge_amount = excluded.charge_amount, '
+    'refunds = excluded.refunds, refund_amount = excluded.refund_amount'
 )
-metadata.create_all(engine)
 
 
+def rebuild_rollups(conn):
+    """Recompute daily rollup tables from all reservations and transactions"""
+    for rollup, key in ((resource_daily, 'resource'), (customer_daily, 'customer')):
+        conn.execute('DELETE FROM ' + rollup.name)
+        for query in ROLLUP_REBUILD_QUERIES:
+            conn.execute(query.format(rollup=rollup.name, key=key))
+    conn.commit()
+
+
+def run_migrations():
+    """Migrate the current database on a connection of its own"""
+    conn = sqlite_connect()
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
+
+
+# Version of each table, bumped after every write so unchanged data can be recognised without a query
+table_versions = {'users': 0, 'reservations': 0, 'transactions': 0, 'settings': 0}
+# Random for every process so versions from before a restart never match
+versions_epoch = uuid.uuid4().hex
+
+
+# Changes made inside atomic(), notified only once it commits (None outside)
+_deferred_changes = ContextVar('deferred_changes', default=None)
+
+
+def _defer(function, args):
+    """Queue change notification until the enclosing atomic block commits, returning False outside one"""
+    deferred = _deferred_changes.get()
+    if deferred is None:
+        return False
+    deferred.append((function, args))
+    return True
+
+
+def changes_deferred():
+    """Check if running inside an atomic block whose writes are not yet visible to other connections"""
+    return _deferred_changes.get() is not None
+
+
+@asynccontextmanager
+async def atomic():
+    """Run all statements in the async with block in one transaction, notifying changes only once it commits"""
+    if changes_deferred():
+        # Nested in another atomic block, which notifies changes once the outermost one commits
+        async with database.transaction():
+            yield
+        return
+    changes = []
+    token = _deferred_changes.set(changes)
+    await database.connect('atomic')
+    try:
+        async with database.transaction():
+            yield
+    finally:
+        _deferred_changes.reset(token)
+        await database.disconnect()
+    for function, args in changes:
+        function(*args)
+
+
+def table_changed(*table_names):
+    """Bump versions of tables that have just been written to"""
+    if _defer(table_changed, table_names):
+        return
+    for table_name in table_names:
+        table_versions[table_name] += 1
+
+
+# Functions called with table name, date/time and customer after a reservation or transaction is written
+change_listeners = []
+
+
+def row_changed(table_name, date_time=None, customer=None):
+    """Notify change listeners of a written row (date/time and customer None if unknown)"""
+    if _defer(row_changed, (table_name, date_time, customer)):
+        return
+    for listener in change_listeners:
+        listener(table_name, date_time, customer)
+
+
+def after_commit(function, *args):
+    """Call function now, or once the enclosing atomic block commits"""
+    if not _defer(function, args):
+        function(*args)
+
+
+# Functions called with setting name and value after a setting is written
+setting_listeners = []
+
+
+def setting_changed(setting, value):
+    """Notify setting listeners of a new setting value"""
+    if _defer(setting_changed, (setting, value)):
+        return
+    for listener in setting_listeners:
+        listener(setting, value)
+
+
+# Columns never copied into the change log
+PRIVATE_COLUMNS = ('password_hash', 'password_salt')
+CHANGE_LOG_QUERY = (
+    'INSERT INTO changes (date_time, table_name, operation, row_key, data) '
+    'SELECT :date_time, :table_name, :operation, {key}, json_object({values}) FROM {table} WHERE {key} = :key'
+)
+CHANGE_LOG_DELETE_QUERY = (
+    'INSERT INTO changes (date_time, table_name, operation, row_key, data) '
+    "VALUES (:date_time, :table_name, 'delete', :key, NULL)"
+)
+# Deletes changes before a cursor that a later change to the same row supersedes
+CHANGE_LOG_COMPACT_QUERY = (
+    'DELETE FROM changes WHERE id < :before AND EXISTS ('
+    'SELECT 1 FROM changes AS later WHERE later.table_name = changes.table_name AND later.row_key = changes.row_key AND later.id > changes.id)'
+)
+
+
+def change_log_values(table):
+    """Get json_object arguments for the public columns of table, with booleans as JSON true/false"""
+    values = []
+    for column in table.columns:
+        if column.name in PRIVATE_COLUMNS:
+            continue
+        value = column.name
+        if isinstance(column.type, sqlalchemy.Boolean):
+            value = "json(CASE " + column.name + " WHEN 1 THEN 'true' WHEN 0 THEN 'false' END)"
+        values.append("'" + column.name + "', " + value)
+    return ', '.join(values)
+
+
+async def log_change(table, operation, key):
+    """Append insert, update or delete of row of table with primary key key to the change log, in the transaction of the write"""
+    values = {'date_time': datetime.datetime.now(), 'table_name': table.name, 'key': key}
+    if operation == 'delete':
+        await database.execute(query=CHANGE_LOG_DELETE_QUERY, values=values)
+        return
+    # Copy the row as written in SQL so the write does not need to be read back first
+    key_column = table.primary_key.columns.values()[0].name
+    query = CHANGE_LOG_QUERY.format(key=key_column, values=change_log_values(table), table=table.name)
+    await database.execute(query=query, values=dict(values, operation=operation))
+
+
+@tracing.traced('api_sqlite.list_changes')
+async def list_changes(since, limit):
+    """List up to limit change log entries after cursor since, oldest first"""
+    await database.connect('list_changes')
+    query = changes.select().where(changes.c.id > since).order_by(changes.c.id).limit(limit)
+    rows = await database.fetch_all(query=query)
+    await database.disconnect()
+    return rows
+
+
+@tracing.traced('api_sqlite.last_change')
+async def last_change():
+    """Get cursor of the latest change log entry, 0 if there is none"""
+    await database.connect('last_change')
+    cursor = await database.fetch_val(query=sqlalchemy.select([sqlalchemy.func.max(changes.c.id)]))
+    await database.disconnect()
+    return cursor or 0
+
+
+@tracing.traced('api_sqlite.compact_changes')
+async def compact_changes(before):
+    """Remove change log entries before cursor before that are superseded by a later change to the same row, returning how many"""
+    await database.connect('compact_changes')
+    async with database.transaction():
+        await database.execute(query=CHANGE_LOG_COMPACT_QUERY, values={'before': before})
+        # Rows deleted by the last statement on this connection
+        removed = await database.fetch_val(query='SELECT changes()')
+    await database.disconnect()
+    return removed
+
+
+@tracing.traced('api_sqlite.get_idempotent_response')
+async def get_idempotent_response(key, expired_until):
+    """Get stored response for idempotency key unless it was stored up to expired_until"""
+    await database.connect('get_idempotent_response')
+    query = idempotency_keys.select().where(idempotency_keys.c.key == key).where(idempotency_keys.c.created > expired_until)
+    row = await database.fetch_one(query=query)
+    await database.disconnect()
+    return row
+
+
+@tracing.traced('api_sqlite.save_idempotent_response')
+async def save_idempotent_response(key, fingerprint, status_code, media_type, body, created, expired_until):
+    """Store response for idempotency key, removing keys stored up to expired_until"""
+    await database.connect('save_idempotent_response')
+    async with database.transaction():
+        query = idempotency_keys.delete().where(idempotency_keys.c.created <= expired_until)
+        await database.execute(query=query)
+        query = idempotency_keys.insert()
+        values = {
+            'key': key,
+            'fingerprint': fingerprint,
+            'status_code': status_code,
+            'media_type': media_type,
+            'body': body,
+            'created': created
+        }
+        await database.execute(query=query, values=values)
+    await database.disconnect()
+    return True
+
+
+def snapshot():
+    """Copy the current database into an in-memory snapshot using SQLite's backup API"""
+    snapshot_conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn = sqlite_connect()
+    conn.backup(snapshot_conn)
+    conn.close()
+    return snapshot_conn
+
+
+def restore(snapshot_conn):
+    """Replace the contents of the current database with a snapshot (or any other sqlite3 connection)"""
+    conn = sqlite_connect()
+    snapshot_conn.backup(conn)
+    conn.close()
+    table_changed(*table_versions)
+    row_changed('reservations')
+    row_changed('transactions')
+
+
+def hash_password(password, password_salt, operation):
+    """Hash password with salt, recording the time taken for operation"""
+    started = time.perf_counter()
+    # Hash password according to SHA-512
+    # https://stackoverflow.com/questions/9594125/salt-and-hash-a-password-in-python
+    with tracing.span('api_sqlite.hash_password', operation=operation):
+        password_hash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), password_salt, 100000)
+    password_hash_seconds.observe(time.perf_counter() - started, operation)
+    return password_hash
+
+
+@tracing.traced('api_sqlite.add_user')
 async def add_user(id, password, name, role):
     """Add new user with given id if not already existing"""
-    await database.connect()
+    await database.connect('add_user')
     query = users.select().where(users.c.id == id)
     row = await database.fetch_one(query=query)
     if not row:
-        # Hash password according to SHA-512
-        # https://stackoverflow.com/questions/9594125/salt-and-hash-a-password-in-python
         password_salt = uuid.uuid4().bytes
-        password_hash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), password_salt, 100000)
+        password_hash = hash_password(password, password_salt, 'add_user')
         query = users.insert()
         values = {'id': id,
                   'password_hash': password_hash,
@@ -77,7 +646,10 @@ async def add_user(id, password, name, role):
                   'activation': True,
                   'role': role
                   }
-        await database.execute(query=query, values=values)
+        async with database.transaction():
+            await database.execute(query=query, values=values)
+            await log_change(users, 'insert', id)
+        table_changed('users')
         await database.disconnect()
         return True
     else:
@@ -85,9 +657,10 @@ async def add_user(id, password, name, role):
         return False
 
 
+@tracing.traced('api_sqlite.user_valid')
 async def user_valid(id):
     """Check if given user ID is valid"""
-    await database.connect()
+    await database.connect('user_valid')
     query = users.select().where(users.c.id == id)
     row = await database.fetch_one(query=query)
     await database.disconnect()
@@ -97,84 +670,115 @@ async def user_valid(id):
         return False
 
 
+@tracing.traced('api_sqlite.password_valid')
 async def password_valid(id, password):
     """Check if password is valid for a given user ID"""
-    await database.connect()
+    await database.connect('password_valid')
     # Get hash of user's password
     query = users.select().where(users.c.id == id)
     row = await database.fetch_one(query=query)
     await database.disconnect()
     # Hash input password and compare
-    password_hash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), row.password_salt, 100000)
+    password_hash = hash_password(password, row.password_salt, 'password_valid')
     if password_hash == row.password_hash:
         return True
     else:
         return False
 
 
+@tracing.traced('api_sqlite.get_user')
 async def get_user(id):
     """Get user with a given ID"""
-    await database.connect()
+    await database.connect('get_user')
     query = users.select().where(users.c.id == id)
     row = await database.fetch_one(query=query)
     await database.disconnect()
     return row
 
 
+@tracing.traced('api_sqlite.list_users')
 async def list_users():
     """List all users"""
-    await database.connect()
+    await database.connect('list_users')
     query = users.select()
     rows = await database.fetch_all(query=query)
     await database.disconnect()
     return rows
 
 
+@tracing.traced('api_sqlite.iterate_users')
+async def iterate_users():
+    """Iterate over all users row by row with a database cursor"""
+    await database.connect('iterate_users')
+    try:
+        async for row in database.iterate(query=users.select()):
+            yield row
+    finally:
+        await database.disconnect()
+
+
+@tracing.traced('api_sqlite.remove_user')
 async def remove_user(id):
     """Remove user with given ID"""
-    await database.connect()
-    query = users.delete().where(users.c.id == id)
-    await database.execute(query=query)
+    await database.connect('remove_user')
+    async with database.transaction():
+        query = users.delete().where(users.c.id == id)
+        await database.execute(query=query)
+        await log_change(users, 'delete', id)
+    table_changed('users')
     await database.disconnect()
     return True
 
 
+@tracing.traced('api_sqlite.edit_user_name')
 async def edit_user_name(id, new_name):
     """Edit name of user with given ID"""
-    await database.connect()
-    query = users.update().where(users.c.id == id).values(name=new_name)
-    await database.execute(query=query)
+    await database.connect('edit_user_name')
+    async with database.transaction():
+        query = users.update().where(users.c.id == id).values(name=new_name)
+        await database.execute(query=query)
+        await log_change(users, 'update', id)
+    table_changed('users')
     await database.disconnect()
     return True
 
 
+@tracing.traced('api_sqlite.add_to_user_balance')
 async def add_to_user_balance(id, amount):
     """Add to account balance of user with given ID"""
-    await database.connect()
-    # Get current account balance
-    query = users.select().where(users.c.id == id)
-    row = await database.fetch_one(query=query)
-    # Calculate new account balance
-    new_balance = row.account_balance + amount
-    # Update account balance
-    query = users.update().where(users.c.id == id).values(account_balance=new_balance)
-    await database.execute(query=query)
+    await database.connect('add_to_user_balance')
+    async with database.transaction():
+        # Get current account balance
+        query = users.select().where(users.c.id == id)
+        row = await database.fetch_one(query=query)
+        # Calculate new account balance
+        new_balance = row.account_balance + amount
+        # Update account balance
+        query = users.update().where(users.c.id == id).values(account_balance=new_balance)
+        await database.execute(query=query)
+        await log_change(users, 'update', id)
+    table_changed('users')
     await database.disconnect()
     return True
 
 
+@tracing.traced('api_sqlite.edit_user_activation')
 async def edit_user_activation(id, activation):
     """Edit activation status of user with given ID"""
-    await database.connect()
-    query = users.update().where(users.c.id == id).values(activation=activation)
-    await database.execute(query=query)
+    await database.connect('edit_user_activation')
+    async with database.transaction():
+        query = users.update().where(users.c.id == id).values(activation=activation)
+        await database.execute(query=query)
+        await log_change(users, 'update', id)
+    table_changed('users')
     await database.disconnect()
     return True
 
 
+@tracing.traced('api_sqlite.user_activated')
 async def user_activated(id):
     """Check if user with given ID is activated"""
-    await database.connect()
+    await database.connect('user_activated')
     query = users.select().where(users.c.id == id)
     row = await database.fetch_one(query=query)
     await database.disconnect()
@@ -184,113 +788,316 @@ async def user_activated(id):
         return False
 
 
-async def list_reservations():
-    """List all reservations"""
-    await database.connect()
-    query = reservations.select()
+def within_date_range(query, table, start_date_time, end_date_time):
+    """Restrict query to rows of table from start_date_time up to (not including) end_date_time if given"""
+    if start_date_time is not None:
+        query = query.where(table.c.date_time >= start_date_time)
+    if end_date_time is not None:
+        query = query.where(table.c.date_time < end_date_time)
+    return query
+
+
+def period(column, granularity):
+    """Get SQL expression for the day (YYYY-MM-DD), week (date of its Monday) or month (YYYY-MM) of a date/time column"""
+    # Literals instead of bound parameters so the expression can be repeated in GROUP BY and ORDER BY
+    if granularity == 'day':
+        return sqlalchemy.func.strftime(sqlalchemy.literal_column("'%Y-%m-%d'"), column)
+    if granularity == 'week':
+        return sqlalchemy.func.date(column, sqlalchemy.literal_column("'weekday 0'"), sqlalchemy.literal_column("'-6 days'"))
+    return sqlalchemy.func.strftime(sqlalchemy.literal_column("'%Y-%m'"), column)
+
+
+@tracing.traced('api_sqlite.aggregate')
+async def aggregate(table, value_column, granularity, group_by=(), start_date_time=None, end_date_time=None):
+    """Count, sum and average value column of table per day, week or month and optionally per resource and/or customer"""
+    await database.connect('aggregate')
+    group_columns = [period(table.c.date_time, granularity).label('period')] + [table.c[column_name] for column_name in group_by]
+    value = table.c[value_column]
+    query = sqlalchemy.select(group_columns + [
+        sqlalchemy.func.count().label('count'),
+        sqlalchemy.func.sum(value).label('total'),
+        sqlalchemy.func.avg(value).label('average')
+    ])
+    query = within_date_range(query, table, start_date_time, end_date_time).group_by(*group_columns).order_by(*group_columns)
+    rows = await database.fetch_all(query=query)
+    await database.disconnect()
+    return rows
+
+
+@tracing.traced('api_sqlite.aggregate_rollup')
+async def aggregate_rollup(rollup, count_columns, amount_columns, granularity, group_by=(), start_date_time=None, end_date_time=None):
+    """Count, sum and average from daily rollup table per day, week or month and optionally per its key column"""
+    await database.connect('aggregate_rollup')
+    group_columns = [period(rollup.c.date, granularity).label('period')] + [rollup.c[column_name] for column_name in group_by]
+    count = functools.reduce(operator.add, [sqlalchemy.func.sum(rollup.c[column_name]) for column_name in count_columns])
+    total = functools.reduce(operator.add, [sqlalchemy.func.sum(rollup.c[column_name]) for column_name in amount_columns])
+    query = sqlalchemy.select(group_columns + [count.label('count'), total.label('total'), (total / count).label('average')])
+    if start_date_time is not None:
+        query = query.where(rollup.c.date >= start_date_time.date())
+    if end_date_time is not None:
+        query = query.where(rollup.c.date < end_date_time.date())
+    # Days where every reservation was cancelled stay in the rollup with zero counts
+    query = query.group_by(*group_columns).having(count != 0).order_by(*group_columns)
     rows = await database.fetch_all(query=query)
     await database.disconnect()
     return rows
 
 
-async def list_transactions():
-    """List all transactions"""
-    await database.connect()
-    query = transactions.select()
+@tracing.traced('api_sqlite.customer_statement')
+async def customer_statement(customer, start_date_time, end_date_time, limit, after_id=None):
+    """Get sums of customer's transaction amounts within and after a date/time range, and up to limit transactions in the range
+    ordered by date/time (following transaction after_id if given) with the cumulative amount from the start of the range"""
+    await database.connect('customer_statement')
+    query = sqlalchemy.select([
+        sqlalchemy.func.sum(sqlalchemy.case([(transactions.c.date_time < end_date_time, transactions.c.amount)], else_=0)).label('within'),
+        sqlalchemy.func.sum(sqlalchemy.case([(transactions.c.date_time >= end_date_time, transactions.c.amount)], else_=0)).label('after')
+    ]).where(transactions.c.customer == customer).where(transactions.c.date_time >= start_date_time)
+    totals = await database.fetch_one(query=query)
+    cumulative = sqlalchemy.func.sum(transactions.c.amount).over(order_by=[transactions.c.date_time, transactions.c.id])
+    ledger = sqlalchemy.select([transactions, cumulative.label('cumulative')]).where(transactions.c.customer == customer)
+    ledger = within_date_range(ledger, transactions, start_date_time, end_date_time).alias('ledger')
+    query = sqlalchemy.select([ledger]).order_by(ledger.c.date_time, ledger.c.id).limit(limit)
+    if after_id is not None:
+        after_date_time = sqlalchemy.select([transactions.c.date_time]).where(transactions.c.id == after_id).as_scalar()
+        query = query.where(sqlalchemy.tuple_(ledger.c.date_time, ledger.c.id) > sqlalchemy.tuple_(after_date_time, after_id))
+    rows = await database.fetch_all(query=query)
+    await database.disconnect()
+    return totals, rows
+
+
+@tracing.traced('api_sqlite.list_reservations')
+async def list_reservations(start_date_time=None, end_date_time=None):
+    """List all reservations, optionally within a date/time range"""
+    await database.connect('list_reservations')
+    query = within_date_range(reservations.select(), reservations, start_date_time, end_date_time)
+    rows = await database.fetch_all(query=query)
+    await database.disconnect()
+    return rows
+
+
+@tracing.traced('api_sqlite.iterate_reservations')
+async def iterate_reservations(start_date_time=None, end_date_time=None):
+    """Iterate over reservations row by row with a database cursor, optionally within a date/time range"""
+    await database.connect('iterate_reservations')
+    query = within_date_range(reservations.select(), reservations, start_date_time, end_date_time)
+    try:
+        async for row in database.iterate(query=query):
+            yield row
+    finally:
+        await database.disconnect()
+
+
+@tracing.traced('api_sqlite.list_transactions')
+async def list_transactions(start_date_time=None, end_date_time=None):
+    """List all transactions, optionally within a date/time range"""
+    await database.connect('list_transactions')
+    query = within_date_range(transactions.select(), transactions, start_date_time, end_date_time)
     rows = await database.fetch_all(query=query)
     await database.disconnect()
     return rows
 
 
-async def list_reservations_for_customer(customer):
-    """List all reservations for a particular customer"""
-    await database.connect()
+@tracing.traced('api_sqlite.iterate_transactions')
+async def iterate_transactions(start_date_time=None, end_date_time=None):
+    """Iterate over transactions row by row with a database cursor, optionally within a date/time range"""
+    await database.connect('iterate_transactions')
+    query = within_date_range(transactions.select(), transactions, start_date_time, end_date_time)
+    try:
+        async for row in database.iterate(query=query):
+            yield row
+    finally:
+        await database.disconnect()
+
+
+@tracing.traced('api_sqlite.list_reservations_for_customer')
+async def list_reservations_for_customer(customer, start_date_time=None, end_date_time=None):
+    """List all reservations for a particular customer, optionally within a date/time range"""
+    await database.connect('list_reservations_for_customer')
     query = reservations.select().where(reservations.c.customer == customer)
+    query = within_date_range(query, reservations, start_date_time, end_date_time)
     rows = await database.fetch_all(query=query)
     await database.disconnect()
     return rows
 
 
-async def list_transactions_for_customer(customer):
-    """List all transactions for a particular customer"""
-    await database.connect()
+@tracing.traced('api_sqlite.list_transactions_for_customer')
+async def list_transactions_for_customer(customer, start_date_time=None, end_date_time=None):
+    """List all transactions for a particular customer, optionally within a date/time range"""
+    await database.connect('list_transactions_for_customer')
     query = transactions.select().where(transactions.c.customer == customer)
+    query = within_date_range(query, transactions, start_date_time, end_date_time)
     rows = await database.fetch_all(query=query)
     await database.disconnect()
     return rows
 
 
+@tracing.traced('api_sqlite.get_reservation_with_serial_number')
 async def get_reservation_with_serial_number(serial_num):
     """Get transaction with a particular serial number if it exists"""
-    await database.connect()
+    await database.connect('get_reservation_with_serial_number')
     query = reservations.select().where(reservations.c.serial_num == serial_num)
     row = await database.fetch_one(query=query)
     await database.disconnect()
     return row
 
 
+ROLLUP_UPSERT_QUERY = (
+    'INSERT INTO {rollup} (date, {key}, {count}, {amount}) VALUES (:date, :key, :count, :amount) '
+    'ON CONFLICT (date, {key}) DO UPDATE SET {count} = {count} + excluded.{count}, {amount} = {amount} + excluded.{amount}'
+)
+
+
+async def roll_up(date_time, resource, customer, count_column, amount_column, count, amount):
+    """Add count and amount of bookings, charges or refunds on the day of date_time to the rollups of resource and customer"""
+    for rollup, key_column, key in ((resource_daily, 'resource', resource), (customer_daily, 'customer', customer)):
+        if key is None:
+            continue
+        query = ROLLUP_UPSERT_QUERY.format(rollup=rollup.name, key=key_column, count=count_column, amount=amount_column)
+        await database.execute(query=query, values={'date': date_time.date(), 'key': key, 'count': count, 'amount': amount})
+
+
+async def roll_up_transaction(date_time, resource, customer, amount):
+    """Add transaction to the charges, or the refunds if amount is negative, in the rollups"""
+    if amount < 0:
+        await roll_up(date_time, resource, customer, 'refunds', 'refund_amount', 1, amount)
+    else:
+        await roll_up(date_time, resource, customer, 'charges', 'charge_amount', 1, amount)
+
+
+@tracing.traced('api_sqlite.add_reservation')
 async def add_reservation(reservation_uuid, date_time, resource, customer, reserver, total_cost):
     """Add new reservation with given values"""
-    await database.connect()
-    query = reservations.insert()
-    values = {
-        'serial_num': reservation_uuid,
-        'date_time': date_time,
-        'resource': resource,
-        'customer': customer,
-        'reserver': reserver,
-        'cost': total_cost
-    }
-    await database.execute(query=query, values=values)
+    await database.connect('add_reservation')
+    async with database.transaction():
+        query = reservations.insert()
+        values = {
+            'serial_num': reservation_uuid,
+            'date_time': date_time,
+            'resource': resource,
+            'customer': customer,
+            'reserver': reserver,
+            'cost': total_cost
+        }
+        await database.execute(query=query, values=values)
+        await roll_up(date_time, resource, customer, 'bookings', 'booking_amount', 1, total_cost)
+        await log_change(reservations, 'insert', reservation_uuid)
+    table_changed('reservations')
+    row_changed('reservations', date_time, customer)
     await database.disconnect()
     return True
 
 
-async def add_transaction(transaction_uuid, date_time, customer, amount):
-    """Add new transaction with given values"""
-    await database.connect()
-    query = transactions.insert()
-    values = {
-        'id': transaction_uuid,
-        'date_time': date_time,
-        'customer': customer,
-        'amount': amount
-    }
-    await database.execute(query=query, values=values)
+@tracing.traced('api_sqlite.add_transaction')
+async def add_transaction(transaction_uuid, date_time, customer, amount, reservation_serial_num=None, resource=None):
+    """Add new transaction with given values, linked to the reservation it pays for or refunds if any"""
+    await database.connect('add_transaction')
+    async with database.transaction():
+        query = transactions.insert()
+        values = {
+            'id': transaction_uuid,
+            'date_time': date_time,
+            'customer': customer,
+            'amount': amount,
+            'reservation_serial_num': reservation_serial_num,
+            'resource': resource
+        }
+        await database.execute(query=query, values=values)
+        await roll_up_transaction(date_time, resource, customer, amount)
+        await log_change(transactions, 'insert', transaction_uuid)
+    table_changed('transactions')
+    row_changed('transactions', date_time, customer)
     await database.disconnect()
     return True
 
 
+@tracing.traced('api_sqlite.add_paid_reservation')
+async def add_paid_reservation(reservation_uuid, date_time, resource, customer, reserver, total_cost, transaction_uuid, transaction_date_time):
+    """Add new reservation, its transaction and the deduction from the customer's balance in a single commit"""
+    await database.connect('add_paid_reservation')
+    async with database.transaction():
+        query = reservations.insert()
+        values = {
+            'serial_num': reservation_uuid,
+            'date_time': date_time,
+            'resource': resource,
+            'customer': customer,
+            'reserver': reserver,
+            'cost': total_cost
+        }
+        await database.execute(query=query, values=values)
+        query = transactions.insert()
+        values = {
+            'id': transaction_uuid,
+            'date_time': transaction_date_time,
+            'customer': customer,
+            'amount': total_cost,
+            'reservation_serial_num': reservation_uuid,
+            'resource': resource
+        }
+        await database.execute(query=query, values=values)
+        await roll_up(date_time, resource, customer, 'bookings', 'booking_amount', 1, total_cost)
+        await roll_up_transaction(transaction_date_time, resource, customer, total_cost)
+        # Deduct cost in SQL so the balance does not need to be read first
+        query = users.update().where(users.c.id == customer).values(account_balance=users.c.account_balance - total_cost)
+        await database.execute(query=query)
+        await log_change(reservations, 'insert', reservation_uuid)
+        await log_change(transactions, 'insert', transaction_uuid)
+        await log_change(users, 'update', customer)
+    table_changed('reservations', 'transactions', 'users')
+    row_changed('reservations', date_time, customer)
+    row_changed('transactions', transaction_date_time, customer)
+    await database.disconnect()
+    return True
+
+
+@tracing.traced('api_sqlite.remove_reservation')
 async def remove_reservation(serial_num):
     """Remove reservation with given serial number"""
-    await database.connect()
-    query = reservations.delete().where(reservations.c.serial_num == serial_num)
-    await database.execute(query=query)
+    await database.connect('remove_reservation')
+    async with database.transaction():
+        # Read reservation so that rollups and change listeners know what it affected
+        query = sqlalchemy.select([reservations.c.date_time, reservations.c.resource, reservations.c.customer, reservations.c.cost]).where(reservations.c.serial_num == serial_num)
+        row = await database.fetch_one(query=query)
+        query = reservations.delete().where(reservations.c.serial_num == serial_num)
+        await database.execute(query=query)
+        if row:
+            await roll_up(row.date_time, row.resource, row.customer, 'bookings', 'booking_amount', -1, - row.cost)
+            await log_change(reservations, 'delete', serial_num)
+    table_changed('reservations')
+    if row:
+        row_changed('reservations', row.date_time, row.customer)
     await database.disconnect()
     return True
 
 
+@tracing.traced('api_sqlite.get_settings_value')
 async def get_settings_value(setting):
     """Returns current value of setting (client_logins_allowed/client_adding_funds_allowed)"""
-    await database.connect()
+    await database.connect('get_settings_value')
     query = settings.select().where(settings.c.setting == setting)
     row = await database.fetch_one(query=query)
     await database.disconnect()
     return row.value
 
 
+@tracing.traced('api_sqlite.set_settings_value')
 async def set_settings_value(setting, value):
     """Sets value of setting (client_logins_allowed/client_adding_funds_allowed)"""
-    await database.connect()
-    query = settings.update().where(settings.c.setting == setting).values(value=value)
-    await database.execute(query=query)
+    await database.connect('set_settings_value')
+    async with database.transaction():
+        query = settings.update().where(settings.c.setting == setting).values(value=value)
+        await database.execute(query=query)
+        await log_change(settings, 'update', setting)
+    table_changed('settings')
+    setting_changed(setting, value)
     await database.disconnect()
     return True
 
 
+@tracing.traced('api_sqlite.setting_name_valid')
 async def setting_name_valid(setting):
     """Check if given setting name is valid"""
-    await database.connect()
+    await database.connect('setting_name_valid')
     query = settings.select().where(settings.c.setting == setting)
     row = await database.fetch_one(query=query)
     await database.disconnect()
@@ -300,9 +1107,10 @@ async def setting_name_valid(setting):
         return False
 
 
+@tracing.traced('api_sqlite.list_holds')
 async def list_holds():
     """List holds made for other facilities"""
-    await database.connect()
+    await database.connect('list_holds')
     # Get list of remote facility manager IDs from users table
     query = users.select().where(users.c.role == 'remote facility manager')
     rows = await database.fetch_all(query=query)
@@ -3,6 +3,7 @@ import json
 import datetime
 import uuid
 import hashlib
+import api_sqlite
 
 """Contains functions for pre-loading and clearing test data from test database"""
 
@@ -10,8 +11,9 @@ conn = sqlite3.connect('test_database.db')
 curs = conn.cursor()
 
 
-def add_test_data():
-    """Add pre-loaded test data to test database"""
+def add_test_data(conn=conn):
+    """Add pre-loaded test data to test database (or the database of another connection)"""
+    curs = conn.cursor()
     # Add pre-loaded users
     with open('preloaded_test_data/test_users.json') as users_file:
         users_data = json.load(users_file)
@@ -29,21 +31,25 @@ def add_test_data():
     with open('preloaded_test_data/test_transactions.json') as transactions_file:
         transactions_data = json.load(transactions_file)
     for id, transaction in transactions_data.items():
-        curs.execute('INSERT INTO transactions VALUES (?, ?, ?, ?)', (id, datetime.datetime.strptime(transaction['date'], '%m-%d-%Y %H:%M'), transaction['customer'], float(transaction['amount'])))
+        curs.execute('INSERT INTO transactions (id, date_time, customer, amount) VALUES (?, ?, ?, ?)', (id, datetime.datetime.strptime(transaction['date'], '%m-%d-%Y %H:%M'), transaction['customer'], float(transaction['amount'])))
     # Add pre-loaded settings
     with open('preloaded_test_data/test_settings.json') as settings_file:
         settings_data = json.load(settings_file)
     for setting, value in settings_data.items():
         curs.execute('INSERT INTO settings VALUES (?, ?)', (setting, eval(value)))
     conn.commit()
+    api_sqlite.rebuild_rollups(conn)
 
 
-def clear_test_data():
-    """Clear all test data from test database"""
+def clear_test_data(conn=conn):
+    """Clear all test data from test database (or the database of another connection)"""
+    curs = conn.cursor()
     curs.execute('DELETE FROM users')
     curs.execute('DELETE FROM reservations')
     curs.execute('DELETE FROM transactions')
     curs.execute('DELETE FROM settings')
+    curs.execute('DELETE FROM resource_daily')
+    curs.execute('DELETE FROM customer_daily')
     conn.commit()
 
 
@@ -0,0 +1,129 @@
+from collections import Counter
+import datetime
+import time
+
+"""Contains consistency audit of the scheduler's in-memory claims against stored reservations"""
+
+# Stored reservations read per statement, each statement releasing its read lock so writers are not blocked for the whole audit
+AUDIT_CHUNK_ROWS = 50000
+# Machines allowed to run along with the harvester
+MAX_MACHINES_WITH_HARVESTER = 3
+IRRADIATOR_COOLDOWN = datetime.timedelta(minutes=60)
+CRUSHER_RECALIBRATION = datetime.timedelta(hours=6)
+# Stored date/times are compared by their first 16 characters (YYYY-MM-DD HH:MM), slots starting at :00 or :30
+SLOT_LENGTH = 16
+
+
+def slot_key(date_time):
+    """Get slot of a date/time as stored in the database, without seconds"""
+    return str(date_time)[:SLOT_LENGTH]
+
+
+def snapshot_claims(resources, since=None):
+    """Copy unit ID, resource name, slot and customer of every in-memory claim at or after since"""
+    claims = []
+    for resource in resources:
+        for date_time, customer in list(resource.reservations.items()):
+            if since is None or date_time >= since:
+                claims.append((resource.id, resource.name, slot_key(date_time), customer))
+    return claims
+
+
+class Findings:
+    """Count of one kind of finding with the first max_examples examples"""
+
+    def __init__(self, max_examples):
+        self.max_examples = max_examples
+        self.count = 0
+        self.examples = []
+
+    def add(self, example):
+        """Count finding, keeping it as an example if there is room"""
+        self.count += 1
+        if len(self.examples) < self.max_examples:
+            self.examples.append(example)
+
+    def to_dict(self):
+        """Get count and examples as a JSON-serializable dictionary"""
+        return {'count': self.count, 'examples': self.examples}
+
+
+def audit(conn, resources, claims, since=None, max_examples=100, chunk_rows=AUDIT_CHUNK_ROWS):
+    """Compare claims (from snapshot_claims) with reservations stored at or after since, reading them in chunks, and check stored slots against the scheduler's rules"""
+    started = time.perf_counter()
+    units = Counter(resource.name for resource in resources)
+    unclaimed = Counter((name, slot, customer) for unit, name, slot, customer in claims)
+    missing_claims = Findings(max_examples)
+    # Stored reservations per slot and resource type, for rules spanning units
+    booked = Counter()
+    num_rows = 0
+    last_rowid = -1
+    where = ' AND date_time >= ?' if since is not None else ''
+    while True:
+        params = (last_rowid, slot_key(since), chunk_rows) if since is not None else (last_rowid, chunk_rows)
+        rows = conn.execute('SELECT rowid, serial_num, date_time, resource, customer FROM reservations WHERE rowid > ?' + where + ' ORDER BY rowid LIMIT ?', params).fetchall()
+        if not rows:
+            break
+        num_rows += len(rows)
+        last_rowid = rows[-1][0]
+        for rowid, serial_num, date_time, resource_name, customer in rows:
+            slot = date_time[:SLOT_LENGTH]
+            booked[slot, resource_name] += 1
+            key = resource_name, slot, customer
+            if unclaimed[key] > 0:
+                unclaimed[key] -= 1
+            else:
+                missing_claims.add({'serial_num': serial_num, 'resource': resource_name, 'date': slot, 'customer': customer})
+    phantom_claims = Findings(max_examples)
+    for unit, name, slot, customer in claims:
+        if unclaimed[name, slot, customer] > 0:
+            unclaimed[name, slot, customer] -= 1
+            phantom_claims.add({'unit': unit, 'resource': name, 'date': slot, 'customer': customer})
+    violations = Findings(max_examples)
+    for example in rule_violations(booked, units, claims):
+        violations.add(example)
+    held_slots = Counter(unit for unit, name, slot, customer in claims)
+    return {
+        'consistent': missing_claims.count == phantom_claims.count == violations.count == 0,
+        'rows': num_rows,
+        'claims': len(claims),
+        'seconds': round(time.perf_counter() - started, 3),
+        'missing_claims': missing_claims.to_dict(),
+        'phantom_claims': phantom_claims.to_dict(),
+        'violations': violations.to_dict(),
+        'held_slots': [{'unit': resource.id, 'resource': resource.name, 'held_slots': held_slots[resource.id]} for resource in resources]
+    }
+
+
+def rule_violations(booked, units, claims):
+    """Yield slots of stored reservations breaking unit counts or the irradiator, harvester and crusher rules, and claimed irradiator units still cooling down"""
+    slots = {}
+    for (slot, name), count in booked.items():
+        slots.setdefault(slot, {})[name] = count
+    crusher_slots = []
+    for slot, counts in sorted(slots.items()):
+        for name, count in counts.items():
+            if count > units.get(name, 0):
+                yield {'rule': 'Units exceeded', 'date': slot, 'resource': name, 'count': count}
+        if counts.get('irradiator', 0) > 1:
+            yield {'rule': 'Irradiators at same time', 'date': slot, 'resource': 'irradiator', 'count': counts['irradiator']}
+        machines = sum(count for name, count in counts.items() if name not in ('workshop', '1.21 gigawatt lightning harvester'))
+        if counts.get('1.21 gigawatt lightning harvester') and machines > MAX_MACHINES_WITH_HARVESTER:
+            yield {'rule': 'Too many machines with harvester', 'date': slot, 'resource': '1.21 gigawatt lightning harvester', 'count': machines}
+        if counts.get('high velocity crusher'):
+            crusher_slots.append(slot)
+    previous = None
+    for slot in crusher_slots:
+        date_time = datetime.datetime.strptime(slot, '%Y-%m-%d %H:%M')
+        if previous is not None and date_time - previous <= CRUSHER_RECALIBRATION:
+            yield {'rule': 'Crusher recalibrating', 'date': slot, 'resource': 'high velocity crusher', 'count': 1}
+        previous = date_time
+    irradiator_slots = {}
+    for unit, name, slot, customer in claims:
+        if name == 'irradiator':
+            irradiator_slots.setdefault(unit, []).append(datetime.datetime.strptime(slot, '%Y-%m-%d %H:%M'))
+    for unit, date_times in sorted(irradiator_slots.items()):
+        date_times.sort()
+        for previous, date_time in zip(date_times, date_times[1:]):
+            if date_time - previous <= IRRADIATOR_COOLDOWN:
+                yield {'rule': 'Irradiator cooling down', 'date': slot_key(date_time), 'resource': 'irradiator', 'unit': unit}
@@ -0,0 +1,28 @@
+import argparse
+import json
+import os
+import sys
+import requests
+
+"""Contains command for auditing a running server's scheduler against its database, such as after a deploy"""
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare a running server's in-memory claims with its stored reservations and check the scheduler's rules")
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='Server URL (default: http://127.0.0.1:8000)')
+    parser.add_argument('--since', help='Audit reservations from this date (MM-DD-YYYY, default: those the server claims on startup)')
+    parser.add_argument('--examples', type=int, default=100, help='Maximum examples of each kind of finding (default: 100)')
+    args = parser.parse_args()
+    headers = {'Authorization': 'Bearer ' + os.environ['ADMIN_TOKEN']} if os.getenv('ADMIN_TOKEN') else {}
+    params = {'examples': args.examples}
+    if args.since:
+        params['since'] = args.since
+    response = requests.get(args.url + '/admin/audit', params=params, headers=headers)
+    response.raise_for_status()
+    report = response.json()
+    print(json.dumps(report, indent=2))
+    # Exit status 1 if anything is inconsistent, 2 if the audit should be repeated because reservations changed while it ran
+    if not report['consistent']:
+        sys.exit(1)
+    if report['concurrent_writes']:
+        sys.exit(2)
@@ -0,0 +1,5 @@
+import os
+
+# Tests use the in-memory database unless DB_NAME is set, so they never write to a database file in the repository
+# It has to be set before api_sqlite is imported
+os.environ.setdefault('DB_NAME', 'memory')
@@ -1,5 +1,5 @@
 import os
-import requests, json, tabulate, csv, random, getpass
+import requests, json, tabulate, csv, random, getpass, threading, time
 
 LOCALHOST = "http://127.0.0.1:8000"
 REMOTE_HOST = "http://linux1.cs.uchicago.edu:51221"
@@ -138,6 +138,8 @@ class Console():
         self.resources = ["workshop", "mini microvac", "irradiator",
                           "polymer extruder", "high velocity crusher",
                           "1.21 gigawatt lightning harvester"]
+        # Current settings pushed by the server (empty while not connected to the event stream)
+        self.settings = {}
 
     ### *** HELPER FUNCTIONS *** ###
     # Helper function to reset user
@@ -574,6 +576,23 @@ class Console():
             print_error(response)
 
 
+    # Function for keeping settings up to date from the server's event stream
+    # Runs in a background thread and reconnects if the stream is interrupted
+    def watch_settings(self):
+        while True:
+            try:
+                with requests.get(f"{HOST}/events", params={"types": "setting"}, stream=True, timeout=(5, 60)) as response:
+                    for line in response.iter_lines(decode_unicode=True):
+                        if line.startswith("data: "):
+                            data = json.loads(line[len("data: "):])
+                            self.settings[data["setting"]] = data["value"]
+            except Exception:
+                pass
+            # Fall back to asking the server until the stream is back
+            self.settings = {}
+            time.sleep(5)
+
+
     # Function for checking if client logins are allowed
     # *** Facility manager restricted ***
     # -- Permissions check not done because clients need this function to see if
@@ -581,6 +600,9 @@ class Console():
     def client_logins_allowed(self):
         # Check user's permissions
         setting = "client_logins_allowed"
+        # Use value pushed by the server if connected to the event stream
+        if setting in self.settings:
+            return self.settings[setting]
         try:
             response = requests.get(f"{HOST}/settings/{setting}")
             if response.json().get("detail") is None:
@@ -824,6 +846,8 @@ class Console():
         print("Our facility is located in Chicago, USA (CST/CDT). Business hours are:")
         print("Mon-Fri 09:00-18:00")
         print("Sat 10:00-16:00")
+        # Receive setting changes in the background instead of asking the server on every command
+        threading.Thread(target=self.watch_settings, daemon=True).start()
         # Verify the user's identity. If the user is new, create a username.
         self.user_login()
         # Run command line for console
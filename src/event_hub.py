@@ -0,0 +1,79 @@
+import asyncio
+import json
+
+"""Contains fan-out of live events to Server-Sent Events subscribers"""
+
+
+def format_event(event_type, data):
+    """Encode event as a Server-Sent Events message"""
+    return ('event: ' + event_type + '\ndata: ' + json.dumps(data, separators=(',', ':')) + '\n\n').encode('utf-8')
+
+
+class Subscription:
+    """Queue of encoded messages for one subscriber, optionally limited to some event types"""
+
+    def __init__(self, event_types, max_queued):
+        self.event_types = event_types
+        self.queue = asyncio.Queue(max_queued)
+
+
+class EventHub:
+    """Publishes each event to every matching subscriber, dropping subscribers that fall too far behind"""
+
+    def __init__(self, max_queued=100):
+        self.max_queued = max_queued
+        self.subscriptions = set()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, event_types=None):
+        """Start queueing events of the given types (all if None) for a new subscriber"""
+        subscription = Subscription(event_types, self.max_queued)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop queueing events for subscriber"""
+        self.subscriptions.discard(subscription)
+
+    def publish(self, event_type, data):
+        """Queue event for every subscriber of its type, encoding it once for all of them"""
+        message = format_event(event_type, data)
+        self.published += 1
+        for subscription in list(self.subscriptions):
+            if subscription.event_types is not None and event_type not in subscription.event_types:
+                continue
+            try:
+                subscription.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Replace backlog with end of stream so a slow subscriber reconnects instead of holding memory
+                self.unsubscribe(subscription)
+                self.dropped += 1
+                while not subscription.queue.empty():
+                    subscription.queue.get_nowait()
+                subscription.queue.put_nowait(None)
+
+    async def stream(self, subscription, initial_messages=(), keepalive_seconds=15):
+        """Yield initial messages and then subscriber's messages until it is dropped, with comments to keep idle connections open"""
+        try:
+            for message in initial_messages:
+                yield message
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.queue.get(), keepalive_seconds)
+                except asyncio.TimeoutError:
+                    yield b': keepalive\n\n'
+                    continue
+                if message is None:
+                    break
+                yield message
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self):
+        """Get number of subscribers, events published and subscribers dropped for falling behind"""
+        return {
+            'subscribers': len(self.subscriptions),
+            'published': self.published,
+            'dropped': self.dropped
+        }
@@ -1,35 +1,114 @@
 import datetime
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
 from models.resource import Resource
+import metrics
+import tracing
 
 """Contains resources and functions for business logic"""
 
-# Facility resource list
+# Facility resource list, filled by load_resources on startup
 resources = []
-num_resources = 0
-for i in range(15):
-    resources.append(Resource('workshop', num_resources, 99 / 2))
-    num_resources += 1
-for i in range(2):
-    resources.append(Resource('mini microvac', num_resources, 2000 / 2))
-    num_resources += 1
-    resources.append(Resource('irradiator', num_resources, 2200 / 2))
-    num_resources += 1
-    resources.append(Resource('polymer extruder', num_resources, 500 / 2))
-    num_resources += 1
-resources.append(Resource('high velocity crusher', num_resources, 10000))
-num_resources += 1
-resources.append(Resource('1.21 gigawatt lightning harvester', num_resources, 8800 / 2))
-num_resources += 1
+# Claims from this long before now still affect whether a reservation is valid (the crusher's recalibration window)
+CLAIM_LOOKBACK = datetime.timedelta(hours=6)
 
 
+def load_resources():
+    """Fill resource list with every unit of the facility, numbered in order"""
+    resources.clear()
+    for i in range(15):
+        resources.append(Resource('workshop', len(resources), 99 / 2))
+    for i in range(2):
+        resources.append(Resource('mini microvac', len(resources), 2000 / 2))
+        resources.append(Resource('irradiator', len(resources), 2200 / 2))
+        resources.append(Resource('polymer extruder', len(resources), 500 / 2))
+    resources.append(Resource('high velocity crusher', len(resources), 10000))
+    resources.append(Resource('1.21 gigawatt lightning harvester', len(resources), 8800 / 2))
+
+
+# Opening and closing hour on each weekday (Monday is 0), closed on Sunday
+WORKING_HOURS = {0: (9, 17), 1: (9, 17), 2: (9, 17), 3: (9, 17), 4: (9, 17), 5: (10, 16)}
+
+reservation_rejections = metrics.Counter('reservation_rejections_total', 'Reservations rejected by the scheduler by reason', ('reason',))
+# Functions called with 'claim' or 'release', resource, date/time and customer when a slot is claimed or freed
+claim_listeners = []
+# Claims made while claim tracking is active (None when it is not)
+_claims_made = ContextVar('claims_made', default=None)
+
+
+@contextmanager
+def track_claims():
+    """Record resource slots claimed inside the with block so they can be released if the work is rolled back"""
+    claims = []
+    token = _claims_made.set(claims)
+    try:
+        yield claims
+    finally:
+        _claims_made.reset(token)
+
+
+def claim(resource, date_time, customer):
+    """Mark resource as reserved by customer at date_time"""
+    resource.reservations[date_time] = customer
+    claims = _claims_made.get()
+    if claims is not None:
+        claims.append((resource, date_time))
+    for listener in claim_listeners:
+        listener('claim', resource, date_time, customer)
+
+
+def restore_claims(rows):
+    """Claim the first free unit of the resource of each stored reservation in date order, as the scheduler assigns them, returning the number claimed"""
+    num_claimed = 0
+    for row in sorted(rows, key=lambda row: row.date_time):
+        for resource in resources:
+            if resource.name == row.resource and row.date_time not in resource.reservations:
+                claim(resource, row.date_time, row.customer)
+                num_claimed += 1
+                break
+    return num_claimed
+
+
+def release(resource, date_time):
+    """Mark resource as free at date_time"""
+    customer = resource.reservations.pop(date_time, None)
+    if customer is not None:
+        for listener in claim_listeners:
+            listener('release', resource, date_time, customer)
+
+
+def release_claims(claims):
+    """Free resource slots claimed by work that was rolled back"""
+    for resource, date_time in claims:
+        release(resource, date_time)
+
+
+def release_reservation(resource_name, date_time, customer):
+    """Free the unit of a resource type claimed by customer at date_time for a cancelled or moved reservation"""
+    for resource in resources:
+        if resource.name == resource_name and resource.reservations.get(date_time) == customer:
+            release(resource, date_time)
+            return True
+    return False
+
+
+@tracing.traced('facility.reservation_valid')
 def reservation_valid(resource_name, customer, date_time):
-    """Check if reservation is valid according to date, time and resource constraints"""
+    """Check if reservation is valid according to date, time and resource constraints, counting rejections by reason"""
+    valid, validity_message, hold_request_possible = check_reservation(resource_name, customer, date_time)
+    if not valid:
+        reservation_rejections.inc(validity_message)
+    return valid, validity_message, hold_request_possible
+
+
+def check_reservation(resource_name, customer, date_time):
+    """Check reservation against date, time and resource constraints, claiming the resource if it is valid"""
     # Time ending with :00 or :30
     if not date_time.minute in (0, 30):
         return False, 'Time not :00 or :30', False
     # Within working hours
-    if not ((date_time.weekday() in range(5) and date_time.hour in range(9, 17)) or (
-                date_time.weekday() == 5 and date_time.hour in range(10, 16))):
+    if not within_working_hours(date_time):
         return False, 'Time outside working hours', True
     # Within 30 days from now
     if not date_time > datetime.datetime.now() > date_time - datetime.timedelta(days=30):
@@ -68,7 +147,7 @@ def reservation_valid(resource_name, customer, date_time):
                     if invalid_date_time in resource.reservations:
                         time_valid = False
                 if time_valid:
-                    resource.reservations[date_time] = customer
+                    claim(resource, date_time, customer)
                     return True, 'Reservation successful', False
                 else:
                     return False, 'Time invalid for irradiator', True
@@ -77,7 +156,7 @@ def reservation_valid(resource_name, customer, date_time):
                 if num_machines > 3:
                     break
                 else:
-                    resource.reservations[date_time] = customer
+                    claim(resource, date_time, customer)
                     return True, 'Reservation successful', False
             # Check if high velocity crusher is recalibrating
             elif resource_name == 'high velocity crusher':
@@ -86,13 +165,13 @@ def reservation_valid(resource_name, customer, date_time):
                     if date_time + datetime.timedelta(minutes=minutes) in resource.reservations:
                         time_valid = False
                 if time_valid:
-                    resource.reservations[date_time] = customer
+                    claim(resource, date_time, customer)
                     return True, 'Reservation successful', False
                 else:
                     return False, 'Time invalid for crusher', True
             # Reservation valid if all constraints fulfilled
             elif date_time not in resource.reservations:
-                resource.reservations[date_time] = customer
+                claim(resource, date_time, customer)
                 return True, 'Reservation successful', False
     if resource_name_valid:
         return False, 'Resource unavailable', True
@@ -100,6 +179,7 @@ def reservation_valid(resource_name, customer, date_time):
         return False, 'Resource name invalid', False
 
 
+@tracing.traced('facility.reservation_limit_exceeded')
 def reservation_limit_exceeded(rows, reservation, date_time):
     """Check if customer has exceeded concurrent and weekly reservation limits"""
     num_days_reserved_in_week = 0
@@ -125,6 +205,74 @@ def reservation_limit_exceeded(rows, reservation, date_time):
         return True
 
 
+def reservation_limit_window(date_time):
+    """Get start and end of the week checked by reservation_limit_exceeded for a reservation at date_time"""
+    return date_time - datetime.timedelta(days=date_time.weekday()), date_time + datetime.timedelta(days=6 - date_time.weekday())
+
+
+def within_working_hours(date_time):
+    """Check if a 30-minute slot starting at date_time is within working hours"""
+    opening_hour, closing_hour = WORKING_HOURS.get(date_time.weekday(), (0, 0))
+    return opening_hour <= date_time.hour < closing_hour
+
+
+def working_slots(date):
+    """Get number of 30-minute slots the facility is open on date"""
+    opening_hour, closing_hour = WORKING_HOURS.get(date.weekday(), (0, 0))
+    return 2 * (closing_hour - opening_hour)
+
+
+def period_start(date, granularity):
+    """Get first day of the day or week (starting Monday) containing date"""
+    if granularity == 'week':
+        return date - datetime.timedelta(days=date.weekday())
+    return date
+
+
+def utilization(rows, start_date, end_date, granularity='day'):
+    """Get booked and available 30-minute slots per resource type and per unit for each day or week from start_date up to (not including) end_date"""
+    # Open slots of a single unit in each period, counted per day rather than per slot
+    available_slots = {}
+    date = start_date
+    while date < end_date:
+        period = period_start(date, granularity)
+        available_slots[period] = available_slots.get(period, 0) + working_slots(date)
+        date += datetime.timedelta(days=1)
+    units = Counter([resource.name for resource in resources])
+    booked_types = Counter()
+    unassigned = Counter()
+    for row in rows:
+        booked_types[period_start(row.date_time.date(), granularity), row.resource] += 1
+        unassigned[row.resource, row.date_time, row.customer] += 1
+    # Units are only known from claims, which are counted only while a matching reservation exists
+    booked_units = Counter()
+    for resource in resources:
+        for date_time, customer in resource.reservations.items():
+            if start_date <= date_time.date() < end_date and unassigned[resource.name, date_time, customer] > 0:
+                unassigned[resource.name, date_time, customer] -= 1
+                booked_units[period_start(date_time.date(), granularity), resource.id] += 1
+    type_rows = []
+    unit_rows = []
+    for period, slots in sorted(available_slots.items()):
+        for name, num_units in units.items():
+            type_rows.append(utilization_row(period, name, booked_types[period, name], slots * num_units))
+        for resource in resources:
+            unit_rows.append(utilization_row(period, resource.name, booked_units[period, resource.id], slots, resource.id))
+    return type_rows, unit_rows
+
+
+def utilization_row(period, resource_name, booked_slots, available_slots, unit=None):
+    """Format booked and available slots with utilization percentage"""
+    row = {'period': period, 'resource': resource_name}
+    if unit is not None:
+        row['unit'] = unit
+    row['booked_slots'] = booked_slots
+    row['available_slots'] = available_slots
+    row['utilization'] = round(100 * booked_slots / available_slots, 1) if available_slots else 0.0
+    return row
+
+
+@tracing.traced('facility.calculate_costs')
 def calculate_costs(reservation, date_time):
     """Calculate total cost for reservation"""
     total_cost = 0.0
@@ -0,0 +1,255 @@
+import argparse
+from collections import Counter
+import datetime
+import hashlib
+import itertools
+import math
+import os
+import random
+import sqlite3
+import time
+import uuid
+import sqlalchemy
+import api_sqlite
+import audit
+import facility
+
+"""Contains functions for generating large synthetic databases for benchmarks"""
+
+# Format SQLAlchemy uses to store DateTime columns in SQLite
+DATE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+# Password shared by all generated users, hashed once
+DEFAULT_PASSWORD = 'password'
+# Rows inserted per executemany call
+CHUNK_SIZE = 100_000
+# Days in advance reservations can be made
+BOOKING_WINDOW_DAYS = 30
+# Slots between bookings of irradiators and of the crusher, which the scheduler keeps more than an hour and six hours apart
+IRRADIATOR_SPACING = audit.IRRADIATOR_COOLDOWN // datetime.timedelta(minutes=30) + 1
+CRUSHER_SPACING = audit.CRUSHER_RECALIBRATION // datetime.timedelta(minutes=30) + 1
+# Share of each resource's capacity booked, leaving enough free slots that redrawing a taken one is quick
+TARGET_OCCUPANCY = 0.5
+# Slots redrawn for a reservation before also redrawing its resource, and before giving up
+REDRAWS_PER_RESOURCE = 10
+MAX_REDRAWS = 1000
+
+
+def half_hour_timeline(start_date, end_date):
+    """List formatted date/times of every 30-minute step from 30 days before start date up to end date"""
+    start = datetime.datetime.combine(start_date, datetime.time()) - datetime.timedelta(days=BOOKING_WINDOW_DAYS)
+    end = datetime.datetime.combine(end_date, datetime.time())
+    steps = int((end - start) / datetime.timedelta(minutes=30))
+    return start, [(start + i * datetime.timedelta(minutes=30)).strftime(DATE_TIME_FORMAT) for i in range(steps)]
+
+
+def working_hour_slots(timeline_start, start_date, end_date, hour_weights=None):
+    """List timeline indexes of 30-minute slots within working hours between start and end date with their weights"""
+    slots = []
+    weights = []
+    date = start_date
+    while date < end_date:
+        for hour in range(*facility.WORKING_HOURS.get(date.weekday(), (0, 0))):
+            for minute in (0, 30):
+                date_time = datetime.datetime(date.year, date.month, date.day, hour, minute)
+                slots.append(int((date_time - timeline_start) / datetime.timedelta(minutes=30)))
+                weights.append(hour_weights.get(hour, 0) if hour_weights else 1)
+        date += datetime.timedelta(days=1)
+    return slots, weights
+
+
+def working_slots_per_day(hour_weights=None):
+    """Get average number of 30-minute slots per day within working hours with a positive weight"""
+    hours = [hour for opening_hour, closing_hour in facility.WORKING_HOURS.values() for hour in range(opening_hour, closing_hour)]
+    return 2 * sum(1 for hour in hours if not hour_weights or hour_weights.get(hour, 0) > 0) / 7
+
+
+def slot_capacities(units):
+    """Get bookings per slot each resource type can take, irradiator and crusher bookings being spread over their spacing"""
+    capacities = dict(units)
+    capacities['irradiator'] = 1 / IRRADIATOR_SPACING
+    capacities['high velocity crusher'] = 1 / CRUSHER_SPACING
+    return capacities
+
+
+def required_days(num_reservations, resource_weights, capacities, slots_per_day):
+    """Get days needed for num_reservations to fill TARGET_OCCUPANCY of the capacity of each resource they are spread over"""
+    total_weight = sum(resource_weights.values())
+    return max(math.ceil(num_reservations * weight / total_weight / (TARGET_OCCUPANCY * capacities[name] * slots_per_day))
+               for name, weight in resource_weights.items() if weight > 0)
+
+
+def slot_is_free(booked, units, name, slot):
+    """Check if a slot can take another booking of a resource under the unit counts and the rules the scheduler enforces"""
+    if booked[name][slot] >= units[name]:
+        return False
+    if name == 'irradiator' and any(booked[name][slot - IRRADIATOR_SPACING + 1:slot + IRRADIATOR_SPACING]):
+        return False
+    if name == 'high velocity crusher' and any(booked[name][slot - CRUSHER_SPACING + 1:slot + CRUSHER_SPACING]):
+        return False
+    if name == 'workshop':
+        return True
+    machines = sum(booked[other][slot] for other in booked if other not in ('workshop', '1.21 gigawatt lightning harvester'))
+    if name == '1.21 gigawatt lightning harvester':
+        return machines <= audit.MAX_MACHINES_WITH_HARVESTER
+    return not booked['1.21 gigawatt lightning harvester'][slot] or machines < audit.MAX_MACHINES_WITH_HARVESTER
+
+
+def sequential_uuid(rng, number):
+    """Generate a UUID-formatted string starting with number so primary key index inserts are appends"""
+    bits = rng.getrandbits(96)
+    return '%08x-%04x-%04x-%04x-%012x' % (number, bits >> 80, (bits >> 64) & 0xffff, (bits >> 48) & 0xffff, bits & 0xffffffffffff)
+
+
+def generate_users(rng, num_users, num_facility_managers):
+    """Generate user rows sharing one precomputed password hash"""
+    password_salt = uuid.uuid4().bytes
+    password_hash = hashlib.pbkdf2_hmac('sha512', DEFAULT_PASSWORD.encode('utf-8'), password_salt, 100000)
+    for i in range(num_users):
+        role = 'facility manager' if i < num_facility_managers else 'client'
+        yield ('user' + str(i), password_hash, password_salt, 'User ' + str(i), round(rng.uniform(0, 25_000), 2), True, role)
+
+
+def generate_reservations(rng, num_reservations, customers, customer_weights, timeline, slots, slot_weights, resource_names, resource_weights, units, refund_rate):
+    """Generate reservation rows within units' capacity and the scheduler's rules and the transaction rows charging (and sometimes refunding) them"""
+    full_costs = {}
+    discounted_costs = {}
+    for resource in facility.resources:
+        full_costs[resource.name] = resource.cost
+        discounted_costs[resource.name] = round(0.75 * resource.cost, 2)
+    booking_window = BOOKING_WINDOW_DAYS * 48
+    discount_window = 14 * 48
+    # Draw all random choices up front, which is much faster than one call per row
+    slot_cum_weights = list(itertools.accumulate(slot_weights))
+    resource_cum_weights = list(itertools.accumulate(resource_weights))
+    chosen_customers = rng.choices(customers, customer_weights, k=num_reservations)
+    chosen_slots = rng.choices(slots, cum_weights=slot_cum_weights, k=num_reservations)
+    chosen_resources = rng.choices(resource_names, cum_weights=resource_cum_weights, k=num_reservations)
+    # Bookings of each resource type per timeline step
+    booked = {name: bytearray(len(timeline)) for name in units}
+    reservation_rows = []
+    transaction_rows = []
+    num_transactions = 0
+    for num_reservation, (customer, slot, resource) in enumerate(zip(chosen_customers, chosen_slots, chosen_resources)):
+        # Redraw slots already full, or that the scheduler would not allow, like a customer picking another time
+        redraws = 0
+        while not slot_is_free(booked, units, resource, slot):
+            redraws += 1
+            if redraws > MAX_REDRAWS:
+                raise ValueError('No free slot found for reservation ' + str(num_reservation) + ', use a longer date range')
+            slot = rng.choices(slots, cum_weights=slot_cum_weights)[0]
+            if redraws % REDRAWS_PER_RESOURCE == 0:
+                resource = rng.choices(resource_names, cum_weights=resource_cum_weights)[0]
+        booked[resource][slot] += 1
+        # Bookings are made up to 30 days in advance with a 25% discount 2 weeks ahead
+        steps_ahead = 1 + int(rng.random() * (booking_window - 1))
+        cost = discounted_costs[resource] if steps_ahead > discount_window else full_costs[resource]
+        serial_num = sequential_uuid(rng, num_reservation)
+        reservation_rows.append((serial_num, timeline[slot], resource, customer, customer, cost))
+        transaction_rows.append((sequential_uuid(rng, num_transactions), timeline[slot - steps_ahead], customer, cost, serial_num, resource))
+        num_transactions += 1
+        if rng.random() < refund_rate:
+            transaction_rows.append((sequential_uuid(rng, num_transactions), timeline[slot - steps_ahead // 2], customer, - round(0.5 * cost, 2), serial_num, resource))
+            num_transactions += 1
+        if len(reservation_rows) >= CHUNK_SIZE:
+            yield reservation_rows, transaction_rows
+            reservation_rows = []
+            transaction_rows = []
+    if reservation_rows:
+        yield reservation_rows, transaction_rows
+
+
+def generate(path='database.db', num_users=5000, num_reservations=1_000_000, num_facility_managers=10,
+             start_date=datetime.date(2021, 1, 1), end_date=datetime.date(2022, 1, 1),
+             resource_weights=None, hour_weights=None, customer_skew=1.0, refund_rate=0.1, seed=0):
+    """Generate a ready-to-use database with synthetic users, reservations, transactions and settings, returning the date range of reservations"""
+    rng = random.Random(seed)
+    facility.load_resources()
+    units = Counter(resource.name for resource in facility.resources)
+    capacities = slot_capacities(units)
+    if resource_weights is None:
+        resource_weights = capacities
+    for name in resource_weights:
+        if name not in units:
+            raise ValueError('Unknown resource: ' + name)
+    # Move the start date back if the date range is too short for the reservations, keeping the end date so no more of them are claimed on startup
+    days = required_days(num_reservations, resource_weights, capacities, working_slots_per_day(hour_weights))
+    if (end_date - start_date).days < days:
+        start_date = end_date - datetime.timedelta(days=days)
+    # Create schema from the same table definitions the server uses
+    api_sqlite.metadata.create_all(sqlalchemy.create_engine('sqlite:///' + path))
+    conn = sqlite3.connect(path)
+    curs = conn.cursor()
+    # Skip journaling and fsync while bulk loading
+    curs.execute('PRAGMA journal_mode = OFF')
+    curs.execute('PRAGMA synchronous = OFF')
+    curs.execute('PRAGMA locking_mode = EXCLUSIVE')
+    curs.execute('PRAGMA temp_store = MEMORY')
+    curs.execute('PRAGMA cache_size = -262144')
+    # Build secondary indexes once after loading instead of updating them on every insert
+    for table in api_sqlite.metadata.tables.values():
+        for index in table.indexes:
+            curs.execute('DROP INDEX ' + index.name)
+    curs.executemany('INSERT INTO users (id, password_hash, password_salt, name, account_balance, activation, role) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     generate_users(rng, num_users, num_facility_managers))
+    curs.executemany('INSERT INTO settings (setting, value) VALUES (?, ?)',
+                     [('client_logins_allowed', True), ('client_adding_funds_allowed', True)])
+    # Customers follow a Zipf-like distribution so a few customers book most of the time
+    customers = ['user' + str(i) for i in range(num_facility_managers, num_users)]
+    customer_weights = [1 / (rank ** customer_skew) for rank in range(1, len(customers) + 1)]
+    timeline_start, timeline = half_hour_timeline(start_date, end_date)
+    slots, slot_weights = working_hour_slots(timeline_start, start_date, end_date, hour_weights)
+    resource_names = list(resource_weights)
+    for reservation_rows, transaction_rows in generate_reservations(rng, num_reservations, customers, customer_weights, timeline, slots, slot_weights,
+                                                                     resource_names, [resource_weights[name] for name in resource_names], units, refund_rate):
+        curs.executemany('INSERT INTO reservations (serial_num, date_time, resource, customer, reserver, cost) VALUES (?, ?, ?, ?, ?, ?)', reservation_rows)
+        curs.executemany('INSERT INTO transactions (id, date_time, customer, amount, reservation_serial_num, resource) VALUES (?, ?, ?, ?, ?, ?)', transaction_rows)
+    conn.commit()
+    api_sqlite.migrate(conn)
+    # Restore default journaling so the server can use the database normally
+    curs.execute('PRAGMA journal_mode = DELETE')
+    curs.execute('PRAGMA locking_mode = NORMAL')
+    curs.execute('ANALYZE')
+    curs.close()
+    conn.close()
+    return start_date, end_date
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a large synthetic database for benchmarks')
+    parser.add_argument('--path', default='database.db')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--reservations', type=int, default=1_000_000)
+    parser.add_argument('--facility-managers', type=int, default=10)
+    parser.add_argument('--start-date', default='01-01-2021', help='MM-DD-YYYY')
+    parser.add_argument('--end-date', default='01-01-2022', help='MM-DD-YYYY')
+    parser.add_argument('--resource-weight', action='append', default=[], metavar='RESOURCE=WEIGHT',
+                        help='Relative booking weight for a resource (default: bookings each resource can take per slot)')
+    parser.add_argument('--hour-weight', action='append', default=[], metavar='HOUR=WEIGHT',
+                        help='Relative booking weight for an hour of the working day (default: uniform)')
+    parser.add_argument('--customer-skew', type=float, default=1.0, help='Zipf exponent of bookings per customer (0 for uniform)')
+    parser.add_argument('--refund-rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--overwrite', action='store_true', help='Replace the database if it already exists')
+    args = parser.parse_args()
+    if os.path.exists(args.path):
+        if not args.overwrite:
+            parser.error(args.path + ' already exists, use --overwrite to replace it')
+        os.remove(args.path)
+    resource_weights = None
+    if args.resource_weight:
+        resource_weights = {}
+        for option in args.resource_weight:
+            name, weight = option.rsplit('=', 1)
+            resource_weights[name] = float(weight)
+    hour_weights = None
+    if args.hour_weight:
+        hour_weights = {}
+        for option in args.hour_weight:
+            hour, weight = option.split('=')
+            hour_weights[int(hour)] = float(weight)
+    start = time.perf_counter()
+    start_date, end_date = generate(args.path, args.users, args.reservations, args.facility_managers,
+                                    datetime.datetime.strptime(args.start_date, '%m-%d-%Y').date(),
+                                    datetime.datetime.strptime(args.end_date, '%m-%d-%Y').date(),
+                                    resource_weights, hour_weights, args.customer_skew, args.refund_rate, args.seed)
+    print('Generated ' + args.path + ' with reservations from ' + start_date.strftime('%m-%d-%Y') + ' to ' + end_date.strftime('%m-%d-%Y') + ' in ' + str(round(time.perf_counter() - start, 1)) + 's')
@@ -1,27 +1,425 @@
-from fastapi import FastAPI, HTTPException
+# Imported first so the time taken to import the app can be measured
+from startup import ReadinessMiddleware, Startup
+from fastapi import Depends, FastAPI, Header, HTTPException, Request, Response
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Match
 from typing import Optional
-from models.models_main import ReservationModel, ReservationUpdateModel, UserModel, NameModel, AmountModel, ActivationModel, LoginDetailsModel, SettingValueModel, HoldModel
+from models.models_main import ReservationModel, ReservationUpdateModel, UserModel, NameModel, AmountModel, ActivationModel, LoginDetailsModel, SettingValueModel, HoldModel, BatchModel
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
 import facility
+import asyncio
+import cProfile
 import datetime
+import hashlib
+import hmac
+import json
+import marshal
+import memory
 import uuid
 import api_sqlite
+import audit
 import os
 import string
+import threading
+import serialization
+from report_cache import CacheEntry, ReportCache
+from single_flight import SingleFlight
+from event_hub import EventHub, format_event
+from rate_limit import RateLimiter
+from admission import AdmissionMiddleware, AdmissionPool
+from metrics import RequestMetricsMiddleware
+from tracing import Tracer
+import metrics
+import tracing
+import profiler
 
 
 # Create app
 app = FastAPI()
 
+# Columns included in compact list responses
+USER_COLUMNS = ('id', 'name', 'account_balance', 'activation', 'role')
+RESERVATION_COLUMNS = ('serial_num', 'date_time', 'resource', 'customer')
+TRANSACTION_COLUMNS = ('id', 'date_time', 'customer', 'amount')
+# Tables whose versions determine the ETag of each list endpoint
+ETAG_TABLES = {
+    '/users': ('users',),
+    '/reservations': ('reservations',),
+    '/transactions': ('transactions',),
+    '/hold': ('users', 'reservations'),
+    '/reports/revenue': ('transactions',),
+    '/reports/usage': ('reservations',)
+}
+# Maximum number of transactions per page of a customer statement
+MAX_STATEMENT_PAGE_SIZE = 1000
+# Maximum number of change log entries per page of GET /changes
+MAX_CHANGES_PAGE_SIZE = 1000
+# Number of latest change log entries that compaction leaves untouched by default
+CHANGE_LOG_RETAIN = int(os.getenv('CHANGE_LOG_RETAIN', '10000'))
+# Table and column aggregated by each report endpoint
+AGGREGATE_REPORTS = {
+    '/reports/revenue': ('transactions', 'amount'),
+    '/reports/usage': ('reservations', 'cost')
+}
+# Count and amount columns of the daily rollups summed by each report endpoint
+ROLLUP_REPORT_COLUMNS = {
+    '/reports/revenue': (('charges', 'refunds'), ('charge_amount', 'refund_amount')),
+    '/reports/usage': (('bookings',), ('booking_amount',))
+}
+REPORT_GRANULARITIES = ('day', 'week', 'month')
+REPORT_GROUP_COLUMNS = ('resource', 'customer')
+# Default date range of list endpoints in format MM-DD-YYYY
+DEFAULT_START_DATE_STRING = '01-01-2021'
+DEFAULT_END_DATE_STRING = '01-01-2022'
+# Cache of date-range report responses, invalidated when reservations or transactions in their range change
+report_cache = ReportCache(int(os.getenv('REPORT_CACHE_ENTRIES', '256')), int(os.getenv('REPORT_CACHE_BYTES', str(64 * 1024 * 1024))))
+api_sqlite.change_listeners.append(report_cache.invalidate)
+# Read endpoints whose concurrent identical requests share one response, as a comma-separated list of route paths
+COALESCED_ROUTES = set(filter(None, os.getenv('COALESCED_ROUTES', ','.join([
+    '/users', '/users/{id}', '/reservations', '/reservations/serial_num/{serial_num}', '/reservations/{customer}',
+    '/transactions', '/transactions/{customer}', '/settings/{setting}', '/hold', '/reports/revenue', '/reports/usage'
+])).split(',')))
+single_flight = SingleFlight()
+# Live events pushed to GET /events subscribers, each holding at most EVENT_QUEUE_SIZE undelivered events
+event_hub = EventHub(int(os.getenv('EVENT_QUEUE_SIZE', '100')))
+EVENT_TYPES = ('setting', 'claim', 'release', 'cancellation')
+SETTINGS = ('client_logins_allowed', 'client_adding_funds_allowed')
+# Maximum number of operations in one POST /batch request
+MAX_BATCH_OPERATIONS = int(os.getenv('MAX_BATCH_OPERATIONS', '1000'))
+BATCH_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+# Writes whose response is stored and replayed when they are repeated with the same Idempotency-Key header
+IDEMPOTENT_ROUTES = {('POST', '/reservations'), ('DELETE', '/reservations'), ('POST', '/hold'), ('PUT', '/users/{id}/account_balance')}
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+# Seconds for which a stored response is replayed
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', str(24 * 60 * 60)))
+# Idempotency keys of requests currently running
+idempotency_keys_in_flight = set()
+# Limit class of each rate-limited route, limited per customer (or client address if a request has no customer)
+RATE_LIMITED_ROUTES = {
+    ('POST', '/reservations'): 'writes',
+    ('PUT', '/reservations'): 'writes',
+    ('DELETE', '/reservations'): 'writes',
+    ('POST', '/hold'): 'writes',
+    ('PUT', '/users/{id}/account_balance'): 'writes',
+    ('GET', '/reservations'): 'reports',
+    ('GET', '/reservations/{customer}'): 'reports',
+    ('GET', '/transactions'): 'reports',
+    ('GET', '/transactions/{customer}'): 'reports',
+    ('GET', '/transactions/{customer}/statement'): 'reports',
+    ('GET', '/reports/revenue'): 'reports',
+    ('GET', '/reports/usage'): 'reports',
+    ('GET', '/reports/utilization'): 'reports',
+    ('POST', '/validity'): 'auth',
+    # Charged once for all its operations, which are not limited themselves
+    ('POST', '/batch'): 'writes'
+}
+# Requests per second and burst of each limit class, set with environment variables like RATE_LIMIT_WRITES=2,10
+RATE_LIMITS = {
+    limit_class: tuple(float(number) for number in os.getenv('RATE_LIMIT_' + limit_class.upper(), default).split(','))
+    for limit_class, default in (('writes', '5,20'), ('reports', '5,30'), ('auth', '1,10'))
+}
+# Path parameter, query parameter or JSON body field each rate-limited route declares for the customer a request is made for,
+# other routes being limited per client address so clients cannot get a fresh bucket by naming a new customer
+RATE_LIMIT_SUBJECTS = {
+    ('POST', '/reservations'): ('body', 'customer'),
+    ('PUT', '/reservations'): ('body', 'customer'),
+    ('DELETE', '/reservations'): ('query', 'customer'),
+    ('POST', '/hold'): ('body', 'username'),
+    ('PUT', '/users/{id}/account_balance'): ('path', 'id'),
+    ('GET', '/reservations/{customer}'): ('path', 'customer'),
+    ('GET', '/transactions/{customer}'): ('path', 'customer'),
+    ('GET', '/transactions/{customer}/statement'): ('path', 'customer'),
+    ('POST', '/validity'): ('body', 'id')
+}
+rate_limiter = RateLimiter(RATE_LIMITS)
+# Bearer token required by /admin endpoints, which are open if it is not set except for profiling
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+MAX_PROFILE_SECONDS = 60
+# Held while a profile is running so that only one runs at a time
+profiler_lock = threading.Lock()
+# Thread sampling the others, excluded from its own samples
+profiler_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='profiler')
+# Latest TRACE_BUFFER_SIZE request traces for GET /admin/traces, also appended to the JSON-lines file TRACE_FILE if set
+tracer = Tracer(int(os.getenv('TRACE_BUFFER_SIZE', '1000')), os.getenv('TRACE_FILE'))
+# Snapshot of allocations compared by the next GET /admin/memory while tracemalloc is on
+memory_differ = memory.SnapshotDiffer()
+MAX_TRACEMALLOC_FRAMES = 25
+# Traffic class of routes whose requests wait for a slot of their class's pool, other routes are in the default class
+ADMISSION_CLASSES = {
+    ('POST', '/users'): 'critical',
+    ('DELETE', '/users/{id}'): 'critical',
+    ('PUT', '/users/{id}/name'): 'critical',
+    ('PUT', '/users/{id}/account_balance'): 'critical',
+    ('PUT', '/users/{id}/activation'): 'critical',
+    ('POST', '/reservations'): 'critical',
+    ('PUT', '/reservations'): 'critical',
+    ('DELETE', '/reservations'): 'critical',
+    ('POST', '/settings/{setting}'): 'critical',
+    ('POST', '/hold'): 'critical',
+    ('GET', '/users'): 'bulk',
+    ('GET', '/reservations'): 'bulk',
+    ('GET', '/reservations/{customer}'): 'bulk',
+    ('GET', '/transactions'): 'bulk',
+    ('GET', '/transactions/{customer}'): 'bulk',
+    ('GET', '/transactions/{customer}/statement'): 'bulk',
+    ('GET', '/reports/revenue'): 'bulk',
+    ('GET', '/reports/usage'): 'bulk',
+    ('GET', '/reports/utilization'): 'bulk',
+    ('GET', '/changes'): 'bulk',
+    ('GET', '/hold'): 'bulk'
+}
+# Long-lived event streams and batches, whose operations are admitted one by one, do not take a slot
+ADMISSION_EXEMPT_ROUTES = {('GET', '/events'), ('POST', '/batch')}
 
-@app.on_event('startup')
-async def startup():
-    """Set whether client logins are allowed on app startup based on environment variable"""
+http_requests = metrics.Counter('http_requests_total', 'Requests by route template, method and status code', ('route', 'method', 'status'))
+http_request_duration = metrics.Histogram('http_request_duration_seconds', 'Time until the response was sent by route template and method', ('route', 'method'))
+
+
+def admission_pool(traffic_class, default):
+    """Create pool of traffic class with concurrency, queue length and maximum queue wait in seconds from its environment variable like ADMISSION_BULK=4,16,2"""
+    concurrency, max_queued, max_wait = os.getenv('ADMISSION_' + traffic_class.upper(), default).split(',')
+    return AdmissionPool(int(concurrency), int(max_queued), float(max_wait))
+
+
+admission_pools = {
+    'critical': admission_pool('critical', '64,256,10'),
+    'default': admission_pool('default', '32,128,5'),
+    'bulk': admission_pool('bulk', '4,16,2')
+}
+
+
+def publish_claim(event_type, resource, date_time, customer):
+    """Publish claim or release of a resource slot"""
+    event_hub.publish(event_type, {'resource': resource.name, 'unit': resource.id, 'date': date_time.strftime('%m-%d-%Y %H:%M')})
+
+
+def publish_setting(setting, value):
+    """Publish new value of a setting"""
+    event_hub.publish('setting', {'setting': setting, 'value': value})
+
+
+facility.claim_listeners.append(publish_claim)
+api_sqlite.setting_listeners.append(publish_setting)
+
+
+def admission_class(scope):
+    """Get traffic class of request for admission control, with facility manager operations and bookings critical and lists and reports bulk, None if exempt"""
+    request = Request(scope)
+    route = (request.method, route_path(request))
+    if route in ADMISSION_EXEMPT_ROUTES:
+        return None
+    if route[1] is not None and route[1].startswith('/admin/'):
+        return 'critical'
+    return ADMISSION_CLASSES.get(route, 'default')
+
+
+# Innermost so cached, not modified and coalesced responses do not take a slot
+app.add_middleware(AdmissionMiddleware, pools=admission_pools, classify=admission_class)
+
+
+@app.middleware('http')
+async def cache_reports(request: Request, call_next):
+    """Serve repeated date-range report requests from the report cache"""
+    report = report_scope(request)
+    # Reads inside an atomic batch can see writes that are not committed yet
+    if report is None or api_sqlite.changes_deferred():
+        return await call_next(request)
+    key = request_key(request)
+    entry = report_cache.get(key)
+    if entry is not None:
+        return Response(entry.body, headers=dict(entry.headers, **{'X-Cache': 'hit'}))
+    generation = report_cache.generation
+    response = await call_next(request)
+    if response.status_code != 200:
+        return response
+    body = b''.join([chunk async for chunk in response.body_iterator])
+    headers = dict(response.headers)
+    report_cache.put(key, CacheEntry(body, headers, *report), generation)
+    return Response(body, headers=dict(headers, **{'X-Cache': 'miss'}))
+
+
+@app.middleware('http')
+async def coalesce_reads(request: Request, call_next):
+    """Share one in-flight response between concurrent identical requests to coalesced read endpoints"""
+    if request.method != 'GET' or route_path(request) not in COALESCED_ROUTES or 'stream' in request.query_params or serialization.stream_requested(request, False) or api_sqlite.changes_deferred():
+        return await call_next(request)
+
+    async def read_response():
+        response = await call_next(request)
+        body = b''.join([chunk async for chunk in response.body_iterator])
+        return response.status_code, dict(response.headers), body
+
+    # Table versions are part of the key so requests arriving after a write do not join a read started before it
+    key = request_key(request) + tuple(api_sqlite.table_versions.values())
+    status_code, headers, body = await single_flight.run(key, read_response)
+    return Response(body, status_code=status_code, headers=headers)
+
+
+@app.middleware('http')
+async def conditional_get(request: Request, call_next):
+    """Answer GET requests for unchanged lists with 304 Not Modified without touching the database"""
+    tables = ETAG_TABLES.get(request.url.path)
+    if request.method != 'GET' or tables is None or api_sqlite.changes_deferred():
+        return await call_next(request)
+    # Compute ETag before the handler reads, so the response is never older than its ETag
+    etag = list_etag(request, tables)
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    response = await call_next(request)
+    if response.status_code == 200:
+        response.headers['ETag'] = etag
+    return response
+
+
+@app.middleware('http')
+async def idempotent_writes(request: Request, call_next):
+    """Replay the stored response of a write repeated with the same Idempotency-Key header instead of running it again"""
+    key = request.headers.get('idempotency-key')
+    if key is None or (request.method, route_path(request)) not in IDEMPOTENT_ROUTES:
+        return await call_next(request)
+    if not 0 < len(key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+        return JSONResponse({'detail': 'Idempotency key must have 1 to ' + str(MAX_IDEMPOTENCY_KEY_LENGTH) + ' characters'}, status_code=400)
+    if key in idempotency_keys_in_flight:
+        return JSONResponse({'detail': 'Request with this idempotency key in progress'}, status_code=409)
+    idempotency_keys_in_flight.add(key)
+    try:
+        body = await request.body()
+        fingerprint = hashlib.sha256('\n'.join([request.method, request.url.path, request.url.query]).encode('utf-8') + b'\n' + body).hexdigest()
+        now = datetime.datetime.now()
+        expired_until = now - datetime.timedelta(seconds=IDEMPOTENCY_KEY_TTL)
+        row = await api_sqlite.get_idempotent_response(key, expired_until)
+        if row is not None:
+            if row.fingerprint != fingerprint:
+                return JSONResponse({'detail': 'Idempotency key already used for a different request'}, status_code=422)
+            return Response(row.body, status_code=row.status_code, media_type=row.media_type, headers={'Idempotent-Replayed': 'true'})
+        # Store the response in the transaction of the write so a retry never sees one without the other
+        with facility.track_claims() as claims:
+            try:
+                async with api_sqlite.atomic():
+                    response = await call_next(replay_request(request, body))
+                    response_body = b''.join([chunk async for chunk in response.body_iterator])
+                    if response.status_code >= 500:
+                        raise IdempotentRequestFailed()
+                    await api_sqlite.save_idempotent_response(key, fingerprint, response.status_code, response.headers.get('content-type'), response_body, now, expired_until)
+            except IdempotentRequestFailed:
+                # Server errors are rolled back and not stored so that the request can be retried
+                facility.release_claims(claims)
+            except Exception:
+                facility.release_claims(claims)
+                raise
+        return Response(response_body, status_code=response.status_code, headers=dict(response.headers))
+    finally:
+        idempotency_keys_in_flight.discard(key)
+
+
+@app.middleware('http')
+async def rate_limit(request: Request, call_next):
+    """Reject requests to rate-limited routes with 429 Too Many Requests once their customer runs out of tokens"""
+    limit_class = RATE_LIMITED_ROUTES.get((request.method, route_path(request)))
+    if limit_class is None or request.scope.get('batch_operation'):
+        return await call_next(request)
+    body = await request.body()
+    retry_after = rate_limiter.check(limit_class, rate_limit_subject(request, body), rate_limit_cost(request, body))
+    if retry_after:
+        return JSONResponse({'detail': 'Too many requests'}, status_code=429, headers={'Retry-After': str(retry_after)})
+    return await call_next(replay_request(request, body))
+
+
+def request_route(scope):
+    """Get route template of request"""
+    return route_path(Request(scope))
+
+
+class RequestContextMiddleware:
+    """ASGI middleware tracing each request and noting its method and route template for the statements it runs"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        endpoint = scope['method'] + ' ' + (request_route(scope) or scope['path'])
+        with api_sqlite.query_endpoint(endpoint), tracer.trace(endpoint) as span:
+
+            async def send_with_trace_id(message):
+                # Lets a client look up the trace of a slow request
+                if message['type'] == 'http.response.start':
+                    message['headers'] = list(message.get('headers', [])) + [(b'x-trace-id', span.trace.trace_id.encode('latin-1'))]
+                    span.attributes['status'] = message['status']
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace_id)
+
+
+async def apply_login_setting():
+    """Set whether client logins are allowed based on environment variable"""
     client_logins_allowed = True
     if os.getenv('CLIENT_LOGINS_ALLOWED') == 'false':
         client_logins_allowed = False
     await api_sqlite.set_settings_value('client_logins_allowed', client_logins_allowed)
 
 
+async def warm_up_scheduler():
+    """Claim units for stored reservations recent or upcoming enough to affect the scheduler's checks"""
+    rows = await api_sqlite.list_reservations(datetime.datetime.now() - facility.CLAIM_LOOKBACK)
+    facility.restore_claims(rows)
+
+
+# Work done on startup rather than on import, in order, before requests other than probes and metrics are served
+startup_phases = Startup([
+    ('schema', api_sqlite.create_schema),
+    ('migrations', api_sqlite.run_migrations),
+    ('catalog', facility.load_resources),
+    ('settings', apply_login_setting),
+    ('warm_up', warm_up_scheduler)
+])
+READINESS_EXEMPT_PATHS = ('/healthz', '/readyz', '/metrics')
+app.add_middleware(RequestContextMiddleware)
+# Requests before startup has finished are answered without being traced or touching the database
+app.add_middleware(ReadinessMiddleware, startup=startup_phases, exempt_paths=READINESS_EXEMPT_PATHS)
+# Outermost so rejected and shed requests are counted too
+app.add_middleware(RequestMetricsMiddleware, route=request_route, requests=http_requests, latency=http_request_duration)
+
+
+# Dependency of /admin endpoints, defined before them
+async def handle_unauthorized_admin(authorization: Optional[str] = Header(None)):
+    """Raise exception if ADMIN_TOKEN is set and the request does not have it as bearer token"""
+    if ADMIN_TOKEN is not None and not hmac.compare_digest((authorization or '').encode('utf-8'), ('Bearer ' + ADMIN_TOKEN).encode('utf-8')):
+        raise HTTPException(status_code=401, detail='Admin token invalid', headers={'WWW-Authenticate': 'Bearer'})
+
+
+@app.on_event('startup')
+async def startup():
+    """Start the startup phases in the background so probes are answered while they run"""
+    startup_phases.start()
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    """Write out queued traces and close the trace file"""
+    await asyncio.get_event_loop().run_in_executor(None, tracer.close)
+
+
+@app.get('/healthz')
+async def health():
+    """Report that the server is alive, with 500 if a startup phase failed"""
+    if startup_phases.failed is not None:
+        raise HTTPException(status_code=500, detail='Startup phase ' + startup_phases.failed + ' failed')
+    return {'status': 'ok'}
+
+
+@app.get('/readyz')
+async def readiness():
+    """Report whether startup has finished and the time taken by import and each startup phase, with 503 until it has"""
+    status = startup_phases.status()
+    if not status['ready']:
+        return JSONResponse(status, status_code=503)
+    return status
+
+
 @app.get('/')
 async def root():
     return {'message': 'Welcome to MPCS, Inc. Team 1 Reservation System!'}
@@ -39,18 +437,18 @@ async def add_user(user: UserModel):
 
 
 @app.get('/users')
-async def list_users():
-    """Get list of all users"""
+async def list_users(request: Request, stream: Optional[bool] = False, format: Optional[str] = 'default', timestamps: Optional[str] = 'iso'):
+    """Get list of all users, streamed row by row with stream=true or an NDJSON Accept header, or as column arrays with format=compact"""
+    handle_invalid_list_format(format, timestamps)
+    if serialization.stream_requested(request, stream):
+        return serialization.streaming_response(request, api_sqlite.iterate_users(), 'id', user_details)
     rows = await api_sqlite.list_users()
     response = {}
     if rows:
+        if format == 'compact':
+            return serialization.compact_response(rows, USER_COLUMNS, timestamps)
         for row in rows:
-            response[row.id] = {
-                'name': row.name,
-                'account_balance': row.account_balance,
-                'activation status': row.activation,
-                'role': row.role
-            }
+            response[row.id] = user_details(row)
         return response
     else:
         raise HTTPException(status_code=404, detail='No users found')
@@ -113,14 +511,19 @@ async def change_user_activation(id: str, activation: ActivationModel):
 @app.post('/reservations', status_code=201)
 async def make_reservation(reservation: ReservationModel):
     """Make new reservation using POST request parameters"""
-    await handle_invalid_user(reservation.customer)
-    await handle_deactivated_user(reservation.customer)
+    # Fetch customer once for validity, activation and account balance checks
+    row = await api_sqlite.get_user(reservation.customer)
+    if not row:
+        raise HTTPException(status_code=400, detail='User ID invalid')
+    if not row.activation:
+        raise HTTPException(status_code=403, detail='User deactivated')
     # Convert date string to date object
     try:
         date_time = datetime.datetime.strptime(reservation.date_time_string, '%m-%d-%Y %H:%M')
     except ValueError:
         raise HTTPException(status_code=400, detail={'message': 'Date/time format incorrect', 'hold_request_possible': False})
-    rows = await api_sqlite.list_reservations()
+    # Only the customer's reservations in the same week count towards the limit
+    rows = await api_sqlite.list_reservations_for_customer(reservation.customer, *facility.reservation_limit_window(date_time))
     # Attempt reservation if customer has not exceeded limit
     if facility.reservation_limit_exceeded(rows, reservation, date_time):
         raise HTTPException(status_code=400, detail={'message': 'Customer limit exceeded', 'hold_request_possible': True})
@@ -131,13 +534,10 @@ async def make_reservation(reservation: ReservationModel):
         raise HTTPException(status_code=400, detail={'message': validity_message, 'hold_request_possible': hold_request_possible})
     total_cost = facility.calculate_costs(reservation, date_time)
     # Check if user has sufficient account balance
-    row = await api_sqlite.get_user(reservation.customer)
     if row.account_balance < total_cost:
         raise HTTPException(status_code=400, detail={'message': 'Not enough balance in account', 'hold_request_possible': False})
     reservation_uuid = str(uuid.uuid4())
-    await api_sqlite.add_reservation(reservation_uuid, date_time, reservation.resource, reservation.customer, reservation.reserver, total_cost)
-    await api_sqlite.add_transaction(str(uuid.uuid4()), datetime.datetime.now(), reservation.customer, total_cost)
-    await api_sqlite.add_to_user_balance(reservation.customer, - total_cost)
+    await api_sqlite.add_paid_reservation(reservation_uuid, date_time, reservation.resource, reservation.customer, reservation.reserver, total_cost, str(uuid.uuid4()), datetime.datetime.now())
     return {'message': 'Reservation successful with serial number: ' + reservation_uuid + ', Total cost: $' + str(total_cost) + ', Current account balance: $' + str(row.account_balance - total_cost)}
 
 
@@ -155,7 +555,7 @@ async def edit_reservation(reservation: ReservationUpdateModel):
     row = await api_sqlite.get_reservation_with_serial_number(reservation.serial_num)
     if not row:
         raise HTTPException(status_code=404, detail='Reservation not found')
-    rows = await api_sqlite.list_reservations()
+    rows = await api_sqlite.list_reservations_for_customer(reservation.customer, *facility.reservation_limit_window(date_time))
     # Attempt edited reservation if customer has not exceeded limit
     if facility.reservation_limit_exceeded(rows, reservation, date_time):
         raise HTTPException(status_code=400, detail='Customer limit exceeded')
@@ -163,8 +563,9 @@ async def edit_reservation(reservation: ReservationUpdateModel):
     reservation_valid, validity_message, hold_request_possible = facility.reservation_valid(reservation.resource, reservation.customer, date_time)
     if not reservation_valid:
         raise HTTPException(status_code=400, detail=validity_message)
-    # Remove old reservation
+    # Remove old reservation and free its slot once committed
     await api_sqlite.remove_reservation(reservation.serial_num)
+    api_sqlite.after_commit(facility.release_reservation, row.resource, row.date_time, row.customer)
     # Calculate cost of edited reservation
     total_cost = facility.calculate_costs(reservation, date_time)
     # Calculate refund amount for old reservation
@@ -173,7 +574,7 @@ async def edit_reservation(reservation: ReservationUpdateModel):
     net_amount = total_cost - refund_amount
     await api_sqlite.add_reservation(reservation.serial_num, date_time, reservation.resource, reservation.customer, reservation.reserver, total_cost)
     if net_amount != 0:
-        await api_sqlite.add_transaction(str(uuid.uuid4()), datetime.datetime.now(), reservation.customer, net_amount)
+        await api_sqlite.add_transaction(str(uuid.uuid4()), datetime.datetime.now(), reservation.customer, net_amount, reservation.serial_num, reservation.resource)
         await api_sqlite.add_to_user_balance(reservation.customer, - net_amount)
     if net_amount >= 0:
         return {'message': 'Modification successful, Total cost: $' + str(net_amount)}
@@ -182,25 +583,26 @@ async def edit_reservation(reservation: ReservationUpdateModel):
 
 
 @app.get('/reservations')
-async def list_reservations(start_date_string: Optional[str] = '01-01-2021', end_date_string: Optional[str] = '01-01-2022'):
-    """Get list of all reservations with start and end date in format MM-DD-YYYY as optional query parameters"""
+async def list_reservations(request: Request, start_date_string: Optional[str] = DEFAULT_START_DATE_STRING, end_date_string: Optional[str] = DEFAULT_END_DATE_STRING, stream: Optional[bool] = False, format: Optional[str] = 'default', timestamps: Optional[str] = 'iso'):
+    """Get list of all reservations with start and end date in format MM-DD-YYYY as optional query parameters, streamed with stream=true or an NDJSON Accept header, or as column arrays with format=compact"""
+    handle_invalid_list_format(format, timestamps)
     # Convert date strings to date objects
     try:
         start_date = datetime.datetime.strptime(start_date_string, '%m-%d-%Y').date()
         end_date = datetime.datetime.strptime(end_date_string, '%m-%d-%Y').date()
     except ValueError:
         raise HTTPException(status_code=404, detail='Date format incorrect')
+    if serialization.stream_requested(request, stream):
+        return serialization.streaming_response(request, api_sqlite.iterate_reservations(*date_range_bounds(start_date, end_date)), 'serial_num', reservation_details)
     # Return list of all reservations in json format keyed by serial number
-    rows = await api_sqlite.list_reservations()
+    rows = await api_sqlite.list_reservations(*date_range_bounds(start_date, end_date))
     if rows:
+        if format == 'compact':
+            return serialization.compact_response(rows, RESERVATION_COLUMNS, timestamps)
         response = {}
         for row in rows:
             if start_date < row.date_time.date() < end_date:
-                response[row.serial_num] = {
-                    'date': row.date_time.strftime('%m-%d-%Y %H:%M'),
-                    'resource': row.resource,
-                    'customer': row.customer
-                }
+                response[row.serial_num] = reservation_details(row)
         return response
     else:
         raise HTTPException(status_code=404, detail='No reservations found')
@@ -219,7 +621,7 @@ async def get_reservation(serial_num: str):
 
 
 @app.get('/reservations/{customer}')
-async def list_reservations_for_customer(customer: str, start_date_string: Optional[str] = '01-01-2021', end_date_string: Optional[str] = '01-01-2022'):
+async def list_reservations_for_customer(customer: str, start_date_string: Optional[str] = DEFAULT_START_DATE_STRING, end_date_string: Optional[str] = DEFAULT_END_DATE_STRING):
     """Get list of all reservations for a customer with customer as path parameter, and start and end date in format MM-DD-YYYY as optional query parameters"""
     await handle_invalid_user(customer)
     # Convert date strings to date objects
@@ -229,7 +631,7 @@ async def list_reservations_for_customer(customer: str, start_date_string: Optio
     except ValueError:
         raise HTTPException(status_code=404, detail='Date format incorrect')
     # Return list of all reservations for customer in json format keyed by serial number
-    rows = await api_sqlite.list_reservations_for_customer(customer)
+    rows = await api_sqlite.list_reservations_for_customer(customer, *date_range_bounds(start_date, end_date))
     response = {}
     reservations_found = False
     for row in rows:
@@ -255,41 +657,45 @@ async def cancel_reservation(customer: str, serial_num: str):
     if row:
         refund_amount = facility.calculate_refund(row)
         if refund_amount != 0:
-            await api_sqlite.add_transaction(str(uuid.uuid4()), datetime.datetime.now(), row.customer, - refund_amount)
+            await api_sqlite.add_transaction(str(uuid.uuid4()), datetime.datetime.now(), row.customer, - refund_amount, serial_num, row.resource)
             await api_sqlite.add_to_user_balance(customer, refund_amount)
         await api_sqlite.remove_reservation(serial_num)
+        # Free the slot once the cancellation is committed
+        api_sqlite.after_commit(facility.release_reservation, row.resource, row.date_time, row.customer)
+        api_sqlite.after_commit(event_hub.publish, 'cancellation', {'serial_num': serial_num, 'resource': row.resource, 'date': row.date_time.strftime('%m-%d-%Y %H:%M')})
         return {'message': 'Cancellation successful, Refund amount: $' + str(refund_amount)}
     else:
         raise HTTPException(status_code=404, detail='Reservation not found')
 
 
 @app.get('/transactions')
-async def list_transactions(start_date_string: Optional[str] = '01-01-2021', end_date_string: Optional[str] = '01-01-2022'):
-    """Get list of all transactions with start and end date in format MM-DD-YYYY as optional query parameters"""
+async def list_transactions(request: Request, start_date_string: Optional[str] = DEFAULT_START_DATE_STRING, end_date_string: Optional[str] = DEFAULT_END_DATE_STRING, stream: Optional[bool] = False, format: Optional[str] = 'default', timestamps: Optional[str] = 'iso'):
+    """Get list of all transactions with start and end date in format MM-DD-YYYY as optional query parameters, streamed with stream=true or an NDJSON Accept header, or as column arrays with format=compact"""
+    handle_invalid_list_format(format, timestamps)
     # Convert date strings to date objects
     try:
         start_date = datetime.datetime.strptime(start_date_string, '%m-%d-%Y').date()
         end_date = datetime.datetime.strptime(end_date_string, '%m-%d-%Y').date()
     except ValueError:
         raise HTTPException(status_code=404, detail='Date format incorrect')
+    if serialization.stream_requested(request, stream):
+        return serialization.streaming_response(request, api_sqlite.iterate_transactions(*date_range_bounds(start_date, end_date)), 'id', transaction_details)
     # Return list of all transactions in json format keyed by id
-    rows = await api_sqlite.list_transactions()
+    rows = await api_sqlite.list_transactions(*date_range_bounds(start_date, end_date))
     if rows:
+        if format == 'compact':
+            return serialization.compact_response(rows, TRANSACTION_COLUMNS, timestamps)
         response = {}
         for row in rows:
             if start_date < row.date_time.date() < end_date:
-                response[row.id] = {
-                    'date': row.date_time.strftime('%m-%d-%Y %H:%M'),
-                    'customer': row.customer,
-                    'amount': str(row.amount)
-                }
+                response[row.id] = transaction_details(row)
         return response
     else:
         raise HTTPException(status_code=404, detail='No transactions found')
 
 
 @app.get('/transactions/{customer}')
-async def list_transactions(customer: str, start_date_string: Optional[str] = '01-01-2021', end_date_string: Optional[str] = '01-01-2022'):
+async def list_transactions(customer: str, start_date_string: Optional[str] = DEFAULT_START_DATE_STRING, end_date_string: Optional[str] = DEFAULT_END_DATE_STRING):
     """Get list of all transactions for a customer with customer as path parameter, and start and end date in format MM-DD-YYYY as optional query parameters"""
     await handle_invalid_user(customer)
     # Convert date strings to date objects
@@ -299,7 +705,7 @@ async def list_transactions(customer: str, start_date_string: Optional[str] = '0
     except ValueError:
         raise HTTPException(status_code=404, detail='Date format incorrect')
     # Return list of all transactions for customer in json format keyed by id
-    rows = await api_sqlite.list_transactions_for_customer(customer)
+    rows = await api_sqlite.list_transactions_for_customer(customer, *date_range_bounds(start_date, end_date))
     response = {}
     transactions_found = False
     for row in rows:
@@ -315,6 +721,292 @@ async def list_transactions(customer: str, start_date_string: Optional[str] = '0
         raise HTTPException(status_code=404, detail='No transactions found for customer')
 
 
+@app.get('/transactions/{customer}/statement')
+async def get_statement(customer: str, start_date_string: Optional[str] = DEFAULT_START_DATE_STRING, end_date_string: Optional[str] = DEFAULT_END_DATE_STRING, limit: Optional[int] = 100, after: Optional[str] = None):
+    """Get customer's transactions between start and end date in format MM-DD-YYYY in order with opening, running and closing balances, limit per page starting after the transaction with ID after"""
+    row = await api_sqlite.get_user(customer)
+    if not row:
+        raise HTTPException(status_code=400, detail='User ID invalid')
+    if not 1 <= limit <= MAX_STATEMENT_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail='Limit not between 1 and ' + str(MAX_STATEMENT_PAGE_SIZE))
+    # Convert date strings to date objects
+    try:
+        start_date = datetime.datetime.strptime(start_date_string, '%m-%d-%Y').date()
+        end_date = datetime.datetime.strptime(end_date_string, '%m-%d-%Y').date()
+    except ValueError:
+        raise HTTPException(status_code=404, detail='Date format incorrect')
+    # Fetch one more transaction than requested to know if there is a next page
+    totals, rows = await api_sqlite.customer_statement(customer, *date_range_bounds(start_date, end_date), limit + 1, after)
+    # Charges were deducted from the current balance and refunds (negative amounts) added to it
+    closing_balance = row.account_balance + (totals.after or 0)
+    opening_balance = closing_balance + (totals.within or 0)
+    transactions = []
+    for transaction in rows[:limit]:
+        transactions.append({
+            'id': transaction.id,
+            'date': transaction.date_time.strftime('%m-%d-%Y %H:%M'),
+            'amount': transaction.amount,
+            'resource': transaction.resource,
+            'reservation': transaction.reservation_serial_num,
+            'balance': round(opening_balance - transaction.cumulative, 2)
+        })
+    return {
+        'customer': customer,
+        'opening_balance': round(opening_balance, 2),
+        'closing_balance': round(closing_balance, 2),
+        'transactions': transactions,
+        'next': rows[limit - 1].id if len(rows) > limit else None
+    }
+
+
+@app.get('/reports/revenue')
+async def revenue_report(start_date_string: Optional[str] = DEFAULT_START_DATE_STRING, end_date_string: Optional[str] = DEFAULT_END_DATE_STRING, granularity: Optional[str] = 'day', group_by: Optional[str] = None):
+    """Get number, total and average of transaction amounts per day, week or month between start and end date in format MM-DD-YYYY, optionally per resource and/or customer with group_by=resource,customer"""
+    return {'granularity': granularity, 'rows': await aggregate_report('/reports/revenue', start_date_string, end_date_string, granularity, group_by)}
+
+
+@app.get('/reports/usage')
+async def usage_report(start_date_string: Optional[str] = DEFAULT_START_DATE_STRING, end_date_string: Optional[str] = DEFAULT_END_DATE_STRING, granularity: Optional[str] = 'day', group_by: Optional[str] = None):
+    """Get number, hours, total and average cost of reservations per day, week or month between start and end date in format MM-DD-YYYY, optionally per resource and/or customer with group_by=resource,customer"""
+    rows = await aggregate_report('/reports/usage', start_date_string, end_date_string, granularity, group_by)
+    # Every reservation is a 30-minute block
+    for row in rows:
+        row['hours'] = row['count'] / 2
+    return {'granularity': granularity, 'rows': rows}
+
+
+@app.get('/reports/utilization')
+async def utilization_report(start_date_string: Optional[str] = DEFAULT_START_DATE_STRING, end_date_string: Optional[str] = DEFAULT_END_DATE_STRING, granularity: Optional[str] = 'day'):
+    """Get utilization of each resource type and unit per day or week between start and end date in format MM-DD-YYYY, as a percentage of working-hour slots booked"""
+    if granularity not in ('day', 'week'):
+        raise HTTPException(status_code=400, detail='Granularity must be day or week')
+    # Convert date strings to date objects
+    try:
+        start_date = datetime.datetime.strptime(start_date_string, '%m-%d-%Y').date()
+        end_date = datetime.datetime.strptime(end_date_string, '%m-%d-%Y').date()
+    except ValueError:
+        raise HTTPException(status_code=404, detail='Date format incorrect')
+    start_date_time, end_date_time = date_range_bounds(start_date, end_date)
+    rows = await api_sqlite.list_reservations(start_date_time, end_date_time)
+    type_rows, unit_rows = facility.utilization(rows, start_date_time.date(), end_date_time.date(), granularity)
+    for row in type_rows + unit_rows:
+        row['period'] = row['period'].strftime('%m-%d-%Y')
+    return {'granularity': granularity, 'resources': type_rows, 'units': unit_rows}
+
+
+@app.get('/events')
+async def stream_events(types: Optional[str] = None):
+    """Stream setting changes, slot claims and releases and cancellations as Server-Sent Events, only of the comma-separated types if given"""
+    event_types = None
+    if types:
+        event_types = set(types.split(','))
+        if not event_types <= set(EVENT_TYPES):
+            raise HTTPException(status_code=400, detail='Event types must be among ' + ', '.join(EVENT_TYPES))
+    # Subscribe before reading current settings so no change in between is missed
+    subscription = event_hub.subscribe(event_types)
+    initial_messages = []
+    try:
+        if event_types is None or 'setting' in event_types:
+            for setting in SETTINGS:
+                initial_messages.append(format_event('setting', {'setting': setting, 'value': await api_sqlite.get_settings_value(setting)}))
+    except Exception:
+        event_hub.unsubscribe(subscription)
+        raise
+    return StreamingResponse(event_hub.stream(subscription, initial_messages), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@app.get('/changes')
+async def list_changes(since: Optional[int] = 0, limit: Optional[int] = 100):
+    """Get inserts, updates and deletes in the order they were committed, limit per page starting after cursor since"""
+    if not 1 <= limit <= MAX_CHANGES_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail='Limit not between 1 and ' + str(MAX_CHANGES_PAGE_SIZE))
+    rows = await api_sqlite.list_changes(since, limit)
+    changes = []
+    for row in rows:
+        changes.append({
+            'cursor': row.id,
+            'date': row.date_time.strftime('%m-%d-%Y %H:%M:%S'),
+            'table': row.table_name,
+            'operation': row.operation,
+            'key': row.row_key,
+            'data': json.loads(row.data) if row.data is not None else None
+        })
+    # Readers pass the cursor of the last change back as since to get the next page
+    return {'changes': changes, 'next': rows[-1].id if rows else since}
+
+
+@app.post('/admin/changes/compact', dependencies=[Depends(handle_unauthorized_admin)])
+async def compact_changes(before: Optional[int] = None):
+    """Remove change log entries before cursor before (default all but the latest CHANGE_LOG_RETAIN) superseded by a later change to the same row"""
+    if before is None:
+        before = await api_sqlite.last_change() - CHANGE_LOG_RETAIN + 1
+    return {'before': before, 'removed': await api_sqlite.compact_changes(before)}
+
+
+@app.get('/metrics')
+async def get_metrics():
+    """Get request counts and latencies per route, database calls, scheduler rejections and password hashing time in Prometheus text format"""
+    return Response(metrics.registry.render(), media_type='text/plain; version=0.0.4')
+
+
+@app.get('/admin/slow_queries', dependencies=[Depends(handle_unauthorized_admin)])
+async def get_slow_queries():
+    """Get slow query threshold, number of slow statements logged and the slowest with their parameters, endpoint and query plan"""
+    return api_sqlite.slow_query_log.stats()
+
+
+@app.delete('/admin/slow_queries', dependencies=[Depends(handle_unauthorized_admin)])
+async def clear_slow_queries():
+    """Forget the slowest statements kept so far"""
+    api_sqlite.slow_query_log.clear()
+    return {'message': 'Slow queries cleared'}
+
+
+@app.get('/admin/profile', dependencies=[Depends(handle_unauthorized_admin)])
+async def profile_server(seconds: Optional[float] = 10, format: Optional[str] = 'collapsed', interval: Optional[float] = 0.005):
+    """Profile the running server for seconds, as collapsed stacks of all threads sampled every interval seconds or with format=pstats as a pstats dump of the event loop thread"""
+    if ADMIN_TOKEN is None:
+        raise HTTPException(status_code=403, detail='Profiling requires ADMIN_TOKEN to be set')
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail='Seconds not between 0 and ' + str(MAX_PROFILE_SECONDS))
+    if format not in ('collapsed', 'pstats'):
+        raise HTTPException(status_code=400, detail='Format must be one of "collapsed" or "pstats"')
+    if interval < 0.001:
+        raise HTTPException(status_code=400, detail='Interval must be at least 0.001 seconds')
+    if not profiler_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail='Profile already running')
+    try:
+        if format == 'pstats':
+            # Everything on the event loop thread runs while this coroutine sleeps
+            event_loop_profile = cProfile.Profile()
+            event_loop_profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                event_loop_profile.disable()
+            event_loop_profile.create_stats()
+            # Same format as cProfile's dump_stats, readable with pstats.Stats
+            return Response(marshal.dumps(event_loop_profile.stats), media_type='application/octet-stream', headers={'Content-Disposition': 'attachment; filename="profile.pstats"'})
+        counts = await asyncio.get_event_loop().run_in_executor(profiler_executor, profiler.sample, seconds, interval)
+        return Response(profiler.collapsed_stacks(counts), media_type='text/plain')
+    finally:
+        profiler_lock.release()
+
+
+@app.get('/admin/traces', dependencies=[Depends(handle_unauthorized_admin)])
+async def list_traces(limit: Optional[int] = 20, min_duration: Optional[float] = 0):
+    """Get up to limit latest request traces that took at least min_duration seconds, with the spans of each stage"""
+    return [tracing.trace_dict(trace) for trace in tracer.latest(limit, min_duration)]
+
+
+@app.get('/admin/traces/{trace_id}', dependencies=[Depends(handle_unauthorized_admin)])
+async def get_trace(trace_id: str):
+    """Get request trace with a given ID"""
+    trace = tracer.find(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail='Trace not found')
+    return tracing.trace_dict(trace)
+
+
+def memory_usage(entries, roots):
+    """Get number of entries of a subsystem and estimated bytes held by its roots"""
+    seen = set()
+    return {'entries': entries, 'bytes': sum(memory.deep_size(root, seen) for root in roots)}
+
+
+def run_audit(claims, since, max_examples):
+    """Audit snapshot of claims against stored reservations on a database connection of its own"""
+    conn = api_sqlite.sqlite_connect()
+    try:
+        return audit.audit(conn, facility.resources, claims, since, max_examples)
+    finally:
+        conn.close()
+
+
+@app.get('/admin/audit', dependencies=[Depends(handle_unauthorized_admin)])
+async def audit_scheduler(since: Optional[str] = None, examples: Optional[int] = 100):
+    """Compare the scheduler's claims with reservations stored from since (MM-DD-YYYY, default those claimed on startup), reporting missing and phantom claims, rule violations and held slots per unit"""
+    try:
+        since_date_time = datetime.datetime.strptime(since, '%m-%d-%Y') if since else datetime.datetime.now() - facility.CLAIM_LOOKBACK
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Date format incorrect')
+    if examples < 0:
+        raise HTTPException(status_code=400, detail='Examples must not be negative')
+    version = api_sqlite.table_versions['reservations']
+    # Claims are copied on the event loop so the scan in another thread never sees them change
+    claims = audit.snapshot_claims(facility.resources, since_date_time)
+    report = await asyncio.get_event_loop().run_in_executor(None, run_audit, claims, since_date_time, examples)
+    # Reservations written during the scan may show up as missing or phantom claims, so the audit should be repeated
+    report['concurrent_writes'] = api_sqlite.table_versions['reservations'] != version
+    return report
+
+
+@app.get('/admin/memory', dependencies=[Depends(handle_unauthorized_admin)])
+async def get_memory_usage(top: Optional[int] = 20):
+    """Get resident set size and estimated bytes held by each subsystem, with the top source lines by allocation growth since the previous call while tracemalloc is on"""
+    if top < 0:
+        raise HTTPException(status_code=400, detail='Top must not be negative')
+    reservations = [resource.reservations for resource in facility.resources]
+    # Messages still queued for event subscribers (asyncio.Queue keeps them in a deque)
+    queued_events = [subscription.queue._queue for subscription in event_hub.subscriptions]
+    # Responses of finished coalesced reads not yet forgotten, running ones hold no body yet
+    coalesced_responses = [task.result() for task in single_flight.calls.values() if task.done() and not task.cancelled() and task.exception() is None]
+    return {
+        'rss': memory.process_rss(),
+        'subsystems': {
+            'reservations': memory_usage(sum(len(resource_reservations) for resource_reservations in reservations), reservations),
+            'report_cache': memory_usage(len(report_cache.entries), [report_cache.entries]),
+            'coalesced_reads': memory_usage(len(single_flight.calls), coalesced_responses),
+            'events': memory_usage(sum(len(queue) for queue in queued_events), queued_events),
+            'rate_limits': memory_usage(len(rate_limiter.buckets), [rate_limiter.buckets]),
+            'idempotency_keys': memory_usage(len(idempotency_keys_in_flight), [idempotency_keys_in_flight]),
+            'traces': memory_usage(len(tracer.traces), [tracer.traces]),
+            'slow_queries': memory_usage(len(api_sqlite.slow_query_log.heap), [api_sqlite.slow_query_log.heap])
+        },
+        'tracemalloc': memory_differ.diff(top)
+    }
+
+
+@app.post('/admin/memory/tracemalloc', dependencies=[Depends(handle_unauthorized_admin)])
+async def start_tracemalloc(frames: Optional[int] = 1):
+    """Start tracing allocations with frames stack frames each, so GET /admin/memory reports growth between calls"""
+    if not 1 <= frames <= MAX_TRACEMALLOC_FRAMES:
+        raise HTTPException(status_code=400, detail='Frames not between 1 and ' + str(MAX_TRACEMALLOC_FRAMES))
+    memory_differ.start(frames)
+    return {'tracing': True}
+
+
+@app.delete('/admin/memory/tracemalloc', dependencies=[Depends(handle_unauthorized_admin)])
+async def stop_tracemalloc():
+    """Stop tracing allocations"""
+    memory_differ.stop()
+    return {'tracing': False}
+
+
+@app.get('/admin/events', dependencies=[Depends(handle_unauthorized_admin)])
+async def get_event_stats():
+    """Get number of event subscribers, events published and subscribers dropped for falling behind"""
+    return event_hub.stats()
+
+
+@app.get('/admin/admission', dependencies=[Depends(handle_unauthorized_admin)])
+async def get_admission_stats():
+    """Get limits, active and queued requests and admitted and shed counts of each traffic class"""
+    return {traffic_class: pool.stats() for traffic_class, pool in admission_pools.items()}
+
+
+@app.get('/admin/rate_limits', dependencies=[Depends(handle_unauthorized_admin)])
+async def get_rate_limit_stats():
+    """Get rate, burst and allowed and limited request counts of each rate limit class and number of token buckets"""
+    return rate_limiter.stats()
+
+
+@app.get('/admin/report_cache', dependencies=[Depends(handle_unauthorized_admin)])
+async def get_report_cache_stats():
+    """Get size and hit, miss, eviction and invalidation counts of the report cache"""
+    return report_cache.stats()
+
+
 @app.post('/validity')
 async def validate(login_details: LoginDetailsModel):
     """Check validity of a given user ID and password combination"""
@@ -389,6 +1081,273 @@ async def list_holds():
         raise HTTPException(status_code=404, detail='No holds found')
 
 
+@app.post('/batch')
+async def run_batch(batch: BatchModel, request: Request):
+    """Run an ordered list of operations on the other endpoints and return their results, all in one transaction that is rolled back if any fails with atomic=true"""
+    if len(batch.operations) > MAX_BATCH_OPERATIONS:
+        raise HTTPException(status_code=413, detail='More than ' + str(MAX_BATCH_OPERATIONS) + ' operations in batch')
+    for operation in batch.operations:
+        if operation.method.upper() not in BATCH_METHODS or not operation.path.startswith('/') or operation.path.startswith('/batch'):
+            raise HTTPException(status_code=400, detail='Batch operation invalid: ' + operation.method + ' ' + operation.path)
+    # Operations get the headers of the batch request unless they set their own, except its idempotency key
+    headers = {}
+    for name, value in request.headers.items():
+        if name not in ('content-length', 'content-type', 'idempotency-key'):
+            headers[name] = value
+    results = []
+    if not batch.atomic:
+        for operation in batch.operations:
+            results.append(await run_batch_operation(request, operation, headers))
+        return {'results': results}
+    with facility.track_claims() as claims:
+        try:
+            async with api_sqlite.atomic():
+                for operation in batch.operations:
+                    result = await run_batch_operation(request, operation, headers)
+                    results.append(result)
+                    if result['status'] >= 400:
+                        raise BatchRolledBack()
+        except BatchRolledBack:
+            facility.release_claims(claims)
+            return {'committed': False, 'results': results}
+    return {'committed': True, 'results': results}
+
+
+def user_details(row):
+    """Format user row for list responses"""
+    return {
+        'name': row.name,
+        'account_balance': row.account_balance,
+        'activation status': row.activation,
+        'role': row.role
+    }
+
+
+def reservation_details(row):
+    """Format reservation row for list responses"""
+    return {
+        'date': row.date_time.strftime('%m-%d-%Y %H:%M'),
+        'resource': row.resource,
+        'customer': row.customer
+    }
+
+
+def transaction_details(row):
+    """Format transaction row for list responses"""
+    return {
+        'date': row.date_time.strftime('%m-%d-%Y %H:%M'),
+        'customer': row.customer,
+        'amount': str(row.amount)
+    }
+
+
+async def aggregate_report(path, start_date_string, end_date_string, granularity, group_by):
+    """Aggregate table of report endpoint per period and group columns in the database and format the rows"""
+    if granularity not in REPORT_GRANULARITIES:
+        raise HTTPException(status_code=400, detail='Granularity must be day, week or month')
+    group_columns = group_by.split(',') if group_by else []
+    for column in group_columns:
+        if column not in REPORT_GROUP_COLUMNS:
+            raise HTTPException(status_code=400, detail='Reports can only be grouped by resource and customer')
+    # Convert date strings to date objects
+    try:
+        start_date = datetime.datetime.strptime(start_date_string, '%m-%d-%Y').date()
+        end_date = datetime.datetime.strptime(end_date_string, '%m-%d-%Y').date()
+    except ValueError:
+        raise HTTPException(status_code=404, detail='Date format incorrect')
+    # Read daily rollups unless grouping by both resource and customer
+    if group_columns == ['resource']:
+        rows = await api_sqlite.aggregate_rollup(api_sqlite.resource_daily, *ROLLUP_REPORT_COLUMNS[path], granularity, group_columns, *date_range_bounds(start_date, end_date))
+    elif len(group_columns) <= 1:
+        rows = await api_sqlite.aggregate_rollup(api_sqlite.customer_daily, *ROLLUP_REPORT_COLUMNS[path], granularity, group_columns, *date_range_bounds(start_date, end_date))
+    else:
+        table_name, value_column = AGGREGATE_REPORTS[path]
+        rows = await api_sqlite.aggregate(api_sqlite.metadata.tables[table_name], value_column, granularity, group_columns, *date_range_bounds(start_date, end_date))
+    report = []
+    for row in rows:
+        # Format periods like the rest of the API, months as MM-YYYY
+        if granularity == 'month':
+            entry = {'period': datetime.datetime.strptime(row.period, '%Y-%m').strftime('%m-%Y')}
+        else:
+            entry = {'period': datetime.datetime.strptime(row.period, '%Y-%m-%d').strftime('%m-%d-%Y')}
+        for column in group_columns:
+            entry[column] = getattr(row, column)
+        entry['count'] = row.count
+        entry['total'] = round(row.total, 2)
+        entry['average'] = round(row.average, 2)
+        report.append(entry)
+    return report
+
+
+def report_scope(request):
+    """Get table, customer and date/time range of a cacheable report request, or None if it is not one"""
+    if request.method != 'GET' or 'stream' in request.query_params or serialization.stream_requested(request, False):
+        return None
+    if request.url.path in AGGREGATE_REPORTS:
+        table = AGGREGATE_REPORTS[request.url.path][0]
+        customer = None
+    else:
+        parts = request.url.path.strip('/').split('/')
+        if parts[0] not in ('reservations', 'transactions') or len(parts) > 2:
+            return None
+        table = parts[0]
+        customer = parts[1] if len(parts) == 2 else None
+    try:
+        start_date = datetime.datetime.strptime(request.query_params.get('start_date_string', DEFAULT_START_DATE_STRING), '%m-%d-%Y').date()
+        end_date = datetime.datetime.strptime(request.query_params.get('end_date_string', DEFAULT_END_DATE_STRING), '%m-%d-%Y').date()
+    except ValueError:
+        return None
+    return (table, customer) + date_range_bounds(start_date, end_date)
+
+
+class BatchRolledBack(Exception):
+    """Raised to roll back an atomic batch after an operation failed"""
+
+
+class IdempotentRequestFailed(Exception):
+    """Raised to roll back a write sent with an idempotency key after it failed with a server error"""
+
+
+async def run_batch_operation(request, operation, headers):
+    """Send batch operation through the app as if it was a separate request and return its status code and body"""
+    path, _, query_string = operation.path.partition('?')
+    body = b'' if operation.body is None else json.dumps(operation.body).encode('utf-8')
+    operation_headers = dict(headers, **(operation.headers or {}))
+    operation_headers.update({'content-type': 'application/json', 'content-length': str(len(body))})
+    scope = {
+        'type': 'http',
+        'http_version': request.scope['http_version'],
+        'method': operation.method.upper(),
+        'scheme': request.scope['scheme'],
+        'server': request.scope.get('server'),
+        'client': request.scope.get('client'),
+        'root_path': request.scope.get('root_path', ''),
+        'path': unquote(path),
+        'raw_path': path.encode('utf-8'),
+        'query_string': query_string.encode('utf-8'),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in operation_headers.items()],
+        # Rate limits were charged for the whole batch
+        'batch_operation': True
+    }
+    request_messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    response_messages = []
+
+    async def receive():
+        if request_messages:
+            return request_messages.pop()
+        # Operation client never disconnects, streamed responses stop listening once they are sent
+        await asyncio.Event().wait()
+
+    async def send(message):
+        response_messages.append(message)
+
+    try:
+        await app(scope, receive, send)
+    except Exception:
+        if not response_messages:
+            return {'status': 500, 'body': 'Internal Server Error'}
+    response_body = b''.join([message.get('body', b'') for message in response_messages[1:]])
+    try:
+        response_body = json.loads(response_body) if response_body else None
+    except ValueError:
+        response_body = response_body.decode('utf-8', 'replace')
+    return {'status': response_messages[0]['status'], 'body': response_body}
+
+
+def request_key(request):
+    """Get key identifying requests with the same path, query parameters and accepted media type"""
+    return request.url.path, str(sorted(request.query_params.multi_items())), request.headers.get('accept', '')
+
+
+def route_match(request):
+    """Get path of the route handling request, with path parameters in braces, and the request's path parameters (None and {} if no route matches)"""
+    # Remembered in the scope since every middleware asks for it
+    if 'route_match' not in request.scope:
+        request.scope['route_match'] = None, {}
+        for route in app.router.routes:
+            match, child_scope = route.matches(request.scope)
+            if match == Match.FULL:
+                request.scope['route_match'] = route.path, child_scope.get('path_params', {})
+                break
+    return request.scope['route_match']
+
+
+def route_path(request):
+    """Get path of the route handling request, with path parameters in braces"""
+    return route_match(request)[0]
+
+
+def replay_request(request, body):
+    """Get copy of request whose already read body can be read again by the endpoint"""
+    request_messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive():
+        if request_messages:
+            return request_messages.pop()
+        return await request.receive()
+
+    return Request(request.scope, receive=receive)
+
+
+def rate_limit_subject(request, body):
+    """Get customer a request is made for from the parameter or field its route declares, or its client address if it declares none"""
+    location, field = RATE_LIMIT_SUBJECTS.get((request.method, route_path(request)), (None, None))
+    value = None
+    if location == 'path':
+        value = route_match(request)[1].get(field)
+    elif location == 'query':
+        value = request.query_params.get(field)
+    elif location == 'body':
+        try:
+            body_params = json.loads(body) if body else {}
+        except ValueError:
+            body_params = {}
+        if isinstance(body_params, dict):
+            value = body_params.get(field)
+    if isinstance(value, str):
+        return 'customer:' + value
+    return 'client:' + (request.client.host if request.client else '')
+
+
+def rate_limit_cost(request, body):
+    """Get number of tokens a request takes, which is the number of operations for a batch"""
+    if route_path(request) != '/batch':
+        return 1
+    try:
+        operations = json.loads(body).get('operations')
+    except (ValueError, AttributeError):
+        return 1
+    return max(len(operations), 1) if isinstance(operations, list) else 1
+
+
+def list_etag(request, tables):
+    """Get ETag for a list request from the versions of its tables, its query parameters and accepted media type"""
+    key = [api_sqlite.versions_epoch, request.url.path, str(sorted(request.query_params.multi_items())), request.headers.get('accept', '')]
+    for table in tables:
+        key.append(table + '=' + str(api_sqlite.table_versions[table]))
+    return '"' + hashlib.sha1('|'.join(key).encode('utf-8')).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """Check if If-None-Match header value contains the given ETag"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate in (etag, '*'):
+            return True
+    return False
+
+
+def date_range_bounds(start_date, end_date):
+    """Get date/time bounds for database queries covering the days strictly between start_date and end_date"""
+    start_date_time = datetime.datetime.combine(start_date + datetime.timedelta(days=1), datetime.time())
+    end_date_time = datetime.datetime.combine(end_date, datetime.time())
+    return start_date_time, end_date_time
+
+
 async def handle_invalid_user(id):
     """Raise exception if user with given ID is invalid"""
     if not await api_sqlite.user_valid(id):
@@ -401,7 +1360,19 @@ async def handle_deactivated_user(id):
         raise HTTPException(status_code=403, detail='User deactivated')
 
 
+def handle_invalid_list_format(format, timestamps):
+    """Raise exception if list format or timestamp format is invalid"""
+    if format not in ('default', 'compact'):
+        raise HTTPException(status_code=400, detail='Format must be one of "default" or "compact"')
+    if timestamps not in ('iso', 'epoch'):
+        raise HTTPException(status_code=400, detail='Timestamps must be one of "iso" or "epoch"')
+
+
 async def handle_invalid_setting(setting):
     """"Raise exception if setting name is invalid"""
     if not await api_sqlite.setting_name_valid(setting):
         raise HTTPException(status_code=400, detail='Setting must be one of "client_logins_allowed" or "client_adding_funds_allowed"')
+
+
+# Everything above runs on import
+startup_phases.imported()
@@ -0,0 +1,88 @@
+from collections import deque
+import sys
+import tracemalloc
+
+"""Contains estimates of memory held by in-process state and tracemalloc snapshot comparison"""
+
+# Allocations made by tracemalloc itself and by importing are left out of snapshots
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>')
+)
+
+
+def deep_size(root, seen=None):
+    """Estimate bytes held by root and the containers, instance attributes and values it refers to, counting objects in seen only once"""
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+            stack.append(obj.__dict__)
+    return size
+
+
+def process_rss():
+    """Get resident set size of the process in bytes from /proc, None where it is not available"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class SnapshotDiffer:
+    """Compares a tracemalloc snapshot with the one taken on the previous call, while tracing is on"""
+
+    def __init__(self):
+        self.snapshot = None
+
+    def start(self, frames=1):
+        """Start tracing allocations with up to frames frames each and take the first snapshot"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.snapshot = self.take()
+
+    def stop(self):
+        """Stop tracing allocations and forget the last snapshot"""
+        tracemalloc.stop()
+        self.snapshot = None
+
+    def take(self):
+        """Take snapshot of current allocations"""
+        return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+    def diff(self, top):
+        """Get traced memory and the top source lines by growth since the previous call, None if tracing is off"""
+        if not tracemalloc.is_tracing():
+            return None
+        snapshot = self.take()
+        differences = []
+        if self.snapshot is not None:
+            for stat in snapshot.compare_to(self.snapshot, 'lineno')[:top]:
+                frame = stat.traceback[0]
+                differences.append({
+                    'location': frame.filename + ':' + str(frame.lineno),
+                    'size': stat.size,
+                    'size_diff': stat.size_diff,
+                    'count': stat.count,
+                    'count_diff': stat.count_diff
+                })
+        self.snapshot = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        return {'traced': current, 'peak': peak, 'top': differences}
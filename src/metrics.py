@@ -0,0 +1,146 @@
+import bisect
+import time
+
+"""Contains counters and histograms rendered in the Prometheus text exposition format"""
+
+# Upper bounds in seconds of the buckets of latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Registry:
+    """Collection of metrics rendered together"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """Add metric to the rendered metrics"""
+        self.metrics.append(metric)
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP ' + metric.name + ' ' + metric.documentation)
+            lines.append('# TYPE ' + metric.name + ' ' + metric.type)
+            for name, labels, value in metric.samples():
+                lines.append(name + format_labels(labels) + ' ' + format_value(value))
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the whole process
+registry = Registry()
+
+
+def format_labels(labels):
+    """Format label names and values as a Prometheus label set, escaping backslashes, quotes and newlines"""
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(name + '="' + value + '"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    """Format sample value, with whole numbers without a decimal point"""
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonically increasing count per combination of label values"""
+    type = 'counter'
+
+    def __init__(self, name, documentation, label_names=(), registry=registry):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.values = {}
+        registry.register(self)
+
+    def inc(self, *label_values, amount=1):
+        """Add amount to the count of the given label values"""
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        """Get count of the given label values"""
+        return self.values.get(label_values, 0)
+
+    def samples(self):
+        """Get name, labels and value of every count"""
+        for label_values, value in sorted(self.values.items()):
+            yield self.name, tuple(zip(self.label_names, label_values)), value
+
+
+class Histogram:
+    """Distribution of observed values over fixed buckets per combination of label values"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS, registry=registry):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # Count per bucket (last for values above all bounds), sum and count of each combination of label values
+        self.values = {}
+        registry.register(self)
+
+    def observe(self, value, *label_values):
+        """Add value to the distribution of the given label values"""
+        counts = self.values.get(label_values)
+        if counts is None:
+            counts = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0, 0]
+        counts[0][bisect.bisect_left(self.buckets, value)] += 1
+        counts[1] += value
+        counts[2] += 1
+
+    def count(self, *label_values):
+        """Get number of values observed for the given label values"""
+        counts = self.values.get(label_values)
+        return counts[2] if counts else 0
+
+    def samples(self):
+        """Get name, labels and value of the cumulative bucket counts, sum and count of every distribution"""
+        for label_values, (bucket_counts, total, count) in sorted(self.values.items()):
+            labels = tuple(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', labels + (('le', format_value(bound)),), cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware counting requests by route template, method and status code and recording their latency until the response is sent"""
+
+    def __init__(self, app, route, requests, latency):
+        self.app = app
+        # Function getting route template of a request scope
+        self.route = route
+        self.requests = requests
+        self.latency = latency
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        route = self.route(scope) or 'unmatched'
+        status = [500]
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.latency.observe(time.perf_counter() - started, route, scope['method'])
+            self.requests.inc(route, scope['method'], str(status[0]))
@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+from typing import Any, Dict, List, Optional
 
 
 # Model for POST request to /users
@@ -61,3 +62,17 @@ class HoldModel(BaseModel):
     start_date: str
     start_time: str
     end_time: str
+
+
+# Operation in POST request to /batch
+class BatchOperationModel(BaseModel):
+    method: str
+    path: str
+    body: Optional[Any] = None
+    headers: Optional[Dict[str, str]] = None
+
+
+# Model for POST request to /batch
+class BatchModel(BaseModel):
+    operations: List[BatchOperationModel]
+    atomic: Optional[bool] = False
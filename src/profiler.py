@@ -0,0 +1,40 @@
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+"""Contains sampling profiler of all threads of the running process"""
+
+
+def frame_label(frame):
+    """Get file and function name of a stack frame"""
+    return os.path.basename(frame.f_code.co_filename) + ':' + frame.f_code.co_name
+
+
+def collapse(frame):
+    """Get stack of frame as labels separated by semicolons, outermost first"""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+def sample(seconds, interval):
+    """Sample stacks of every other thread each interval for seconds, returning counts per thread name and stack"""
+    counts = Counter()
+    own_thread = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own_thread:
+                counts[names.get(thread_id, str(thread_id)) + ';' + collapse(frame)] += 1
+        time.sleep(interval)
+    return counts
+
+
+def collapsed_stacks(counts):
+    """Format stack counts as collapsed stacks, one stack and its count per line as read by flamegraph tools"""
+    return ''.join(stack + ' ' + str(count) + '\n' for stack, count in sorted(counts.items()))
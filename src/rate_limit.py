@@ -0,0 +1,87 @@
+from collections import OrderedDict
+import math
+import time
+
+"""Contains in-process token-bucket rate limiting"""
+
+
+class TokenBucket:
+    """Bucket holding up to burst tokens, refilled at rate tokens per second"""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        """Add tokens for the time since the last refill, up to burst"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now, cost=1):
+        """Take cost tokens once there are that many (or a full bucket for costs above burst, leaving it in debt), returning 0, otherwise seconds until there will be enough"""
+        self.refill(now)
+        needed = min(cost, self.burst)
+        if self.tokens >= needed:
+            self.tokens -= cost
+            return 0
+        return (needed - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Token buckets per limit class and subject (such as a customer), with counts of allowed and limited requests per class"""
+
+    def __init__(self, limits, max_buckets=10000, clock=time.monotonic):
+        # Rate and burst of each limit class
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self.clock = clock
+        # Least recently used bucket first
+        self.buckets = OrderedDict()
+        self.allowed = dict.fromkeys(limits, 0)
+        self.limited = dict.fromkeys(limits, 0)
+
+    def check(self, limit_class, subject, cost=1):
+        """Take cost tokens from the subject's bucket of limit class, returning 0 if allowed, otherwise whole seconds to wait"""
+        now = self.clock()
+        bucket = self.buckets.get((limit_class, subject))
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self.prune(now)
+            # Still full of buckets that are refilling, so drop the least recently used to keep memory bounded
+            while len(self.buckets) >= self.max_buckets:
+                self.buckets.popitem(last=False)
+            bucket = TokenBucket(*self.limits[limit_class], now)
+            self.buckets[(limit_class, subject)] = bucket
+        else:
+            self.buckets.move_to_end((limit_class, subject))
+        wait = bucket.take(now, cost)
+        if wait:
+            self.limited[limit_class] += 1
+            return math.ceil(wait)
+        self.allowed[limit_class] += 1
+        return 0
+
+    def prune(self, now):
+        """Remove buckets that have refilled completely, which behave the same as new ones"""
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+
+    def reset(self):
+        """Remove all buckets so every subject starts with a full one"""
+        self.buckets.clear()
+
+    def stats(self):
+        """Get rate and burst of each limit class with its allowed and limited request counts, and number of buckets"""
+        classes = {}
+        for limit_class, (rate, burst) in self.limits.items():
+            classes[limit_class] = {
+                'rate': rate,
+                'burst': burst,
+                'allowed': self.allowed[limit_class],
+                'limited': self.limited[limit_class]
+            }
+        return {'classes': classes, 'buckets': len(self.buckets)}
@@ -0,0 +1,21 @@
+import argparse
+import sqlite3
+import sqlalchemy
+import time
+import api_sqlite
+
+"""Contains command for backfilling daily rollup tables"""
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recompute daily rollup tables from all reservations and transactions')
+    parser.add_argument('--path', default=api_sqlite.SQLITE_DATABASE, help='Database file (default: database of DB_NAME environment variable)')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    conn = sqlite3.connect(args.path, uri=True)
+    # Add rollup tables and linked transaction columns to databases from older versions first
+    api_sqlite.metadata.create_all(sqlalchemy.create_engine('sqlite://', creator=lambda: conn))
+    api_sqlite.migrate(conn)
+    api_sqlite.rebuild_rollups(conn)
+    conn.close()
+    print('Rebuilt rollups of ' + args.path + ' in ' + str(round(time.perf_counter() - start, 1)) + 's')
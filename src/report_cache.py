@@ -0,0 +1,84 @@
+from collections import OrderedDict
+
+"""Contains in-process cache for date-range report responses"""
+
+
+class CacheEntry:
+    """Cached response body with the table, customer and date/time range it was computed from"""
+
+    def __init__(self, body, headers, table, customer, start_date_time, end_date_time):
+        self.body = body
+        self.headers = headers
+        self.table = table
+        self.customer = customer
+        self.start_date_time = start_date_time
+        self.end_date_time = end_date_time
+
+    def affected_by(self, table, date_time, customer):
+        """Check if a change to a row of table dated date_time for customer could change this entry"""
+        if table != self.table:
+            return False
+        if customer is not None and self.customer is not None and customer != self.customer:
+            return False
+        if date_time is None:
+            return True
+        return self.start_date_time <= date_time < self.end_date_time
+
+
+class ReportCache:
+    """LRU cache of report responses bounded by number of entries and total body size"""
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Incremented on every invalidation so results computed during a change are not stored
+        self.generation = 0
+
+    def get(self, key):
+        """Get cached entry for key if present, marking it as most recently used"""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry, generation):
+        """Store entry for key unless data changed since generation, evicting least recently used entries"""
+        if generation != self.generation or len(entry.body) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key).body)
+        self.entries[key] = entry
+        self.size += len(entry.body)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            key, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.body)
+            self.evictions += 1
+
+    def invalidate(self, table, date_time=None, customer=None):
+        """Remove entries that a change to a row of table dated date_time for customer could affect"""
+        self.generation += 1
+        for key in [key for key, entry in self.entries.items() if entry.affected_by(table, date_time, customer)]:
+            self.size -= len(self.entries.pop(key).body)
+            self.invalidations += 1
+
+    def stats(self):
+        """Get number and size of entries and hit, miss, eviction and invalidation counts"""
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
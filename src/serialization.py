@@ -0,0 +1,90 @@
+from starlette.responses import Response, StreamingResponse
+import datetime
+import json
+
+# orjson is optional, the standard library encoder is used if it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""Contains functions for serializing list responses"""
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+# Streamed rows are sent in chunks of about this many characters
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def dumps(value):
+    """Serialize value to compact JSON the same way FastAPI does"""
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def stream_requested(request, stream):
+    """Check if list should be streamed because of the stream query parameter or an NDJSON Accept header"""
+    return stream or NDJSON_MEDIA_TYPE in request.headers.get('accept', '')
+
+
+async def json_object_parts(rows, key, details):
+    """Serialize rows as parts of one JSON object of row details keyed by the key column"""
+    yield '{'
+    separator = ''
+    async for row in rows:
+        yield separator + dumps(getattr(row, key)) + ':' + dumps(details(row))
+        separator = ','
+    yield '}'
+
+
+async def ndjson_parts(rows, key, details):
+    """Serialize rows as newline-delimited JSON with the key column included in every line"""
+    async for row in rows:
+        line = {key: getattr(row, key)}
+        line.update(details(row))
+        yield dumps(line) + '\n'
+
+
+async def chunked(parts):
+    """Join serialized parts into chunks so every row does not need its own write"""
+    buffer = []
+    size = 0
+    async for part in parts:
+        buffer.append(part)
+        size += len(part)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+def streaming_response(request, rows, key, details):
+    """Stream rows as NDJSON if the client accepts it, otherwise as a JSON object keyed by the key column"""
+    if NDJSON_MEDIA_TYPE in request.headers.get('accept', ''):
+        return StreamingResponse(chunked(ndjson_parts(rows, key, details)), media_type=NDJSON_MEDIA_TYPE)
+    return StreamingResponse(chunked(json_object_parts(rows, key, details)), media_type='application/json')
+
+
+def encode(value):
+    """Serialize value to JSON bytes, with orjson if it is installed"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def compact_response(rows, columns, timestamps='iso'):
+    """Respond with column names once followed by one array of values per row, with ISO or epoch timestamps"""
+    values = []
+    for row in rows:
+        row_values = []
+        for column in columns:
+            value = getattr(row, column)
+            if isinstance(value, datetime.datetime):
+                if timestamps == 'epoch':
+                    # Stored date/times are naive in the server's local time, which timestamp() converts from to get Unix time
+                    value = int(value.timestamp())
+                elif orjson is None:
+                    value = value.isoformat()
+            row_values.append(value)
+        values.append(row_values)
+    return Response(encode({'columns': list(columns), 'rows': values}), media_type='application/json')
@@ -0,0 +1,38 @@
+import asyncio
+
+"""Contains coalescing of identical concurrent calls"""
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time, sharing its result with callers of the same key that arrive while it runs"""
+
+    def __init__(self):
+        self.calls = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def run(self, key, function):
+        """Await result of function for key, starting it only if no call for key is in flight"""
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(function())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self.forget(key, done))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        # Shield so one caller being cancelled does not cancel the call for the others
+        return await asyncio.shield(task)
+
+    def forget(self, key, task):
+        """Remove finished call for key so later callers start a new one"""
+        if self.calls.get(key) is task:
+            del self.calls[key]
+
+    def stats(self):
+        """Get number of calls in flight, calls started and callers that joined a call in flight"""
+        return {
+            'in_flight': len(self.calls),
+            'leaders': self.leaders,
+            'followers': self.followers
+        }
@@ -0,0 +1,46 @@
+import heapq
+import itertools
+import logging
+
+"""Contains log of the slowest database statements"""
+
+logger = logging.getLogger(__name__)
+
+
+class SlowQueryLog:
+    """Logs statements slower than threshold seconds and keeps the max_entries slowest of them"""
+
+    def __init__(self, threshold, max_entries=20):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        # Min-heap of (seconds, sequence number, entry) so the fastest kept entry is replaced first
+        self.heap = []
+        self.sequence = itertools.count()
+        self.logged = 0
+
+    def is_slow(self, seconds):
+        """Check if a statement that took seconds should be logged"""
+        return seconds >= self.threshold
+
+    def record(self, seconds, sql, params, endpoint, plan):
+        """Log slow statement with its parameters, the endpoint it was run for and its query plan"""
+        self.logged += 1
+        logger.warning('Slow query (%.3f s) for %s: %s %r\n%s', seconds, endpoint, sql, params, '\n'.join(plan))
+        entry = {'seconds': round(seconds, 6), 'sql': sql, 'params': params, 'endpoint': endpoint, 'plan': plan}
+        item = (seconds, next(self.sequence), entry)
+        if len(self.heap) < self.max_entries:
+            heapq.heappush(self.heap, item)
+        elif self.heap and seconds > self.heap[0][0]:
+            heapq.heapreplace(self.heap, item)
+
+    def slowest(self):
+        """Get kept entries, slowest first"""
+        return [entry for seconds, sequence, entry in sorted(self.heap, reverse=True)]
+
+    def clear(self):
+        """Remove kept entries"""
+        self.heap = []
+
+    def stats(self):
+        """Get threshold, number of statements logged and the slowest ones"""
+        return {'threshold': self.threshold, 'logged': self.logged, 'slowest': self.slowest()}
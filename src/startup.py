@@ -0,0 +1,80 @@
+import time
+
+# When this module was imported, which main does before anything else
+import_started = time.perf_counter()
+
+from starlette.responses import JSONResponse
+import asyncio
+import inspect
+import logging
+
+"""Contains timed startup phases and readiness of the app for traffic"""
+
+logger = logging.getLogger(__name__)
+
+
+class Startup:
+    """Runs named startup phases in order, timing each, and tracks whether the app is ready for traffic"""
+
+    def __init__(self, phases):
+        # Names and functions of phases, coroutine functions are awaited and others run in a worker thread
+        self.phases = phases
+        self.import_seconds = None
+        self.seconds = {}
+        self.failed = None
+        self.ready = False
+        self.task = None
+
+    def imported(self):
+        """Record time taken to import the app"""
+        self.import_seconds = time.perf_counter() - import_started
+
+    async def run(self):
+        """Run phases that have not run yet, logging the time each takes, and mark the app ready once all have"""
+        for name, function in self.phases:
+            if name in self.seconds:
+                continue
+            started = time.perf_counter()
+            try:
+                if inspect.iscoroutinefunction(function):
+                    await function()
+                else:
+                    # Blocking work runs off the event loop so probes are answered meanwhile
+                    await asyncio.get_event_loop().run_in_executor(None, function)
+            except Exception:
+                self.failed = name
+                logger.exception('Startup phase %s failed', name)
+                raise
+            self.seconds[name] = time.perf_counter() - started
+            logger.info('Startup phase %s took %.3f s', name, self.seconds[name])
+        self.failed = None
+        self.ready = True
+
+    def start(self):
+        """Run phases in the background"""
+        self.task = asyncio.ensure_future(self.run())
+
+    def status(self):
+        """Get readiness, failed phase and seconds taken by import and each finished phase"""
+        return {
+            'ready': self.ready,
+            'failed': self.failed,
+            'import_seconds': round(self.import_seconds, 6) if self.import_seconds is not None else None,
+            'phases': {name: round(self.seconds[name], 6) for name, function in self.phases if name in self.seconds}
+        }
+
+
+class ReadinessMiddleware:
+    """ASGI middleware answering 503 until startup has finished, except for exempt paths such as health probes"""
+
+    def __init__(self, app, startup, exempt_paths):
+        self.app = app
+        self.startup = startup
+        self.exempt_paths = exempt_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and not self.startup.ready and scope['path'] not in self.exempt_paths:
+            response = JSONResponse({'detail': 'Server starting'}, status_code=503, headers={'Retry-After': '1'})
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
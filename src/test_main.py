@@ -3,7 +3,24 @@ from main import app
 import main
 from models.models_main import ReservationModel, UserModel
 import api_sqlite
+import facility
 import api_sqlite_test_data
+import generate_benchmark_data
+import serialization
+import report_cache
+import single_flight
+import event_hub
+import rate_limit
+import admission
+import metrics
+import slow_query_log
+import tracing
+import profiler
+import memory
+import audit
+import startup
+import marshal
+import threading
 import pytest
 import asyncio
 import re
@@ -11,14 +28,39 @@ from collections import namedtuple
 import unittest.mock as mock
 import datetime
 from databases import Database
+import sqlalchemy
 import os
 import sqlite3
+import json
+import time
+from contextlib import contextmanager
 
 # source for async mocking: https://dino.codes/posts/mocking-asynchronous-functions-python/
-# Note: set environment variable to "test" before running pytest
+# Note: tests use the in-memory database unless environment variable DB_NAME is set (see conftest.py)
 
 client = TestClient(app)
 
+# Seed database once and restore it before and after every test so tests cannot affect each other or leave data behind
+@pytest.fixture(scope='session')
+def seeded_database():
+    # Database file as it was before the tests, put back once they have finished
+    original = api_sqlite.snapshot() if api_sqlite.db_name != 'memory' else None
+    # The test client does not run startup events, so run the startup phases here
+    asyncio.get_event_loop().run_until_complete(main.startup_phases.run())
+    if api_sqlite.db_name == 'memory':
+        api_sqlite_test_data.add_test_data(api_sqlite.memory_keeper)
+    yield api_sqlite.snapshot()
+    if original is not None:
+        api_sqlite.restore(original)
+@pytest.fixture(autouse=True)
+def isolated_database(seeded_database):
+    api_sqlite.restore(seeded_database)
+    for resource in facility.resources:
+        resource.reservations.clear()
+    main.rate_limiter.reset()
+    yield
+    api_sqlite.restore(seeded_database)
+
 ### API Tests
 def test_read_root():
     response = client.get("/")
@@ -371,7 +413,7 @@ def test_api_list_holds_empty(mock_list_holds):
 
 ### Database Tests
 def delete_users_from_test_db():
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('DELETE FROM users')
     conn.commit()
@@ -385,7 +427,7 @@ async def test_db_add_user_successful():
     actual = await api_sqlite.add_user('test_id', 'test_pass', 'test_name', 'facility_manager')
     expected = True
     assert actual == expected
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT id FROM users')
     row = [row[0] for row in curs]
@@ -447,7 +489,7 @@ async def test_db_get_user():
     delete_users_from_test_db()
     await api_sqlite.add_user('test_id', 'test_pass', 'test_name', 'facility_manager')
     actual = await api_sqlite.get_user('test_id')
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT * FROM users WHERE id = "test_id"')
     expected = [row for row in curs][0]
@@ -462,7 +504,7 @@ async def test_db_list_users():
     await api_sqlite.add_user('test_id1', 'test_pass1', 'test_name1', 'facility_manager')
     await api_sqlite.add_user('test_id2', 'test_pass2', 'test_name2', 'remote facility_manager')
     actual = await api_sqlite.list_users()
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT * FROM users')
     expected = [row for row in curs]
@@ -476,7 +518,7 @@ async def test_db_remove_user():
     delete_users_from_test_db()
     await api_sqlite.add_user('test_id', 'test_pass', 'test_name', 'facility_manager')
     await api_sqlite.remove_user('test_id')
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT * FROM users')
     actual = [row for row in curs]
@@ -491,7 +533,7 @@ async def test_db_edit_user_name():
     delete_users_from_test_db()
     await api_sqlite.add_user('test_id', 'test_pass', 'test_name', 'facility_manager')
     await api_sqlite.edit_user_name('test_id', 'new_test_name')
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT name FROM users WHERE id = "test_id"')
     row = [row[0] for row in curs]
@@ -507,7 +549,7 @@ async def test_db_add_to_user_balance():
     delete_users_from_test_db()
     await api_sqlite.add_user('test_id', 'test_pass', 'test_name', 'facility_manager')
     await api_sqlite.add_to_user_balance('test_id', 50)
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT account_balance FROM users WHERE id = "test_id"')
     row = [row[0] for row in curs]
@@ -523,7 +565,7 @@ async def test_db_edit_user_activation():
     delete_users_from_test_db()
     await api_sqlite.add_user('test_id', 'test_pass', 'test_name', 'facility_manager')
     await api_sqlite.edit_user_activation('test_id', False)
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT activation FROM users WHERE id = "test_id"')
     row = [row[0] for row in curs]
@@ -560,7 +602,7 @@ async def test_db_list_reservations():
     await api_sqlite.add_reservation('uuid2', datetime.datetime(2021,10,12,12,00), 'mini microvac', 'test_customer2', 'test_reserver2', 50)
     rows = await api_sqlite.list_reservations()
     actual = [row[0] for row in rows]
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT * FROM reservations')
     expected = [row[0] for row in curs]
@@ -576,7 +618,7 @@ async def test_db_list_transactions():
     await api_sqlite.add_transaction('uuid2', datetime.datetime(2021,10,12,12,00), 'test_customer2', 50)
     rows = await api_sqlite.list_transactions()
     actual = [row[0] for row in rows]
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT * FROM transactions')
     expected = [row[0] for row in curs]
@@ -592,7 +634,7 @@ async def test_db_list_reservations_for_customer():
     await api_sqlite.add_reservation('uuid2', datetime.datetime(2021,10,12,12,00), 'mini microvac', 'test_customer2', 'test_reserver2', 50)
     rows = await api_sqlite.list_reservations_for_customer('test_customer2')
     actual = [row[0] for row in rows]
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT * FROM reservations WHERE customer == "test_customer2"')
     expected = [row[0] for row in curs]
@@ -608,7 +650,7 @@ async def test_db_list_transactions_for_customer():
     await api_sqlite.add_transaction('uuid2', datetime.datetime(2021,10,12,12,00), 'test_customer2', 50)
     rows = await api_sqlite.list_transactions_for_customer('test_customer2')
     actual = [row[0] for row in rows]
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT * FROM transactions WHERE customer == "test_customer2"')
     expected = [row[0] for row in curs]
@@ -624,7 +666,7 @@ async def test_db_get_reservation_with_serial_number():
     await api_sqlite.add_reservation('uuid2', datetime.datetime(2021,10,12,12,00), 'mini microvac', 'test_customer2', 'test_reserver2', 50)
     row = await api_sqlite.get_reservation_with_serial_number('uuid2')
     actual = row[0]
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT * FROM reservations WHERE serial_num == "uuid2"')
     expected = [row[0] for row in curs][0]
@@ -633,7 +675,7 @@ async def test_db_get_reservation_with_serial_number():
     assert actual == expected
 
 def delete_reservations_from_test_db():
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('DELETE FROM reservations')
     conn.commit()
@@ -647,7 +689,7 @@ async def test_db_add_reservation():
     actual = await api_sqlite.add_reservation("1", datetime.datetime(2021,10,11,12,00), "mini microvac", "tester1", "tester1", 50)
     expected = True
     assert actual == expected
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT serial_num FROM reservations')
     row = [row[0] for row in curs]
@@ -659,7 +701,7 @@ async def test_db_add_reservation():
     assert actual == expected
 
 def delete_transactions_from_test_db():
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('DELETE FROM transactions')
     conn.commit()
@@ -673,7 +715,7 @@ async def test_db_add_transaction():
     actual = await api_sqlite.add_transaction("1", datetime.datetime(2021,10,11,12,00), "tester1", 50)
     expected = True
     assert actual == expected
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT id FROM transactions')
     row = [row[0] for row in curs]
@@ -692,7 +734,7 @@ async def test_db_remove_reservation():
     actual = await api_sqlite.remove_reservation("1")
     expected = True
     assert actual == expected
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT serial_num FROM reservations')
     row = [row[0] for row in curs]
@@ -704,7 +746,7 @@ async def test_db_remove_reservation():
     assert actual == expected
 
 def delete_settings_from_test_db():
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('DELETE FROM settings')
     conn.commit()
@@ -729,7 +771,7 @@ async def test_db_list_holds():
     await api_sqlite.add_reservation('uuid2', datetime.datetime(2021,10,12,12,00), 'mini microvac', 'test_customer2', 'test_reserver2', 50)
     rows = await api_sqlite.list_holds()
     actual = [row[0] for row in rows]
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT * FROM reservations WHERE reserver == "test_id"')
     expected = [row[0] for row in curs]
@@ -744,7 +786,7 @@ def test_e2e_add_user_successful():
     expected = {'message': 'User added successfully'}
     assert actual.status_code == 201
     assert actual.json() == expected
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT id FROM users')
     row = [row[0] for row in curs]
@@ -761,7 +803,7 @@ def test_e2e_add_user_unsuccessful_alreadyexists():
     expected = {'detail': 'User already exists'}
     assert actual.status_code == 400
     assert actual.json() == expected
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT id FROM users')
     row = [row[0] for row in curs]
@@ -777,7 +819,7 @@ def test_e2e_add_user_unsuccessful_wrongrole():
     expected = {'detail': 'User must be one of facility manager, client or remote facility manager'}
     assert actual.status_code == 400
     assert actual.json() == expected
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT id FROM users')
     row = [row[0] for row in curs]
@@ -819,7 +861,7 @@ def test_e2e_delete_user_successful():
     expected = {'message': 'User removed successfully'}
     assert actual.status_code == 200
     assert actual.json() == expected
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT id FROM users WHERE id = "test_id"')
     row = [row[0] for row in curs]
@@ -836,7 +878,7 @@ def test_e2e_edit_user_name_successful():
     expected = {'message': 'User name edited successfully'}
     assert actual.status_code == 200
     assert actual.json() == expected
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT name FROM users WHERE id = "test_id"')
     row = [row[0] for row in curs]
@@ -869,7 +911,7 @@ def test_e2e_change_user_activation_activationsuccessful():
     expected = {'message': 'User activated successfully'}
     assert actual.status_code == 200
     assert actual.json() == expected
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT activation FROM users WHERE id = "test_id"')
     row = [row[0] for row in curs]
@@ -886,7 +928,7 @@ def test_e2e_change_user_activation_deactivationsuccessful():
     expected = {'message': 'User deactivated successfully'}
     assert actual.status_code == 200
     assert actual.json() == expected
-    conn = sqlite3.connect('test_database.db')
+    conn = api_sqlite.sqlite_connect()
     curs = conn.cursor()
     curs.execute('SELECT activation FROM users WHERE id = "test_id"')
     row = [row[0] for row in curs]
@@ -911,3 +953,1090 @@ def test_e2e_validite_invalid():
     expected = {'validity': False}
     assert actual.status_code == 200
     assert actual.json() == expected
+
+### Query budget tests
+# Maximum database work allowed for a single request to each endpoint
+QUERY_BUDGETS = {
+    # Reservation, transaction and balance writes, resource and customer rollups of the booking and the charge, and a change log entry for each row
+    'POST /reservations': {'connects': 3, 'queries': 2, 'writes': 10, 'commits': 1, 'seconds': 1.0},
+    'GET /reservations': {'connects': 1, 'queries': 1, 'writes': 0, 'commits': 0, 'seconds': 0.5},
+    'GET /transactions': {'connects': 1, 'queries': 1, 'writes': 0, 'commits': 0, 'seconds': 0.5},
+}
+
+@pytest.fixture()
+def query_budget():
+    @contextmanager
+    def within_budget(endpoint):
+        budget = QUERY_BUDGETS[endpoint]
+        start = time.perf_counter()
+        with api_sqlite.track_queries() as stats:
+            yield stats
+        elapsed = time.perf_counter() - start
+        for counter in ('connects', 'queries', 'writes', 'commits'):
+            assert getattr(stats, counter) <= budget[counter], '{} made {} {} (budget {}): {}'.format(endpoint, getattr(stats, counter), counter, budget[counter], stats.statements)
+        assert elapsed <= budget['seconds'], '{} took {:.3f}s (budget {}s)'.format(endpoint, elapsed, budget['seconds'])
+    return within_budget
+
+def next_weekday_morning(days_ahead):
+    date_time = (datetime.datetime.now() + datetime.timedelta(days=days_ahead)).replace(hour=10, minute=0, second=0, microsecond=0)
+    while date_time.weekday() > 4:
+        date_time += datetime.timedelta(days=1)
+    return date_time
+
+def test_budget_make_reservation(query_budget):
+    delete_users_from_test_db()
+    delete_reservations_from_test_db()
+    client.post("/users", json={'id': 'test_id', 'password': 'test_pass', 'name': 'test_name', 'role': 'client'})
+    client.put("/users/test_id/account_balance", json={'amount': 5000})
+    date_time_string = next_weekday_morning(3).strftime('%m-%d-%Y %H:%M')
+    with query_budget('POST /reservations') as stats:
+        actual = client.post("/reservations", json={'resource': 'workshop', 'customer': 'test_id', 'reserver': 'test_id', 'date_time_string': date_time_string})
+    assert actual.status_code == 201
+    assert stats.commits == 1
+
+def test_budget_list_reservations(query_budget):
+    with query_budget('GET /reservations'):
+        client.get("/reservations", params={'start_date_string': '01-01-2021', 'end_date_string': '01-01-2022'})
+
+def test_budget_list_transactions(query_budget):
+    with query_budget('GET /transactions'):
+        client.get("/transactions", params={'start_date_string': '01-01-2021', 'end_date_string': '01-01-2022'})
+
+### Benchmark data generator tests
+def test_generate_benchmark_data(tmp_path):
+    path = str(tmp_path / 'benchmark.db')
+    generate_benchmark_data.generate(path, num_users=20, num_reservations=500, num_facility_managers=2, hour_weights={9: 1}, refund_rate=0)
+    conn = sqlite3.connect(path)
+    curs = conn.cursor()
+    assert curs.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 20
+    assert curs.execute('SELECT COUNT(*) FROM reservations').fetchone()[0] == 500
+    assert curs.execute('SELECT COUNT(*) FROM transactions').fetchone()[0] == 500
+    assert curs.execute('SELECT COUNT(*) FROM settings').fetchone()[0] == 2
+    assert curs.execute('SELECT COUNT(*) FROM reservations WHERE customer IN ("user0", "user1")').fetchone()[0] == 0
+    hours = [row[0] for row in curs.execute('SELECT DISTINCT strftime("%H", date_time) FROM reservations')]
+    curs.close()
+    conn.close()
+    assert hours == ['09']
+
+def test_generate_benchmark_data_capacity(tmp_path):
+    path = str(tmp_path / 'benchmark.db')
+    start_date, end_date = generate_benchmark_data.generate(path, num_users=20, num_reservations=10000, num_facility_managers=2,
+                                                            start_date=datetime.date(2021, 12, 1), refund_rate=0)
+    assert start_date < datetime.date(2021, 12, 1)
+    assert end_date == datetime.date(2022, 1, 1)
+    conn = sqlite3.connect(path)
+    report = audit.audit(conn, facility.resources, [])
+    conn.close()
+    assert report['rows'] == 10000
+    assert report['violations']['count'] == 0
+
+### Streaming tests
+def add_reservations_to_test_db(num_reservations):
+    conn = api_sqlite.sqlite_connect()
+    curs = conn.cursor()
+    for i in range(num_reservations):
+        curs.execute('INSERT INTO reservations VALUES (?, ?, ?, ?, ?, ?)', ('uuid' + str(i), datetime.datetime(2021, 10, 11, 9, 0) + datetime.timedelta(minutes=30 * i), 'workshop', 'tester' + str(i % 3), 'tester', 49.5))
+        curs.execute('INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?)', ('uuid' + str(i), datetime.datetime(2021, 10, 1, 9, 0) + datetime.timedelta(minutes=i), 'tester' + str(i % 3), 49.5, 'uuid' + str(i), 'workshop'))
+    conn.commit()
+    curs.close()
+    conn.close()
+
+def test_e2e_list_reservations_stream():
+    delete_reservations_from_test_db()
+    delete_transactions_from_test_db()
+    add_reservations_to_test_db(2000)
+    expected = client.get("/reservations").json()
+    actual = client.get("/reservations", params={'stream': 'true'})
+    assert actual.status_code == 200
+    assert actual.json() == expected
+    assert len(expected) == 2000
+
+def test_e2e_list_transactions_ndjson():
+    delete_reservations_from_test_db()
+    delete_transactions_from_test_db()
+    add_reservations_to_test_db(10)
+    expected = client.get("/transactions").json()
+    actual = client.get("/transactions", headers={'Accept': 'application/x-ndjson'})
+    assert actual.status_code == 200
+    assert actual.headers['content-type'].startswith('application/x-ndjson')
+    lines = [json.loads(line) for line in actual.text.splitlines()]
+    assert {line.pop('id'): line for line in lines} == expected
+
+def test_e2e_list_users_stream_empty():
+    delete_users_from_test_db()
+    actual = client.get("/users", params={'stream': 'true'})
+    assert actual.status_code == 200
+    assert actual.json() == {}
+
+### Compact format tests
+def test_e2e_list_reservations_compact():
+    delete_reservations_from_test_db()
+    delete_transactions_from_test_db()
+    add_reservations_to_test_db(1)
+    actual = client.get("/reservations", params={'format': 'compact'})
+    expected = {'columns': ['serial_num', 'date_time', 'resource', 'customer'], 'rows': [['uuid0', '2021-10-11T09:00:00', 'workshop', 'tester0']]}
+    assert actual.status_code == 200
+    assert actual.json() == expected
+def test_e2e_list_transactions_compact_epoch():
+    delete_reservations_from_test_db()
+    delete_transactions_from_test_db()
+    add_reservations_to_test_db(1)
+    actual = client.get("/transactions", params={'format': 'compact', 'timestamps': 'epoch'})
+    expected = {'columns': ['id', 'date_time', 'customer', 'amount'], 'rows': [['uuid0', int(datetime.datetime(2021, 10, 1, 9, 0).timestamp()), 'tester0', 49.5]]}
+    assert actual.status_code == 200
+    assert actual.json() == expected
+def test_compact_response_epoch_is_unix_time():
+    trans = namedtuple('trans', ['id', 'date_time', 'customer', 'amount'])
+    trans1 = trans('1', datetime.datetime(2021,10,11,12,00), 'tester1', 50.5)
+    try:
+        with mock.patch.dict(os.environ, {'TZ': 'America/New_York'}):
+            time.tzset()
+            actual = serialization.compact_response([trans1], main.TRANSACTION_COLUMNS, timestamps='epoch')
+    finally:
+        time.tzset()
+    assert json.loads(actual.body)['rows'] == [['1', 1633968000, 'tester1', 50.5]]
+def test_api_list_users_invalid_format():
+    actual = client.get("/users", params={'format': 'xml'})
+    expected = {'detail': 'Format must be one of "default" or "compact"'}
+    assert actual.status_code == 400
+    assert actual.json() == expected
+def test_compact_response_without_orjson():
+    trans = namedtuple('trans', ['id', 'date_time', 'customer', 'amount'])
+    trans1 = trans('1', datetime.datetime(2021,10,11,12,00), 'tester1', 50.5)
+    with mock.patch('serialization.orjson', None):
+        actual = serialization.compact_response([trans1], main.TRANSACTION_COLUMNS)
+    assert json.loads(actual.body) == {'columns': ['id', 'date_time', 'customer', 'amount'], 'rows': [['1', '2021-10-11T12:00:00', 'tester1', 50.5]]}
+
+### Conditional GET tests
+def test_e2e_list_users_not_modified():
+    delete_users_from_test_db()
+    client.post("/users", json={'id': 'test_id1', 'password': 'test_pass1', 'name': 'test_name1', 'role': 'client'})
+    first = client.get("/users")
+    etag = first.headers['ETag']
+    with api_sqlite.track_queries() as stats:
+        actual = client.get("/users", headers={'If-None-Match': etag})
+    assert actual.status_code == 304
+    assert actual.headers['ETag'] == etag
+    assert stats.queries == 0 and stats.connects == 0
+    # Different query parameters and media types get different ETags
+    assert client.get("/users", params={'format': 'compact'}).headers['ETag'] != etag
+    # Writes change the ETag
+    client.put("/users/test_id1/name", json={'name': 'new_test_name'})
+    actual = client.get("/users", headers={'If-None-Match': etag})
+    assert actual.status_code == 200
+    assert actual.headers['ETag'] != etag
+    assert actual.json()['test_id1']['name'] == 'new_test_name'
+
+@pytest.mark.asyncio
+async def test_db_table_versions():
+    before = dict(api_sqlite.table_versions)
+    await api_sqlite.add_reservation('uuid1', datetime.datetime(2021,10,11,12,00), 'mini microvac', 'test_customer1', 'test_reserver1', 50)
+    await api_sqlite.add_transaction('uuid1', datetime.datetime(2021,10,11,12,00), 'test_customer1', 50)
+    assert api_sqlite.table_versions['reservations'] == before['reservations'] + 1
+    assert api_sqlite.table_versions['transactions'] == before['transactions'] + 1
+    assert api_sqlite.table_versions['users'] == before['users']
+
+def test_etag_matches():
+    assert main.etag_matches('"a", W/"b"', '"b"')
+    assert main.etag_matches('*', '"b"')
+    assert not main.etag_matches('"a"', '"b"')
+    assert not main.etag_matches(None, '"b"')
+
+### Report cache tests
+def test_e2e_list_transactions_cached():
+    delete_transactions_from_test_db()
+    add_reservations_to_test_db(5)
+    params = {'start_date_string': '09-30-2021', 'end_date_string': '10-31-2021'}
+    first = client.get("/transactions", params=params)
+    assert first.headers['X-Cache'] == 'miss'
+    with api_sqlite.track_queries() as stats:
+        second = client.get("/transactions", params=params)
+    assert second.headers['X-Cache'] == 'hit'
+    assert second.json() == first.json()
+    assert stats.queries == 0
+    # Transactions outside the range, or for other customers of a customer report, leave the entry in place
+    asyncio.get_event_loop().run_until_complete(api_sqlite.add_transaction('outside', datetime.datetime(2021, 12, 1, 9, 0), 'tester0', 10))
+    assert client.get("/transactions", params=params).headers['X-Cache'] == 'hit'
+    asyncio.get_event_loop().run_until_complete(api_sqlite.add_transaction('bill', datetime.datetime(2021, 10, 4, 9, 0), 'bill', 10))
+    assert client.get("/transactions/bill", params=params).headers['X-Cache'] == 'miss'
+    asyncio.get_event_loop().run_until_complete(api_sqlite.add_transaction('other', datetime.datetime(2021, 10, 5, 9, 0), 'marie', 10))
+    assert client.get("/transactions/bill", params=params).headers['X-Cache'] == 'hit'
+    # Transactions inside the range invalidate the entry
+    actual = client.get("/transactions", params=params)
+    assert actual.headers['X-Cache'] == 'miss'
+    assert 'other' in actual.json()
+
+def test_report_cache_evicts_least_recently_used():
+    cache = report_cache.ReportCache(max_entries=2, max_bytes=10)
+    start, end = datetime.datetime(2021, 1, 1), datetime.datetime(2022, 1, 1)
+    cache.put('a', report_cache.CacheEntry(b'aaaa', {}, 'reservations', None, start, end), cache.generation)
+    cache.put('b', report_cache.CacheEntry(b'bbbb', {}, 'reservations', None, start, end), cache.generation)
+    cache.get('a')
+    cache.put('c', report_cache.CacheEntry(b'cccc', {}, 'transactions', None, start, end), cache.generation)
+    assert list(cache.entries) == ['a', 'c']
+    cache.invalidate('reservations', datetime.datetime(2021, 6, 1), 'tester1')
+    assert list(cache.entries) == ['c']
+    assert cache.stats() == {'entries': 1, 'bytes': 4, 'max_entries': 2, 'max_bytes': 10, 'hits': 1, 'misses': 0, 'evictions': 1, 'invalidations': 1}
+    # Entries computed while data changed are not stored
+    generation = cache.generation
+    cache.invalidate('transactions')
+    cache.put('d', report_cache.CacheEntry(b'dddd', {}, 'transactions', None, start, end), generation)
+    assert list(cache.entries) == []
+
+### Single-flight tests
+async def asgi_get(path, query_string=b''):
+    """Send GET request directly to the app and return status code and body"""
+    scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http', 'server': ('testserver', 80), 'client': ('testclient', 50000),
+             'root_path': '', 'path': path, 'raw_path': path.encode(), 'query_string': query_string, 'headers': [(b'host', b'testserver')]}
+    messages = []
+    requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+    async def receive():
+        # Client stays connected after sending the request
+        if requests:
+            return requests.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+def test_e2e_coalesce_concurrent_identical_requests():
+    async def get_concurrently():
+        return await asyncio.gather(*[asgi_get('/settings/client_logins_allowed') for i in range(300)])
+    followers = main.single_flight.followers
+    with api_sqlite.track_queries() as stats:
+        responses = asyncio.get_event_loop().run_until_complete(get_concurrently())
+    assert set(responses) == {(200, b'{"value":true}')}
+    # Setting is checked and read once for all requests
+    assert stats.queries == 2
+    assert main.single_flight.followers - followers == 299
+    assert main.single_flight.calls == {}
+
+def test_e2e_coalesce_only_configured_routes():
+    async def get_concurrently():
+        return await asyncio.gather(*[asgi_get('/settings/client_logins_allowed') for i in range(10)])
+    with mock.patch('main.COALESCED_ROUTES', {'/reservations'}):
+        with api_sqlite.track_queries() as stats:
+            responses = asyncio.get_event_loop().run_until_complete(get_concurrently())
+    assert set(responses) == {(200, b'{"value":true}')}
+    assert stats.queries == 20
+
+def test_single_flight_shares_call_per_key():
+    flight = single_flight.SingleFlight()
+    calls = []
+
+    async def read(value):
+        calls.append(value)
+        await asyncio.sleep(0)
+        return value
+
+    async def run():
+        return await asyncio.gather(*[flight.run(key, lambda key=key: read(key)) for key in ['a'] * 5 + ['b']])
+    assert asyncio.get_event_loop().run_until_complete(run()) == ['a'] * 5 + ['b']
+    assert calls == ['a', 'b']
+    assert flight.stats() == {'in_flight': 0, 'leaders': 2, 'followers': 4}
+    # Calls finished before are not reused
+    asyncio.get_event_loop().run_until_complete(run())
+    assert calls == ['a', 'b', 'a', 'b']
+
+### Batch tests
+def batch_operations(date_time_string, last_customer):
+    return [
+        {'method': 'POST', 'path': '/users', 'body': {'id': 'test_id', 'password': 'test_pass', 'name': 'test_name', 'role': 'client'}},
+        {'method': 'PUT', 'path': '/users/test_id/account_balance', 'body': {'amount': 5000}},
+        {'method': 'POST', 'path': '/reservations', 'body': {'resource': 'irradiator', 'customer': 'test_id', 'reserver': 'test_id', 'date_time_string': date_time_string}},
+        {'method': 'GET', 'path': '/users/' + last_customer}
+    ]
+
+def test_e2e_batch():
+    delete_users_from_test_db()
+    delete_reservations_from_test_db()
+    date_time_string = next_weekday_morning(3).strftime('%m-%d-%Y %H:%M')
+    actual = client.post("/batch", json={'operations': batch_operations(date_time_string, 'unknown_id')})
+    assert actual.status_code == 200
+    assert [result['status'] for result in actual.json()['results']] == [201, 200, 201, 400]
+    assert actual.json()['results'][3]['body'] == {'detail': 'User ID invalid'}
+    # Operations before and after the failure are kept without atomic
+    assert client.get("/users/test_id").json()['account balance'] == 5000 - 1100
+
+def test_e2e_batch_atomic_rolled_back():
+    delete_users_from_test_db()
+    delete_reservations_from_test_db()
+    date_time = next_weekday_morning(3)
+    versions = dict(api_sqlite.table_versions)
+    actual = client.post("/batch", json={'operations': batch_operations(date_time.strftime('%m-%d-%Y %H:%M'), 'unknown_id'), 'atomic': True})
+    assert actual.json()['committed'] is False
+    assert [result['status'] for result in actual.json()['results']] == [201, 200, 201, 400]
+    assert client.get("/users/test_id").status_code == 400
+    serial_num = re.search('serial number: ([0-9a-f-]{36})', actual.json()['results'][2]['body']['message']).group(1)
+    assert client.get("/reservations/serial_num/" + serial_num).status_code == 404
+    assert api_sqlite.table_versions == versions
+    # Slot claimed by rolled back reservation is free again
+    assert all(date_time not in resource.reservations for resource in facility.resources)
+
+def test_e2e_batch_atomic_committed():
+    delete_users_from_test_db()
+    delete_reservations_from_test_db()
+    versions = dict(api_sqlite.table_versions)
+    with api_sqlite.track_queries() as stats:
+        actual = client.post("/batch", json={'operations': batch_operations(next_weekday_morning(3).strftime('%m-%d-%Y %H:%M'), 'test_id'), 'atomic': True})
+    assert actual.json()['committed'] is True
+    assert [result['status'] for result in actual.json()['results']] == [201, 200, 201, 200]
+    assert actual.json()['results'][3]['body']['account balance'] == 5000 - 1100
+    assert stats.commits == 1
+    assert api_sqlite.table_versions['users'] > versions['users']
+    assert api_sqlite.table_versions['reservations'] > versions['reservations']
+
+def test_e2e_batch_invalid():
+    actual = client.post("/batch", json={'operations': [{'method': 'POST', 'path': '/batch', 'body': {'operations': []}}]})
+    assert actual.status_code == 400
+    with mock.patch('main.MAX_BATCH_OPERATIONS', 1):
+        actual = client.post("/batch", json={'operations': [{'method': 'GET', 'path': '/'}] * 2})
+    assert actual.status_code == 413
+
+### Aggregated report tests
+def add_report_data_to_test_db():
+    conn = api_sqlite.sqlite_connect()
+    curs = conn.cursor()
+    curs.execute('DELETE FROM reservations')
+    curs.execute('DELETE FROM transactions')
+    rows = [
+        ('r1', datetime.datetime(2021, 10, 4, 9, 0), 'workshop', 'bill', 49.5),
+        ('r2', datetime.datetime(2021, 10, 4, 10, 0), 'irradiator', 'bill', 1100),
+        ('r3', datetime.datetime(2021, 10, 6, 9, 0), 'workshop', 'marie', 49.5),
+        ('r4', datetime.datetime(2021, 11, 2, 9, 0), 'workshop', 'marie', 37.13)
+    ]
+    for serial_num, date_time, resource, customer, cost in rows:
+        curs.execute('INSERT INTO reservations (serial_num, date_time, resource, customer, reserver, cost) VALUES (?, ?, ?, ?, ?, ?)', (serial_num, date_time, resource, customer, customer, cost))
+        curs.execute('INSERT INTO transactions (id, date_time, customer, amount, reservation_serial_num, resource) VALUES (?, ?, ?, ?, ?, ?)', ('t' + serial_num, date_time, customer, cost, serial_num, resource))
+    # Refund of half the irradiator reservation
+    curs.execute('INSERT INTO transactions (id, date_time, customer, amount, reservation_serial_num, resource) VALUES (?, ?, ?, ?, ?, ?)', ('refund', datetime.datetime(2021, 10, 5, 9, 0), 'bill', -550, 'r2', 'irradiator'))
+    conn.commit()
+    api_sqlite.rebuild_rollups(conn)
+    curs.close()
+    conn.close()
+
+def test_e2e_revenue_report_by_week_and_resource():
+    add_report_data_to_test_db()
+    actual = client.get("/reports/revenue", params={'granularity': 'week', 'group_by': 'resource'})
+    assert actual.status_code == 200
+    assert actual.json() == {'granularity': 'week', 'rows': [
+        {'period': '10-04-2021', 'resource': 'irradiator', 'count': 2, 'total': 550.0, 'average': 275.0},
+        {'period': '10-04-2021', 'resource': 'workshop', 'count': 2, 'total': 99.0, 'average': 49.5},
+        {'period': '11-01-2021', 'resource': 'workshop', 'count': 1, 'total': 37.13, 'average': 37.13}
+    ]}
+
+def test_e2e_usage_report_by_month_and_customer():
+    add_report_data_to_test_db()
+    actual = client.get("/reports/usage", params={'granularity': 'month', 'group_by': 'customer', 'start_date_string': '10-03-2021', 'end_date_string': '12-31-2021'})
+    assert actual.json() == {'granularity': 'month', 'rows': [
+        {'period': '10-2021', 'customer': 'bill', 'count': 2, 'total': 1149.5, 'average': 574.75, 'hours': 1.0},
+        {'period': '10-2021', 'customer': 'marie', 'count': 1, 'total': 49.5, 'average': 49.5, 'hours': 0.5},
+        {'period': '11-2021', 'customer': 'marie', 'count': 1, 'total': 37.13, 'average': 37.13, 'hours': 0.5}
+    ]}
+    actual = client.get("/reports/usage", params={'start_date_string': '10-03-2021', 'end_date_string': '10-05-2021'})
+    assert actual.json()['rows'] == [{'period': '10-04-2021', 'count': 2, 'total': 1149.5, 'average': 574.75, 'hours': 1.0}]
+
+def test_e2e_report_invalid():
+    assert client.get("/reports/revenue", params={'granularity': 'year'}).status_code == 400
+    assert client.get("/reports/usage", params={'group_by': 'reserver'}).status_code == 400
+
+def test_db_report_query_uses_index():
+    conn = api_sqlite.sqlite_connect()
+    plan = conn.execute("EXPLAIN QUERY PLAN SELECT date(date_time, 'weekday 0', '-6 days'), resource, count(*), sum(amount) FROM transactions WHERE date_time >= '2021-01-01' AND date_time < '2022-01-01' GROUP BY 1, 2").fetchall()
+    conn.close()
+    assert 'COVERING INDEX ix_transactions_report' in str(plan)
+
+def test_db_migrate_adds_transaction_links():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE transactions (id VARCHAR(36) NOT NULL, date_time DATETIME, customer VARCHAR(50), amount FLOAT, PRIMARY KEY (id))')
+    conn.execute('CREATE TABLE reservations (serial_num VARCHAR(36) NOT NULL, date_time DATETIME, resource VARCHAR(50), customer VARCHAR(50), reserver VARCHAR(50), cost FLOAT, PRIMARY KEY (serial_num))')
+    conn.execute('CREATE TABLE users (id VARCHAR(50) NOT NULL, password_hash VARCHAR(128), password_salt VARCHAR(36), name VARCHAR(50), account_balance FLOAT, activation BOOLEAN, role VARCHAR(50), PRIMARY KEY (id))')
+    conn.execute('CREATE TABLE settings (setting VARCHAR(50) NOT NULL, value BOOLEAN, PRIMARY KEY (setting))')
+    conn.execute("INSERT INTO transactions VALUES ('t1', '2021-10-04 09:00:00.000000', 'bill', 49.5)")
+    conn.commit()
+    # New tables are created by create_all before migrating
+    api_sqlite.metadata.create_all(sqlalchemy.create_engine('sqlite://', creator=lambda: conn))
+    api_sqlite.migrate(conn)
+    api_sqlite.migrate(conn)
+    assert [row[1] for row in conn.execute('PRAGMA table_info(transactions)')][-2:] == ['reservation_serial_num', 'resource']
+    assert [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_%' ORDER BY name")] == ['ix_changes_row', 'ix_idempotency_keys_created', 'ix_reservations_report', 'ix_transactions_customer', 'ix_transactions_report']
+    assert conn.execute('SELECT date, customer, charges, charge_amount FROM customer_daily').fetchall() == [('2021-10-04', 'bill', 1, 49.5)]
+    conn.close()
+
+### Rollup tests
+def rollup_rows(conn):
+    rows = []
+    for table in ('resource_daily', 'customer_daily'):
+        rows += [tuple(round(value, 2) if isinstance(value, float) else value for value in row) for row in conn.execute('SELECT * FROM ' + table + ' WHERE bookings != 0 OR charges != 0 OR refunds != 0 ORDER BY 1, 2')]
+    return rows
+
+def test_e2e_rollups_maintained_by_writes():
+    delete_users_from_test_db()
+    delete_reservations_from_test_db()
+    delete_transactions_from_test_db()
+    conn = api_sqlite.sqlite_connect()
+    api_sqlite.rebuild_rollups(conn)
+    conn.close()
+    client.post("/users", json={'id': 'test_id', 'password': 'test_pass', 'name': 'test_name', 'role': 'client'})
+    client.put("/users/test_id/account_balance", json={'amount': 20000})
+    first = next_weekday_morning(3)
+    serial_nums = []
+    for date_time, resource in ((first, 'workshop'), (first + datetime.timedelta(hours=1), 'irradiator'), (next_weekday_morning(17), 'polymer extruder')):
+        actual = client.post("/reservations", json={'resource': resource, 'customer': 'test_id', 'reserver': 'test_id', 'date_time_string': date_time.strftime('%m-%d-%Y %H:%M')})
+        assert actual.status_code == 201
+        serial_nums.append(re.search('serial number: ([0-9a-f-]{36})', actual.json()['message']).group(1))
+    client.put("/reservations", json={'serial_num': serial_nums[0], 'resource': 'workshop', 'customer': 'test_id', 'reserver': 'test_id', 'date_time_string': (first + datetime.timedelta(hours=3)).strftime('%m-%d-%Y %H:%M')})
+    client.delete("/reservations", params={'customer': 'test_id', 'serial_num': serial_nums[2]})
+    conn = api_sqlite.sqlite_connect()
+    maintained = rollup_rows(conn)
+    api_sqlite.rebuild_rollups(conn)
+    rebuilt = rollup_rows(conn)
+    conn.close()
+    assert maintained == rebuilt
+    assert ('test_id', 2) in [(row[1], row[2]) for row in maintained if row[0] == first.strftime('%Y-%m-%d')]
+
+def test_e2e_rollup_reports_match_raw_aggregates():
+    add_report_data_to_test_db()
+    for path in ('/reports/revenue', '/reports/usage'):
+        for granularity in ('day', 'week', 'month'):
+            for group_by in ('resource', 'customer', None):
+                params = {'granularity': granularity, 'group_by': group_by} if group_by else {'granularity': granularity}
+                rollup = client.get(path, params=params).json()['rows']
+                rows = asyncio.get_event_loop().run_until_complete(api_sqlite.aggregate(
+                    api_sqlite.metadata.tables[main.AGGREGATE_REPORTS[path][0]], main.AGGREGATE_REPORTS[path][1], granularity, [group_by] if group_by else [],
+                    *main.date_range_bounds(datetime.date(2021, 1, 1), datetime.date(2022, 1, 1))))
+                assert [(row['count'], row['total']) for row in rollup] == [(row.count, round(row.total, 2)) for row in rows]
+
+### Utilization tests
+Row = namedtuple('Row', ['date_time', 'resource', 'customer'])
+
+def test_utilization():
+    monday = datetime.datetime(2021, 10, 4, 9, 0)
+    saturday = datetime.datetime(2021, 10, 9, 10, 0)
+    rows = [Row(monday, 'workshop', 'bill'), Row(monday, 'workshop', 'marie'), Row(saturday, 'irradiator', 'bill')]
+    facility.resources[0].reservations[monday] = 'bill'
+    facility.resources[1].reservations[monday] = 'marie'
+    # Claim left behind by a cancelled reservation is not counted
+    facility.resources[2].reservations[monday] = 'alice'
+    facility.resources[16].reservations[saturday] = 'bill'
+    type_rows, unit_rows = facility.utilization(rows, datetime.date(2021, 10, 4), datetime.date(2021, 10, 11), 'week')
+    assert type_rows[0] == {'period': datetime.date(2021, 10, 4), 'resource': 'workshop', 'booked_slots': 2, 'available_slots': 15 * 92, 'utilization': 0.1}
+    assert type_rows[2] == {'period': datetime.date(2021, 10, 4), 'resource': 'irradiator', 'booked_slots': 1, 'available_slots': 2 * 92, 'utilization': 0.5}
+    assert [row['booked_slots'] for row in unit_rows] == [1, 1, 0] + [0] * 13 + [1] + [0] * 6
+    type_rows, unit_rows = facility.utilization(rows, datetime.date(2021, 10, 9), datetime.date(2021, 10, 11))
+    assert [row['available_slots'] for row in unit_rows if row['unit'] == 16] == [12, 0]
+    assert unit_rows[16] == {'period': datetime.date(2021, 10, 9), 'resource': 'irradiator', 'unit': 16, 'booked_slots': 1, 'available_slots': 12, 'utilization': 8.3}
+
+def test_e2e_utilization_report():
+    add_report_data_to_test_db()
+    actual = client.get("/reports/utilization", params={'start_date_string': '10-03-2021', 'end_date_string': '10-07-2021'})
+    assert actual.status_code == 200
+    workshop = [row for row in actual.json()['resources'] if row['resource'] == 'workshop']
+    assert workshop == [
+        {'period': '10-04-2021', 'resource': 'workshop', 'booked_slots': 1, 'available_slots': 240, 'utilization': 0.4},
+        {'period': '10-05-2021', 'resource': 'workshop', 'booked_slots': 0, 'available_slots': 240, 'utilization': 0.0},
+        {'period': '10-06-2021', 'resource': 'workshop', 'booked_slots': 1, 'available_slots': 240, 'utilization': 0.4}
+    ]
+    assert len(actual.json()['units']) == 3 * len(facility.resources)
+    assert client.get("/reports/utilization", params={'granularity': 'month'}).status_code == 400
+
+### Statement tests
+def add_statement_data_to_test_db():
+    conn = api_sqlite.sqlite_connect()
+    curs = conn.cursor()
+    curs.execute('DELETE FROM transactions')
+    curs.execute('UPDATE users SET account_balance = 1000 WHERE id = "bill"')
+    amounts = [('t1', datetime.datetime(2021, 9, 1, 9, 0), 100), ('t2', datetime.datetime(2021, 10, 4, 9, 0), 200), ('t3', datetime.datetime(2021, 10, 4, 9, 0), -50),
+               ('t4', datetime.datetime(2021, 10, 20, 9, 0), 300), ('t5', datetime.datetime(2021, 11, 5, 9, 0), 25)]
+    for id, date_time, amount in amounts:
+        curs.execute('INSERT INTO transactions (id, date_time, customer, amount) VALUES (?, ?, ?, ?)', (id, date_time, 'bill', amount))
+    curs.execute('INSERT INTO transactions (id, date_time, customer, amount) VALUES (?, ?, ?, ?)', ('other', datetime.datetime(2021, 10, 5, 9, 0), 'marie', 999))
+    conn.commit()
+    curs.close()
+    conn.close()
+
+def test_e2e_statement():
+    add_statement_data_to_test_db()
+    params = {'start_date_string': '09-30-2021', 'end_date_string': '11-01-2021'}
+    actual = client.get("/transactions/bill/statement", params=params)
+    assert actual.status_code == 200
+    # Current balance 1000 after t5 (25) was charged, so 1025 before it and 1475 before t2 to t4
+    assert actual.json()['opening_balance'] == 1475
+    assert actual.json()['closing_balance'] == 1025
+    assert [(transaction['id'], transaction['amount'], transaction['balance']) for transaction in actual.json()['transactions']] == [('t2', 200, 1275), ('t3', -50, 1325), ('t4', 300, 1025)]
+    assert actual.json()['next'] is None
+
+def test_e2e_statement_pages():
+    add_statement_data_to_test_db()
+    params = {'start_date_string': '01-01-2021', 'end_date_string': '01-01-2022', 'limit': 2}
+    first = client.get("/transactions/bill/statement", params=params).json()
+    assert [transaction['id'] for transaction in first['transactions']] == ['t1', 't2']
+    assert first['next'] == 't2'
+    second = client.get("/transactions/bill/statement", params=dict(params, after=first['next'])).json()
+    assert [(transaction['id'], transaction['balance']) for transaction in second['transactions']] == [('t3', 1325), ('t4', 1025)]
+    third = client.get("/transactions/bill/statement", params=dict(params, after=second['next'])).json()
+    assert [(transaction['id'], transaction['balance']) for transaction in third['transactions']] == [('t5', 1000)]
+    assert third['next'] is None
+    assert third['opening_balance'] == first['opening_balance'] == 1575
+
+def test_e2e_statement_invalid():
+    assert client.get("/transactions/unknown_id/statement").status_code == 400
+    assert client.get("/transactions/bill/statement", params={'limit': 0}).status_code == 400
+
+def test_db_statement_uses_customer_index():
+    conn = api_sqlite.sqlite_connect()
+    plan = conn.execute("EXPLAIN QUERY PLAN SELECT sum(amount) FROM transactions WHERE customer = 'bill' AND date_time >= '2021-01-01'").fetchall()
+    conn.close()
+    assert 'COVERING INDEX ix_transactions_customer' in str(plan)
+
+### Event tests
+def test_event_hub_fan_out():
+    hub = event_hub.EventHub(max_queued=2)
+    subscriptions = [hub.subscribe() for i in range(2000)]
+    claims_only = hub.subscribe({'claim'})
+    hub.publish('setting', {'setting': 'client_logins_allowed', 'value': False})
+    messages = [subscription.queue.get_nowait() for subscription in subscriptions]
+    assert messages[0] == b'event: setting\ndata: {"setting":"client_logins_allowed","value":false}\n\n'
+    # Message is encoded once and shared by every subscriber
+    assert all(message is messages[0] for message in messages)
+    assert claims_only.queue.empty()
+    # Subscriber that does not keep up is dropped with an end of stream marker
+    for i in range(3):
+        hub.publish('claim', {'unit': i})
+    assert claims_only.queue.get_nowait() is None
+    assert hub.stats() == {'subscribers': 0, 'published': 4, 'dropped': 2001}
+
+async def asgi_stream(path, query_string, until):
+    """Read response of GET request sent directly to the app until a message contains until, then disconnect"""
+    scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http', 'server': ('testserver', 80), 'client': ('testclient', 50000),
+             'root_path': '', 'path': path, 'raw_path': path.encode(), 'query_string': query_string, 'headers': [(b'host', b'testserver')]}
+    requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+    disconnected = asyncio.Event()
+    body = []
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        body.append(message.get('body', b''))
+        if until in message.get('body', b''):
+            disconnected.set()
+
+    await asyncio.wait_for(app(scope, receive, send), 5)
+    return b''.join(body).decode('utf-8')
+
+def test_e2e_events():
+    async def subscribe_and_change():
+        stream = asyncio.ensure_future(asgi_stream('/events', b'', b'cancellation'))
+        while not main.event_hub.subscriptions:
+            await asyncio.sleep(0.01)
+        await main.set_setting('client_logins_allowed', main.SettingValueModel(value=False))
+        facility.reservation_valid('workshop', 'bill', next_weekday_morning(3))
+        await main.cancel_reservation('bill', 'acf2ff21-7290-44f8-a0f0-39459356ceaa')
+        return await stream
+    facility.resources[0].reservations[datetime.datetime(2021, 5, 13, 9, 0)] = 'bill'
+    events = asyncio.get_event_loop().run_until_complete(subscribe_and_change()).split('\n\n')
+    assert events[0] == 'event: setting\ndata: {"setting":"client_logins_allowed","value":true}'
+    assert events[2] == 'event: setting\ndata: {"setting":"client_logins_allowed","value":false}'
+    assert events[3] == 'event: claim\ndata: {"resource":"workshop","unit":0,"date":"' + next_weekday_morning(3).strftime('%m-%d-%Y %H:%M') + '"}'
+    assert events[4] == 'event: release\ndata: {"resource":"workshop","unit":0,"date":"05-13-2021 09:00"}'
+    assert events[5].startswith('event: cancellation\ndata: {"serial_num":"acf2ff21-7290-44f8-a0f0-39459356ceaa"')
+    # Subscriber is removed once the client disconnects
+    assert main.event_hub.subscriptions == set()
+
+def test_e2e_events_invalid_type():
+    assert client.get("/events", params={'types': 'setting,unknown'}).status_code == 400
+
+### Change log tests
+def test_e2e_changes():
+    since = asyncio.get_event_loop().run_until_complete(api_sqlite.last_change())
+    client.post("/users", json={'id': 'changer', 'password': 'secret', 'name': 'Changer', 'role': 'client'})
+    client.put("/users/changer/name", json={'name': 'Renamed'})
+    client.put("/users/changer/activation", json={'activation': False})
+    client.delete("/users/changer")
+    response = client.get("/changes", params={'since': since, 'limit': 3}).json()
+    assert [(change['table'], change['operation'], change['key']) for change in response['changes']] == [('users', 'insert', 'changer'), ('users', 'update', 'changer'), ('users', 'update', 'changer')]
+    assert response['changes'][0]['data'] == {'id': 'changer', 'name': 'Changer', 'account_balance': 0, 'activation': True, 'role': 'client'}
+    assert response['changes'][2]['data']['activation'] is False
+    assert response['next'] == response['changes'][-1]['cursor'] == since + 3
+    response = client.get("/changes", params={'since': response['next']}).json()
+    assert response['changes'] == [dict(response['changes'][0], table='users', operation='delete', key='changer', data=None)]
+    assert client.get("/changes", params={'since': response['next']}).json() == {'changes': [], 'next': response['next']}
+
+def test_e2e_changes_of_reservation():
+    delete_users_from_test_db()
+    delete_reservations_from_test_db()
+    client.post("/users", json={'id': 'test_id', 'password': 'test_pass', 'name': 'test_name', 'role': 'client'})
+    client.put("/users/test_id/account_balance", json={'amount': 5000})
+    since = asyncio.get_event_loop().run_until_complete(api_sqlite.last_change())
+    actual = client.post("/reservations", json={'resource': 'workshop', 'customer': 'test_id', 'reserver': 'test_id', 'date_time_string': next_weekday_morning(3).strftime('%m-%d-%Y %H:%M')})
+    assert actual.status_code == 201
+    changes = client.get("/changes", params={'since': since}).json()['changes']
+    assert [(change['table'], change['operation']) for change in changes] == [('reservations', 'insert'), ('transactions', 'insert'), ('users', 'update')]
+    assert changes[1]['data']['reservation_serial_num'] == changes[0]['key']
+    assert changes[2]['data']['account_balance'] == client.get("/users/test_id").json()['account balance']
+
+def test_e2e_changes_compact():
+    since = asyncio.get_event_loop().run_until_complete(api_sqlite.last_change())
+    for name in ('First', 'Second', 'Third'):
+        client.put("/users/bill/name", json={'name': name})
+    client.put("/users/marie/name", json={'name': 'Marie'})
+    # Entries not older than before are kept even if superseded
+    assert client.post("/admin/changes/compact", params={'before': since + 2}).json() == {'before': since + 2, 'removed': 1}
+    changes = client.get("/changes", params={'since': since}).json()['changes']
+    assert [(change['key'], change['data']['name']) for change in changes] == [('bill', 'Second'), ('bill', 'Third'), ('marie', 'Marie')]
+    assert client.post("/admin/changes/compact", params={'before': since + 5}).json()['removed'] == 1
+    changes = client.get("/changes", params={'since': since}).json()['changes']
+    assert [(change['cursor'], change['data']['name']) for change in changes] == [(since + 3, 'Third'), (since + 4, 'Marie')]
+
+def test_e2e_changes_invalid_limit():
+    assert client.get("/changes", params={'limit': 0}).status_code == 400
+
+### Idempotency key tests
+def test_e2e_idempotent_reservation():
+    delete_users_from_test_db()
+    delete_reservations_from_test_db()
+    client.post("/users", json={'id': 'test_id', 'password': 'test_pass', 'name': 'test_name', 'role': 'client'})
+    client.put("/users/test_id/account_balance", json={'amount': 5000})
+    reservation = {'resource': 'workshop', 'customer': 'test_id', 'reserver': 'test_id', 'date_time_string': next_weekday_morning(3).strftime('%m-%d-%Y %H:%M')}
+    first = client.post("/reservations", json=reservation, headers={'Idempotency-Key': 'reservation-1'})
+    assert first.status_code == 201
+    assert 'idempotent-replayed' not in first.headers
+    balance = client.get("/users/test_id").json()['account balance']
+    retry = client.post("/reservations", json=reservation, headers={'Idempotency-Key': 'reservation-1'})
+    assert retry.status_code == 201
+    assert retry.headers['idempotent-replayed'] == 'true'
+    assert retry.json() == first.json()
+    assert client.get("/users/test_id").json()['account balance'] == balance
+    assert len(client.get("/reservations/test_id", params={'start_date_string': '01-01-2021', 'end_date_string': '01-01-2100'}).json()) == 1
+    # Same key for a different request is rejected, without a key the request runs again
+    assert client.post("/reservations", json=dict(reservation, resource='irradiator'), headers={'Idempotency-Key': 'reservation-1'}).status_code == 422
+    assert client.post("/reservations", json=reservation).status_code == 201
+    assert len(client.get("/reservations/test_id", params={'start_date_string': '01-01-2021', 'end_date_string': '01-01-2100'}).json()) == 2
+
+def test_e2e_idempotent_funds():
+    balance = client.get("/users/bill").json()['account balance']
+    for i in range(2):
+        response = client.put("/users/bill/account_balance", json={'amount': 100}, headers={'Idempotency-Key': 'funds-1'})
+        assert response.json()['message'].endswith(str(balance + 100))
+    assert client.get("/users/bill").json()['account balance'] == balance + 100
+    # Stored responses expire
+    with mock.patch.object(main, 'IDEMPOTENCY_KEY_TTL', 0):
+        client.put("/users/bill/account_balance", json={'amount': 100}, headers={'Idempotency-Key': 'funds-1'})
+    assert client.get("/users/bill").json()['account balance'] == balance + 200
+
+def test_e2e_idempotency_key_in_flight():
+    main.idempotency_keys_in_flight.add('funds-2')
+    try:
+        assert client.put("/users/bill/account_balance", json={'amount': 100}, headers={'Idempotency-Key': 'funds-2'}).status_code == 409
+    finally:
+        main.idempotency_keys_in_flight.discard('funds-2')
+    assert client.put("/users/bill/account_balance", json={'amount': 100}, headers={'Idempotency-Key': 'x' * 256}).status_code == 400
+
+### Rate limit tests
+def test_rate_limiter_token_buckets():
+    now = [0]
+    limiter = rate_limit.RateLimiter({'writes': (0.5, 2)}, max_buckets=2, clock=lambda: now[0])
+    assert [limiter.check('writes', 'bill') for i in range(3)] == [0, 0, 2]
+    assert limiter.check('writes', 'marie') == 0
+    now[0] = 1
+    assert limiter.check('writes', 'bill') == 1
+    now[0] = 2
+    assert limiter.check('writes', 'bill') == 0
+    # Full buckets are pruned once there are too many
+    now[0] = 10
+    limiter.check('writes', 'john')
+    assert set(limiter.buckets) == {('writes', 'john')}
+    assert limiter.stats() == {'classes': {'writes': {'rate': 0.5, 'burst': 2, 'allowed': 5, 'limited': 2}}, 'buckets': 1}
+
+def test_rate_limiter_max_buckets():
+    limiter = rate_limit.RateLimiter({'writes': (0.5, 2)}, max_buckets=3, clock=lambda: 0)
+    for i in range(10):
+        limiter.check('writes', 'bill')
+        limiter.check('writes', 'customer' + str(i))
+        assert len(limiter.buckets) <= 3
+    # Buckets still refilling are evicted least recently used first, so the one in use is kept
+    assert set(limiter.buckets) == {('writes', 'customer8'), ('writes', 'bill'), ('writes', 'customer9')}
+    assert limiter.check('writes', 'bill') == 2
+
+def test_e2e_rate_limit():
+    limiter = rate_limit.RateLimiter({'writes': (1, 1), 'reports': (1, 1), 'auth': (0.1, 2)}, clock=lambda: 0)
+    with mock.patch.object(main, 'rate_limiter', limiter):
+        statuses = [client.post("/validity", json={'id': 'bill', 'password': 'wrong'}).status_code for i in range(3)]
+        assert statuses[:2] != [429, 429]
+        response = client.post("/validity", json={'id': 'bill', 'password': 'wrong'})
+        assert response.status_code == 429
+        assert response.headers['retry-after'] == '10'
+        # Other customers and endpoint classes have their own buckets
+        assert client.post("/validity", json={'id': 'marie', 'password': 'wrong'}).status_code != 429
+        assert client.get("/reports/revenue").status_code == 200
+        assert client.get("/reports/revenue").status_code == 429
+        assert client.get("/users/bill").status_code == 200
+        assert client.get("/admin/rate_limits").json()['classes']['auth'] == {'rate': 0.1, 'burst': 2, 'allowed': 3, 'limited': 2}
+        # Lists of a customer's reservations and transactions are reports too
+        assert client.get("/reservations/bill").status_code != 429
+        assert client.get("/transactions/bill").status_code == 429
+def test_e2e_rate_limit_ignores_undeclared_customer():
+    limiter = rate_limit.RateLimiter({'writes': (1, 1), 'reports': (1, 1), 'auth': (1, 1)}, clock=lambda: 0)
+    with mock.patch.object(main, 'rate_limiter', limiter):
+        # Reports do not declare a customer, so naming a new one each time does not get a fresh bucket
+        assert client.get("/reports/usage", params={'customer': 'x0'}).status_code == 200
+        assert client.get("/reports/usage", params={'customer': 'x1'}).status_code == 429
+        # Nor do fields a route does not declare, such as a customer in the body of a balance update for bill
+        assert client.put("/users/bill/account_balance", json={'amount': 1, 'customer': 'x0'}).status_code == 200
+        assert client.put("/users/bill/account_balance", json={'amount': 1, 'customer': 'x1'}).status_code == 429
+
+def test_rate_limiter_cost_above_burst():
+    limiter = rate_limit.RateLimiter({'writes': (1, 2)}, clock=lambda: 0)
+    # A full bucket admits a larger cost and is left in debt
+    assert limiter.check('writes', 'bill', 5) == 0
+    assert limiter.check('writes', 'bill') == 4
+    assert limiter.check('writes', 'marie', 3) == 0
+
+def test_e2e_rate_limit_batch():
+    limiter = rate_limit.RateLimiter({'writes': (1, 20), 'reports': (1, 1), 'auth': (1, 1)}, clock=lambda: 0)
+    operations = [{'method': 'PUT', 'path': '/users/bill/account_balance', 'body': {'amount': 1}}] * 25
+    with mock.patch.object(main, 'rate_limiter', limiter):
+        # Operations are not limited one by one, so a batch can have more of them than the burst
+        actual = client.post("/batch", json={'operations': operations, 'atomic': True})
+        assert actual.json()['committed'] is True
+        assert [result['status'] for result in actual.json()['results']] == [200] * 25
+        # The batch took 25 tokens from its caller's bucket, so the next batch waits for the debt to be paid off
+        response = client.post("/batch", json={'operations': operations})
+        assert response.status_code == 429
+        assert response.headers['retry-after'] == '25'
+        assert client.put("/users/bill/account_balance", json={'amount': 1}).status_code == 200
+
+### Admission control tests
+def test_admission_pool_queues_and_sheds():
+    async def run():
+        pool = admission.AdmissionPool(1, 1, 0.05)
+        assert await pool.acquire()
+        waiting = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0)
+        # Queue is full
+        assert not await pool.acquire()
+        pool.release(1.0)
+        assert await waiting
+        # No slot frees up in time
+        assert not await pool.acquire()
+        assert pool.retry_after() == 1
+        pool.release(30.0)
+        assert pool.stats() == {'concurrency': 1, 'max_queued': 1, 'max_wait': 0.05, 'active': 0, 'queued': 0, 'admitted': 2, 'shed': 2, 'service_time': 3.09}
+        # Wait estimate grows with the queue
+        assert pool.retry_after() == 4
+    asyncio.get_event_loop().run_until_complete(run())
+
+def test_e2e_admission_sheds_bulk_traffic():
+    bulk = admission.AdmissionPool(1, 0, 1)
+    bulk.active = 1
+    bulk.service_time = 2.5
+    with mock.patch.dict(main.admission_pools, {'bulk': bulk}):
+        response = client.get("/reports/revenue")
+        assert response.status_code == 503
+        assert response.headers['retry-after'] == '3'
+        # Bookings and facility manager operations have their own pool
+        assert client.put("/users/bill/name", json={'name': 'Bill'}).status_code == 200
+        assert client.get("/admin/admission").json()['bulk']['shed'] == 1
+    assert main.admission_class({'type': 'http', 'method': 'GET', 'path': '/events', 'query_string': b'', 'headers': [], 'root_path': ''}) is None
+    assert main.admission_pools['critical'].active == 0
+
+### Metrics tests
+def test_metrics_render():
+    registry = metrics.Registry()
+    requests = metrics.Counter('requests_total', 'Requests', ('route', 'status'), registry=registry)
+    latency = metrics.Histogram('latency_seconds', 'Latency', ('route',), buckets=(0.1, 1), registry=registry)
+    requests.inc('/users/{id}', '200')
+    requests.inc('/say "hi"\n', '404', amount=2)
+    for value in (0.05, 0.1, 0.5, 3):
+        latency.observe(value, '/users')
+    assert registry.render() == (
+        '# HELP requests_total Requests\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{route="/say \\"hi\\"\\n",status="404"} 2\n'
+        'requests_total{route="/users/{id}",status="200"} 1\n'
+        '# HELP latency_seconds Latency\n'
+        '# TYPE latency_seconds histogram\n'
+        'latency_seconds_bucket{route="/users",le="0.1"} 2\n'
+        'latency_seconds_bucket{route="/users",le="1"} 3\n'
+        'latency_seconds_bucket{route="/users",le="+Inf"} 4\n'
+        'latency_seconds_sum{route="/users"} 3.65\n'
+        'latency_seconds_count{route="/users"} 4\n'
+    )
+
+def test_e2e_metrics():
+    requests = main.http_requests.get('/users/{id}', 'GET', '200')
+    latencies = main.http_request_duration.count('/users/{id}', 'GET')
+    calls = api_sqlite.database_calls.get('get_user')
+    rejections = facility.reservation_rejections.get('Time not :00 or :30')
+    client.get("/users/bill")
+    client.get("/no/such/route")
+    client.post("/validity", json={'id': 'bill', 'password': 'wrong'})
+    facility.reservation_valid('workshop', 'bill', next_weekday_morning(3).replace(minute=15))
+    assert main.http_requests.get('/users/{id}', 'GET', '200') == requests + 1
+    assert main.http_request_duration.count('/users/{id}', 'GET') == latencies + 1
+    assert api_sqlite.database_calls.get('get_user') == calls + 1
+    assert facility.reservation_rejections.get('Time not :00 or :30') == rejections + 1
+    response = client.get("/metrics")
+    assert response.headers['content-type'].startswith('text/plain; version=0.0.4')
+    assert 'http_requests_total{route="unmatched",method="GET",status="404"}' in response.text
+    assert 'password_hash_seconds_count{operation="password_valid"}' in response.text
+    assert re.search('^database_statements_total{kind="queries"} [0-9]+$', response.text, re.MULTILINE)
+
+### Slow query log tests
+def test_slow_query_log_keeps_slowest():
+    log = slow_query_log.SlowQueryLog(0.1, max_entries=2)
+    for seconds in (0.2, 0.5, 0.3, 0.1):
+        log.record(seconds, 'SELECT ' + str(seconds), [], 'GET /', [])
+    assert log.is_slow(0.1) and not log.is_slow(0.05)
+    assert [entry['sql'] for entry in log.slowest()] == ['SELECT 0.5', 'SELECT 0.3']
+    assert log.logged == 4
+    log.clear()
+    assert log.stats() == {'threshold': 0.1, 'logged': 4, 'slowest': []}
+
+def test_e2e_slow_queries():
+    with mock.patch.object(api_sqlite.slow_query_log, 'threshold', 0):
+        client.delete("/admin/slow_queries")
+        client.get("/reservations", params={'start_date_string': '01-01-2021', 'end_date_string': '01-01-2022'})
+        client.post("/users", json={'id': 'slow_id', 'password': 'test_pass', 'name': 'test_name', 'role': 'client'})
+        entries = client.get("/admin/slow_queries").json()['slowest']
+    reservations = [entry for entry in entries if 'FROM reservations' in entry['sql']][0]
+    assert reservations['endpoint'] == 'GET /reservations'
+    assert reservations['params'] == ['2021-01-02 00:00:00', '2022-01-01 00:00:00']
+    assert reservations['plan'][0].startswith('SEARCH reservations USING INDEX ix_reservations_report')
+    insert = [entry for entry in entries if entry['sql'].startswith('INSERT INTO users')][0]
+    assert insert['endpoint'] == 'POST /users'
+    assert '<16 bytes>' in insert['params']
+    assert client.delete("/admin/slow_queries").json() == {'message': 'Slow queries cleared'}
+def test_slow_query_plan_off_event_loop():
+    query_plan = api_sqlite.query_plan
+    threads = []
+    def recorded_query_plan(sql, params):
+        threads.append(threading.get_ident())
+        return query_plan(sql, params)
+    with mock.patch.object(api_sqlite.slow_query_log, 'threshold', 0), mock.patch('api_sqlite.query_plan', recorded_query_plan):
+        asyncio.get_event_loop().run_until_complete(api_sqlite.get_settings_value('client_logins_allowed'))
+    assert threads
+    assert threading.get_ident() not in threads
+
+### Tracing tests
+def test_tracer_nests_spans():
+    tracer = tracing.Tracer(max_traces=2)
+    with tracing.span('outside') as span:
+        assert span is None
+    for i in range(3):
+        with tracer.trace('request ' + str(i), method='GET'):
+            with tracing.span('stage', step=1):
+                with tracing.span('substage'):
+                    pass
+    assert [trace.root.name for trace in tracer.latest(5)] == ['request 2', 'request 1']
+    trace = tracing.trace_dict(tracer.latest(1)[0])
+    assert [(span['name'], span['attributes']) for span in trace['spans']] == [('request 2', {'method': 'GET'}), ('stage', {'step': 1}), ('substage', {})]
+    assert trace['spans'][2]['parent_id'] == trace['spans'][1]['span_id']
+    assert trace['spans'][1]['parent_id'] == trace['spans'][0]['span_id']
+    assert tracer.latest(5, min_duration=60) == []
+
+def test_e2e_trace_reservation():
+    delete_users_from_test_db()
+    delete_reservations_from_test_db()
+    client.post("/users", json={'id': 'test_id', 'password': 'test_pass', 'name': 'test_name', 'role': 'client'})
+    client.put("/users/test_id/account_balance", json={'amount': 5000})
+    response = client.post("/reservations", json={'resource': 'workshop', 'customer': 'test_id', 'reserver': 'test_id', 'date_time_string': next_weekday_morning(3).strftime('%m-%d-%Y %H:%M')})
+    trace = client.get("/admin/traces/" + response.headers['x-trace-id']).json()
+    assert trace['name'] == 'POST /reservations'
+    assert trace['spans'][0]['attributes'] == {'status': 201}
+    names = [span['name'] for span in trace['spans']]
+    for name in ('facility.reservation_valid', 'facility.reservation_limit_exceeded', 'facility.calculate_costs', 'api_sqlite.get_user', 'api_sqlite.add_paid_reservation'):
+        assert name in names
+    span_ids = {span['span_id'] for span in trace['spans']}
+    assert all(span['parent_id'] in span_ids for span in trace['spans'][1:])
+    add_paid_reservation = [span for span in trace['spans'] if span['name'] == 'api_sqlite.add_paid_reservation'][0]
+    assert any(span['name'] == 'database.write' and span['parent_id'] == add_paid_reservation['span_id'] for span in trace['spans'])
+    assert client.get("/admin/traces", params={'limit': 1}).json()[0]['name'] == 'GET /admin/traces/{trace_id}'
+    assert client.get("/admin/traces/unknown").status_code == 404
+def test_traced_async_generator():
+    tracer = tracing.Tracer()
+    @tracing.traced('rows')
+    async def rows():
+        with tracing.span('row'):
+            yield 1
+        yield 2
+    async def consume():
+        with tracer.trace('request'):
+            return [row async for row in rows()]
+    assert asyncio.get_event_loop().run_until_complete(consume()) == [1, 2]
+    trace = tracing.trace_dict(tracer.latest(1)[0])
+    assert [span['name'] for span in trace['spans']] == ['request', 'rows', 'row']
+    assert trace['spans'][2]['parent_id'] == trace['spans'][1]['span_id']
+def test_tracer_writes_file_in_background(tmp_path):
+    path = str(tmp_path / 'traces.jsonl')
+    tracer = tracing.Tracer(path=path)
+    for i in range(3):
+        with tracer.trace('request ' + str(i)):
+            pass
+    tracer.close()
+    with open(path) as trace_file:
+        assert [json.loads(line)['name'] for line in trace_file] == ['request 0', 'request 1', 'request 2']
+    assert tracer.trace_file is None
+    # Traces after closing are still kept in memory
+    with tracer.trace('request 3'):
+        pass
+    assert tracer.latest(1)[0].root.name == 'request 3'
+
+def test_e2e_trace_batch_operations():
+    response = client.post("/batch", json={'operations': [{'method': 'GET', 'path': '/users/bill'}]})
+    trace = client.get("/admin/traces/" + response.headers['x-trace-id']).json()
+    assert [span['name'] for span in trace['spans']][:2] == ['POST /batch', 'GET /users/{id}']
+
+### Admin and profiler tests
+def test_e2e_admin_token():
+    assert client.get("/admin/report_cache").status_code == 200
+    with mock.patch.object(main, 'ADMIN_TOKEN', 'secret'):
+        assert client.get("/admin/report_cache").status_code == 401
+        assert client.get("/admin/report_cache", headers={'Authorization': 'Bearer wrong'}).status_code == 401
+        assert client.get("/admin/report_cache", headers={'Authorization': 'Bearer secret'}).status_code == 200
+    # Profiling is only available with an admin token
+    assert client.get("/admin/profile", params={'seconds': 0.1}).status_code == 403
+
+def test_profiler_collapsed_stacks():
+    def spin(stop):
+        while not stop.is_set():
+            sum(range(1000))
+    stop = threading.Event()
+    thread = threading.Thread(target=spin, args=(stop,), name='spinner')
+    thread.start()
+    try:
+        counts = profiler.sample(0.1, 0.001)
+    finally:
+        stop.set()
+        thread.join()
+    stacks = profiler.collapsed_stacks(counts)
+    assert re.search('^spinner;.*test_main.py:spin [0-9]+$', stacks, re.MULTILINE)
+    assert 'profiler.py:sample' not in stacks
+
+def test_e2e_profile():
+    with mock.patch.object(main, 'ADMIN_TOKEN', 'secret'):
+        headers = {'Authorization': 'Bearer secret'}
+        response = client.get("/admin/profile", params={'seconds': 0.1}, headers=headers)
+        assert response.status_code == 200
+        assert re.search('^MainThread;.* [0-9]+$', response.text, re.MULTILINE)
+        response = client.get("/admin/profile", params={'seconds': 0.1, 'format': 'pstats'}, headers=headers)
+        assert response.headers['content-type'] == 'application/octet-stream'
+        assert any(function == 'profile_server' for filename, line, function in marshal.loads(response.content))
+        assert client.get("/admin/profile", params={'seconds': 61}, headers=headers).status_code == 400
+        main.profiler_lock.acquire()
+        try:
+            assert client.get("/admin/profile", params={'seconds': 0.1}, headers=headers).status_code == 409
+        finally:
+            main.profiler_lock.release()
+
+def test_deep_size_counts_shared_objects_once():
+    value = 'x' * 1000
+    assert memory.deep_size([value]) > 1000
+    assert memory.deep_size([value, value]) < 2000
+    seen = set()
+    memory.deep_size(value, seen)
+    assert memory.deep_size([value], seen) < 1000
+
+def test_e2e_memory():
+    before = client.get("/admin/memory").json()
+    assert before['tracemalloc'] is None
+    facility.resources[0].reservations[datetime.datetime(2030, 1, 1)] = 'x' * 10000
+    after = client.get("/admin/memory").json()
+    assert after['subsystems']['reservations']['entries'] == before['subsystems']['reservations']['entries'] + 1
+    assert after['subsystems']['reservations']['bytes'] > before['subsystems']['reservations']['bytes'] + 10000
+    assert set(after['subsystems']) >= {'report_cache', 'coalesced_reads', 'events', 'traces'}
+    assert client.post("/admin/memory/tracemalloc", params={'frames': 0}).status_code == 400
+    assert client.post("/admin/memory/tracemalloc").json() == {'tracing': True}
+    try:
+        growth = [bytearray(100000) for i in range(10)]
+        diff = client.get("/admin/memory").json()['tracemalloc']
+        assert any('test_main.py:' in line['location'] and line['size_diff'] >= 1000000 for line in diff['top'])
+    finally:
+        assert client.delete("/admin/memory/tracemalloc").json() == {'tracing': False}
+
+def test_audit_finds_missing_phantom_claims_and_violations():
+    conn = sqlite3.connect(':memory:')
+    api_sqlite.metadata.create_all(sqlalchemy.create_engine('sqlite://', creator=lambda: conn))
+    monday = datetime.datetime(2021, 10, 4, 9, 0)
+    rows = [('workshop', monday, 'bill'), ('irradiator', monday, 'bill'), ('irradiator', monday, 'alice'),
+            ('high velocity crusher', monday + datetime.timedelta(hours=1), 'bill'), ('high velocity crusher', monday + datetime.timedelta(hours=5), 'marie')]
+    for i, (resource, date_time, customer) in enumerate(rows):
+        conn.execute('INSERT INTO reservations VALUES (?, ?, ?, ?, ?, ?)', ('uuid' + str(i), date_time, resource, customer, customer, 1.0))
+    facility.resources[0].reservations[monday] = 'bill'
+    facility.resources[1].reservations[monday + datetime.timedelta(minutes=30)] = 'marie'
+    facility.resources[16].reservations[monday] = 'bill'
+    facility.resources[16].reservations[monday + datetime.timedelta(minutes=30)] = 'bill'
+    report = audit.audit(conn, facility.resources, audit.snapshot_claims(facility.resources), chunk_rows=2)
+    assert not report['consistent']
+    assert report['rows'] == 5 and report['claims'] == 4
+    assert [claim['serial_num'] for claim in report['missing_claims']['examples']] == ['uuid2', 'uuid3', 'uuid4']
+    assert report['phantom_claims']['examples'] == [
+        {'unit': 1, 'resource': 'workshop', 'date': '2021-10-04 09:30', 'customer': 'marie'},
+        {'unit': 16, 'resource': 'irradiator', 'date': '2021-10-04 09:30', 'customer': 'bill'}]
+    assert [(violation['rule'], violation['date']) for violation in report['violations']['examples']] == [
+        ('Irradiators at same time', '2021-10-04 09:00'), ('Crusher recalibrating', '2021-10-04 14:00'), ('Irradiator cooling down', '2021-10-04 09:30')]
+    assert report['held_slots'][16] == {'unit': 16, 'resource': 'irradiator', 'held_slots': 2}
+    since = audit.audit(conn, facility.resources, audit.snapshot_claims(facility.resources, monday + datetime.timedelta(hours=2)), monday + datetime.timedelta(hours=2), max_examples=0)
+    assert since['rows'] == 1 and since['claims'] == 0
+    assert since['missing_claims'] == {'count': 1, 'examples': []}
+
+def test_e2e_audit():
+    # Reservations from before the startup claims (all seeded ones) are only audited on request
+    assert client.get("/admin/audit").json()['rows'] == 0
+    report = client.get("/admin/audit", params={'since': '01-01-2021'}).json()
+    assert report['missing_claims']['count'] == report['rows'] > 0
+    assert not report['consistent'] and not report['concurrent_writes']
+    assert len(report['held_slots']) == len(facility.resources)
+    assert client.get("/admin/audit", params={'since': '2021-10-04'}).status_code == 400
+    assert client.get("/admin/audit", params={'since': '01-01-2030'}).json()['consistent']
+
+def test_startup_phases():
+    order = []
+    async def load():
+        order.append('load')
+    def fail():
+        raise ValueError('broken')
+    phases = startup.Startup([('load', load), ('check', lambda: order.append('check')), ('fail', fail)])
+    with pytest.raises(ValueError):
+        asyncio.get_event_loop().run_until_complete(phases.run())
+    assert order == ['load', 'check']
+    assert not phases.ready and phases.failed == 'fail'
+    assert list(phases.status()['phases']) == ['load', 'check']
+    phases.phases[2] = ('fail', lambda: None)
+    asyncio.get_event_loop().run_until_complete(phases.run())
+    assert order == ['load', 'check']
+    assert phases.ready and phases.failed is None
+
+def test_e2e_readiness():
+    status = client.get("/readyz").json()
+    assert status['ready'] and status['import_seconds'] > 0
+    assert list(status['phases']) == ['schema', 'migrations', 'catalog', 'settings', 'warm_up']
+    with mock.patch.object(main.startup_phases, 'ready', False):
+        response = client.get("/users")
+        assert response.status_code == 503 and response.headers['retry-after'] == '1'
+        assert client.get("/readyz").status_code == 503
+        assert client.get("/healthz").json() == {'status': 'ok'}
+        with mock.patch.object(main.startup_phases, 'failed', 'migrations'):
+            assert client.get("/healthz").status_code == 500
+
+def test_warm_up_restores_upcoming_claims():
+    tomorrow = datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1), datetime.time(10, 0))
+    conn = api_sqlite.sqlite_connect()
+    for serial_num, date_time, resource in (('past', tomorrow - datetime.timedelta(days=2), 'irradiator'), ('first', tomorrow, 'workshop'),
+                                            ('second', tomorrow, 'workshop'), ('third', tomorrow, 'irradiator')):
+        conn.execute('INSERT INTO reservations VALUES (?, ?, ?, ?, ?, ?)', (serial_num, date_time, resource, 'bill', 'bill', 1.0))
+    conn.commit()
+    conn.close()
+    asyncio.get_event_loop().run_until_complete(main.warm_up_scheduler())
+    assert [resource.id for resource in facility.resources if resource.reservations] == [0, 1, 16]
+    assert facility.resources[16].reservations == {tomorrow: 'bill'}
+    assert client.get("/admin/audit").json()['consistent']
+
@@ -0,0 +1,171 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import inspect
+import json
+import os
+import time
+
+"""Contains lightweight request tracing with nested timed spans"""
+
+# Span that new spans are children of (None outside traced requests, where spans are not recorded)
+_current_span = ContextVar('current_span', default=None)
+
+
+class Trace:
+    """Spans of one traced request"""
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.root = None
+        self.spans = []
+
+
+class Span:
+    """Timed stage of a request with its parent span and attributes"""
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+
+    def finish(self):
+        """Record duration and add span to its trace"""
+        self.duration = time.perf_counter() - self.started
+        self.trace.spans.append(self)
+
+    def to_dict(self):
+        """Get span as a JSON-serializable dictionary with times in seconds"""
+        return {
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': round(self.start, 6),
+            'duration': round(self.duration, 6),
+            'attributes': self.attributes
+        }
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time the with block as a child of the current span, if a traced request is running"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace, name, parent.span_id, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    finally:
+        _current_span.reset(token)
+        child.finish()
+
+
+def traced(name):
+    """Decorate function, coroutine function or async generator function so every call is timed as a span"""
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+        elif inspect.isasyncgenfunction(function):
+            # Timed from the first item to the last, including time the caller spends between items
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with span(name):
+                    async for item in function(*args, **kwargs):
+                        yield item
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with span(name):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Tracer:
+    """Keeps the max_traces latest traces in memory, also appending them to a JSON-lines file at path if given"""
+
+    def __init__(self, max_traces=1000, path=None):
+        self.traces = deque(maxlen=max_traces)
+        self.path = path
+        # Traces are appended to the file by one worker thread so requests do not wait for disk writes
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='trace_writer') if path else None
+        # Opened by the writer on the first trace and kept open until close
+        self.trace_file = None
+
+    @contextmanager
+    def trace(self, name, **attributes):
+        """Time the with block as the root span of a new trace, recording the trace once it ends, or as a child span inside another trace"""
+        if _current_span.get() is not None:
+            with span(name, **attributes) as child:
+                yield child
+            return
+        root = Span(Trace(), name, None, attributes)
+        root.trace.root = root
+        token = _current_span.set(root)
+        try:
+            yield root
+        finally:
+            _current_span.reset(token)
+            root.finish()
+            self.record(root.trace)
+
+    def record(self, trace):
+        """Keep finished trace, dropping the oldest if the buffer is full, and queue it to be written to the file"""
+        self.traces.append(trace)
+        if self.writer is not None:
+            self.writer.submit(self.write, trace)
+
+    def write(self, trace):
+        """Append trace to the JSON-lines file, in the writer thread"""
+        if self.trace_file is None:
+            self.trace_file = open(self.path, 'a')
+        self.trace_file.write(json.dumps(trace_dict(trace), separators=(',', ':')) + '\n')
+        self.trace_file.flush()
+
+    def close(self):
+        """Wait for queued traces to be written and close the file, later traces only being kept in memory"""
+        if self.writer is not None:
+            self.writer.shutdown(wait=True)
+            self.writer = None
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+
+    def find(self, trace_id):
+        """Get kept trace with ID, None if it is not kept"""
+        for trace in self.traces:
+            if trace.trace_id == trace_id:
+                return trace
+        return None
+
+    def latest(self, limit, min_duration=0):
+        """Get up to limit kept traces whose root span took at least min_duration seconds, latest first"""
+        traces = []
+        for trace in reversed(self.traces):
+            if trace.root.duration >= min_duration:
+                traces.append(trace)
+                if len(traces) == limit:
+                    break
+        return traces
+
+
+def trace_dict(trace):
+    """Get trace as a JSON-serializable dictionary with its spans in the order they started"""
+    return {
+        'trace_id': trace.trace_id,
+        'name': trace.root.name,
+        'duration': round(trace.root.duration, 6),
+        'spans': [child.to_dict() for child in sorted(trace.spans, key=lambda child: child.started)]
+    }